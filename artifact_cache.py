@@ -0,0 +1,154 @@
+"""
+Content-addressed cache for what a ranking run produces, so that a rerun on the same data with the same configuration
+doesn't rebuild the profile or search for the model again; there are two kinds of artifacts
+
+	profile	: the customer profile (dense or sparse) with the customer IDs and populations, keyed by the configuration
+			  parameters the features depend on (PROFILE_KEYS), a fingerprint of the transactions and one of the Mosaic
+		  rules file (MOSAIC_CLASSES_FILE), so that editing the rules makes a new profile
+	ranking	: the train/test split, the fitted best estimator, its accuracy and the importances, keyed by the parameters
+			  of the search and the ranking (RANKING_KEYS) and a fingerprint of the profile itself
+
+every artifact is a pickle in ARTIFACT_CACHE_DIR named after its key; reading an artifact marks it as recently used and
+once the directory takes more than ARTIFACT_CACHE_MAX_MB the least recently used artifacts are removed
+
+"""
+
+import hashlib
+import os
+import pickle
+from datetime import date
+
+PROFILE_KEYS = ("MTYPE_PRIMARY_JUNK", "MTYPE_SECONDARY_JUNK", "HANDLE_CUSTOMERS_WITH_NO_MOSAIC_GROUP", "HANDLE_CUSTOMERS_WITH_NO_GENDER",
+					"MOSAIC_CLASSES_FILE", "NTOP_SEC_MTYPES_INTO_FEATURES", "REFERENCE_DATE", "TIME_WINDOWS", "PROFILE_FORMAT",
+					"DEDUP_POLICY", "TRANS_FEATURE_COLUMNS", "TRANS_FEATURE_MODE", "TRANS_FEATURE_VOCAB_SIZE", "TRANS_FEATURE_HASH_BUCKETS",
+					"TRANS_FEATURE_NUMERIC")
+
+RANKING_KEYS = ("ESTIMATOR_BACKEND", "SEARCH_STRATEGY", "SEARCH_N_CANDIDATES", "SEARCH_MAX_EVALS", "SEARCH_TIME_BUDGET", "RANKING_MODE", "RANKING_METHODS",
+					"RANKING_N_REPEATS", "RANKING_TOP_K", "RANKING_PATIENCE", "RANKING_N_BOOTSTRAP", "BATCH_JOBS", "BATCH_MIN_CUSTOMERS")
+
+#
+# a fingerprint of a data frame: hashes its values row by row (in one vectorized pass) together with its columns and dtypes
+#
+
+def frame_fingerprint(df):
+
+	import pandas as pd  # not needed for anything else here, so rank_features.py starts without it
+
+	h = hashlib.sha1(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+	h.update(str([(c, str(t)) for c, t in df.dtypes.items()]).encode("utf-8"))
+
+	return h.hexdigest()
+
+#
+# a fingerprint of a file's contents, e.g. the Mosaic rules (MOSAIC_CLASSES_FILE) the profile is made with
+#
+
+def file_fingerprint(path):
+
+	h = hashlib.sha1()
+
+	try:
+		with open(path, "rb") as f:
+			for block in iter(lambda: f.read(1 << 20), b""):
+				h.update(block)
+	except IOError:
+		return "missing"
+
+	return h.hexdigest()
+
+class ArtifactCache(object):
+
+	KINDS = ["profile", "ranking"]
+
+	def __init__(self, pars):
+
+		self.enabled = (pars["ARTIFACT_CACHE"].lower().strip() == "yes")
+		self.cache_dir = pars["ARTIFACT_CACHE_DIR"] or "./data/artifacts"
+		self.max_mb = float(pars["ARTIFACT_CACHE_MAX_MB"] or 2048)
+		self.pars = pars
+
+	#
+	# the key: a hash of the configuration parameters in keys and whatever else the artifact depends on (fingerprints)
+	#
+
+	def key(self, keys, *parts):
+
+		h = hashlib.sha1()
+
+		for k in keys:
+			v = self.pars[k].strip()
+			if (k == "REFERENCE_DATE") and not v:
+				v = date.today().isoformat()  # no reference date means today, so the profile changes every day
+			h.update("|{}={}".format(k, v).encode("utf-8"))
+
+		for p in parts:
+			h.update("|{}".format(p).encode("utf-8"))
+
+		return h.hexdigest()
+
+	def _path(self, kind, key):
+
+		if kind not in self.KINDS:
+			raise ValueError("error! unknown artifact kind {}; choose from {}...".format(kind, self.KINDS))
+
+		return os.path.join(self.cache_dir, "{}_{}.pkl".format(kind, key))
+
+	def get(self, kind, key):
+
+		if not self.enabled:
+			return None
+
+		path = self._path(kind, key)
+
+		try:
+			with open(path, "rb") as f:
+				artifact = pickle.load(f)
+		except (IOError, EOFError, pickle.UnpicklingError):
+			return None
+
+		os.utime(path)  # the modification time is when it was last used
+		print("loaded {} from the artifact cache ({})...".format(kind, key[:12]))
+
+		return artifact
+
+	def put(self, kind, key, artifact):
+
+		if not self.enabled:
+			return
+
+		os.makedirs(self.cache_dir, exist_ok=True)
+		path = self._path(kind, key)
+
+		# write to a temporary file first so that an interrupted run doesn't leave a broken artifact behind
+		tmp_path = "{}.{}.tmp".format(path, os.getpid())
+		with open(tmp_path, "wb") as f:
+			pickle.dump(artifact, f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp_path, path)
+
+		print("saved {} to the artifact cache ({}, {} MB)...".format(kind, key[:12], round(os.path.getsize(path)/1024**2, 1)))
+
+		self._evict(keep=path)
+
+	#
+	# remove the least recently used artifacts until the cache fits into ARTIFACT_CACHE_MAX_MB (the one just saved stays)
+	#
+
+	def _evict(self, keep=None):
+
+		files = []
+		for name in os.listdir(self.cache_dir):
+			path = os.path.join(self.cache_dir, name)
+			if name.endswith(".pkl") and os.path.isfile(path):
+				st = os.stat(path)
+				files.append((st.st_mtime, st.st_size, path))
+
+		total = sum(size for mtime, size, path in files)
+
+		for mtime, size, path in sorted(files):
+			if total <= self.max_mb*1024**2:
+				break
+			if path == keep:
+				continue
+			os.remove(path)
+			total -= size
+			print("evicted {} from the artifact cache...".format(os.path.basename(path)))
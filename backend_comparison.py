@@ -0,0 +1,127 @@
+"""
+Compare the estimator backends (see estimator_backends) on the same profile: every backend in COMPARE_BACKENDS gets
+the same training and testing customers, its own model search (with no cached fits) and ranking, in a fresh worker
+process so that its memory is its own; for every backend we record
+
+	fit_sec, rank_sec		: wall-clock seconds of the model search and of the ranking
+	peak_rss_mb				: the peak resident memory of the worker process, rss_added_mb less what it started with
+	accuracy				: on the testing customers
+	top_k_stability			: how often the top RANKING_TOP_K features (by the stability ranking) made the top RANKING_TOP_K
+							  in the bootstrap samples, on average; 1 means the ranking doesn't move at all
+	top_k_overlap			: the share of its top RANKING_TOP_K features that are in the top RANKING_TOP_K of the first backend
+
+and the table goes to COMPARE_RESULTS_FILE (tab-separated); with a memory-mapped profile (see
+CustProfileCreator.feature_matrix) the workers get the name of its file and the positions of the training customers
+in it rather than a copy of the training set
+
+"""
+
+import mmap
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+
+from estimator_backends import get_backend
+from feature_ranking import FeatureRanker
+from model_search import ModelSearch
+from stage_profiler import _peak_rss_mb
+
+#
+# fit and rank with one backend; runs in a worker process of its own; X_train may be the file of a memory-mapped
+# matrix with the training customers at train_rows
+#
+
+def _run_backend(name, X_train, X_test, y_train, y_test, feature_names, pars, train_rows=None):
+
+	rss_start = _peak_rss_mb()
+	X_train = np.load(X_train, mmap_mode="r") if isinstance(X_train, str) else X_train  # a file name: map it
+
+	pars = defaultdict(str, pars)
+	pars["ESTIMATOR_BACKEND"] = name
+	pars["SEARCH_CACHE_DIR"] = tempfile.mkdtemp()  # time the fits, not the cache
+	pars["RANKING_METHODS"] = "impurity permutation stability"
+
+	backend = get_backend(name)
+	if backend.dense_input and sparse.issparse(X_test):
+		X_test = X_test.toarray()
+
+	start_time = time.perf_counter()
+	search = ModelSearch(pars)
+	model = search.fit(X_train, y_train, train_rows)
+	fit_sec = time.perf_counter() - start_time
+
+	start_time = time.perf_counter()
+	ranker = FeatureRanker(pars, backend)
+	importances = ranker.rank(model, X_test, y_test, feature_names)
+	rank_sec = time.perf_counter() - start_time
+
+	shutil.rmtree(pars["SEARCH_CACHE_DIR"], ignore_errors=True)
+
+	stability = importances.loc[importances["method"] == "stability"]
+	top = stability.loc[stability["rank"] <= ranker.top_k]
+
+	rss_end = _peak_rss_mb()
+
+	return ({"backend": name, "fit_sec": round(fit_sec, 2), "rank_sec": round(rank_sec, 2), "peak_rss_mb": rss_end,
+				"rss_added_mb": None if rss_end is None else round(rss_end - rss_start, 1),
+				"accuracy": round(model.score(X_test, y_test), 3), "best_params": str(search.best_params_),
+				"top_k_stability": round(top["top_k_share"].mean(), 3), "permutation_repeats": ranker.n_repeats_done},
+				list(top["feature"]))
+
+class BackendComparison(object):
+
+	def __init__(self, pars):
+
+		self.backends = pars["COMPARE_BACKENDS"].split() or ["random_forest", "extra_trees", "hist_gb", "l1_logistic"]
+		self.results_file = pars["COMPARE_RESULTS_FILE"] or "./data/backend_comparison.csv"
+		self.pars = pars
+
+		for name in self.backends:
+			get_backend(name)  # fails on unknown names before anything is fitted
+
+		self.results = pd.DataFrame()
+
+	#
+	# rows: the positions of the customers (with the labels in y) in a memory-mapped X; all the rows of X if not given
+	#
+
+	def run(self, X, y, feature_names, train_idx, test_idx, rows=None):
+
+		X = X.values if hasattr(X, "iloc") else X
+		y = np.asarray(y)
+		y_train, y_test = y[train_idx], y[test_idx]
+
+		if (rows is not None) and isinstance(X, np.memmap) and isinstance(X.base, mmap.mmap):
+			# the testing set is read into memory, the training set stays in the file the workers map
+			X_train, X_test, train_rows = X.filename, np.array(X[rows[test_idx]]), rows[train_idx]
+		else:
+			X = X if rows is None else X[rows]
+			X_train, X_test, train_rows = X[train_idx], X[test_idx], None
+
+		results, tops = [], []
+
+		for name in self.backends:
+
+			print("---> backend {}: {} training and {} testing customers".format(name, len(train_idx), len(test_idx)))
+
+			with ProcessPoolExecutor(max_workers=1) as pool:
+				res, top = pool.submit(_run_backend, name, X_train, X_test, y_train, y_test, feature_names, dict(self.pars),
+																											train_rows).result()
+
+			res["top_k_overlap"] = round(len(set(top) & set(tops[0]))/max(len(top), 1), 3) if tops else 1.0
+			results.append(res)
+			tops.append(top)
+
+		self.results = pd.DataFrame(results)
+		self.results.to_csv(self.results_file, sep="\t", index=False)
+
+		print("---> backends compared on the same profile")
+		print(self.results.drop(columns=["best_params"]).to_string(index=False))
+		print("saved results to {}...".format(self.results_file))
+
+		return self.results
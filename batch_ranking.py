@@ -0,0 +1,195 @@
+"""
+Batch ranking over many population comparisons: the customer feature matrix is computed once, written to
+BATCH_DIR as .npy files and memory-mapped by every worker process (rather than pickled to each of them);
+a profile that is memory-mapped already (see CustProfileCreator.feature_matrix) isn't written again, the workers
+map its file and only the positions of the labelled customers in it go to BATCH_DIR; every job picks the rows of
+the customers in the populations it compares, searches for a model and ranks the features (see model_search and
+feature_ranking), one job per worker process at a time;
+
+BATCH_JOBS
+	one_vs_rest	: every population against all the other (labelled) customers
+	pairwise	: every pair of populations
+
+jobs with fewer than BATCH_MIN_CUSTOMERS customers on either side are skipped; the tables of all jobs are
+combined into one with the job name (the populations compared) and the test accuracy of its model
+
+"""
+
+import mmap
+import os
+import time
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import combinations
+from scipy import sparse
+from sklearn.model_selection import train_test_split
+
+from estimator_backends import get_backend
+from model_search import ModelSearch
+from feature_ranking import FeatureRanker
+
+# the memory-mapped feature matrix and labels, set once per worker by _init_worker; _rows are the positions of the
+# labelled customers in _X if it is the mapped profile itself
+_X = None
+_y = None
+_rows = None
+
+def _init_worker(batch_dir, is_sparse, matrix_file=None):
+
+	global _X, _y, _rows
+
+	if matrix_file is not None:
+		_X = np.load(matrix_file, mmap_mode="r")
+		_rows = np.load(os.path.join(batch_dir, "rows.npy"))
+	elif is_sparse:
+		shape = tuple(np.load(os.path.join(batch_dir, "shape.npy")))
+		_X = sparse.csr_matrix(tuple(np.load(os.path.join(batch_dir, part + ".npy"), mmap_mode="r")
+															for part in ["data", "indices", "indptr"]), shape=shape, copy=False)
+	else:
+		_X = np.load(os.path.join(batch_dir, "X.npy"), mmap_mode="r")
+
+	_y = np.load(os.path.join(batch_dir, "y.npy"), mmap_mode="r")
+
+#
+# one job: the customers in the positive populations against those in the negative ones; the search and ranking
+# run in this process since the jobs themselves are spread over the worker processes
+#
+
+def _run_job(job, pars, feature_names):
+
+	name, pos, neg = job
+	start_time = time.time()
+
+	pars = defaultdict(str, pars)
+	pars["SEARCH_N_JOBS"] = pars["RANKING_N_JOBS"] = "1"
+
+	rows = np.flatnonzero(np.isin(_y, pos + neg))
+	X = _X[rows] if _rows is None else _X[_rows[rows]]  # only the rows of this job are read from the mapped file
+	X = X.toarray() if sparse.issparse(X) and get_backend(pars["ESTIMATOR_BACKEND"]).dense_input else X
+	y = np.isin(_y[rows], pos).astype(int)
+
+	X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, stratify=y, random_state=113)
+
+	forest = ModelSearch(pars).fit(X_train, y_train)
+	importances = FeatureRanker(pars).rank(forest, X_test, y_test, feature_names)
+
+	importances.insert(0, "job", name)
+	importances["accuracy"] = forest.score(X_test, y_test)
+
+	return (importances, time.time() - start_time)
+
+class BatchRanker(object):
+
+	def __init__(self, pars):
+
+		self.pars = pars
+		self.job_types = pars["BATCH_JOBS"].split() or ["one_vs_rest", "pairwise"]
+		self.n_jobs = int(pars["BATCH_N_JOBS"] or 0) or os.cpu_count()
+		self.batch_dir = pars["BATCH_DIR"] or "./data/batch"
+		self.min_customers = int(pars["BATCH_MIN_CUSTOMERS"] or 20)
+
+		for j in self.job_types:
+			if j not in ["one_vs_rest", "pairwise"]:
+				raise ValueError("error! unknown batch job type {}...".format(j))
+
+		self.jobs = []
+
+	#
+	# the comparisons to make: (name, positive population codes, negative population codes)
+	#
+
+	def _make_jobs(self, y, pops_inverse_enc):
+
+		codes, sizes = np.unique(y, return_counts=True)
+		size = dict(zip(codes.tolist(), sizes.tolist()))
+		codes = sorted(size, key=lambda c: str(pops_inverse_enc[c]))
+
+		jobs = []
+
+		if "one_vs_rest" in self.job_types:
+			for c in codes:
+				jobs.append(("{} vs rest".format(pops_inverse_enc[c]), [c], [r for r in codes if r != c]))
+
+		if "pairwise" in self.job_types:
+			for c, d in combinations(codes, 2):
+				jobs.append(("{} vs {}".format(pops_inverse_enc[c], pops_inverse_enc[d]), [c], [d]))
+
+		self.jobs = []
+
+		for name, pos, neg in jobs:
+			npos, nneg = sum(size[c] for c in pos), sum(size[c] for c in neg)
+			if min(npos, nneg) < self.min_customers:
+				print("skipping {}: {} vs {} customers...".format(name, npos, nneg))
+				continue
+			self.jobs.append((name, pos, neg))
+
+		return self.jobs
+
+	#
+	# save the feature matrix and labels so that the workers can memory-map them; a mapped matrix stays where it is
+	# and only the positions of the labelled customers in it are saved
+	#
+
+	def _share(self, X, y, rows=None):
+
+		if not os.path.exists(self.batch_dir):
+			os.makedirs(self.batch_dir)
+
+		if rows is not None:
+			np.save(os.path.join(self.batch_dir, "rows.npy"), np.asarray(rows))
+		elif sparse.issparse(X):
+			X = X.tocsr()
+			for part in ["data", "indices", "indptr"]:
+				np.save(os.path.join(self.batch_dir, part + ".npy"), getattr(X, part))
+			np.save(os.path.join(self.batch_dir, "shape.npy"), np.array(X.shape))
+		else:
+			np.save(os.path.join(self.batch_dir, "X.npy"), np.ascontiguousarray(X, dtype="float32"))
+
+		np.save(os.path.join(self.batch_dir, "y.npy"), np.asarray(y).astype(int))
+
+	#
+	# rows: the positions of the customers (with the labels in y) in a memory-mapped X, which the workers then map
+	# themselves; else all the rows of X, of which only the customers who are in one population have a label
+	#
+
+	def rank(self, X, y, feature_names, pops_inverse_enc, rows=None):
+
+		X = X.values if hasattr(X, "iloc") else X
+		y = np.asarray(y, dtype=float)
+
+		mapped = (rows is not None) and isinstance(X, np.memmap) and isinstance(X.base, mmap.mmap)
+
+		if mapped:
+			y = y.astype(int)
+		else:
+			X = X if rows is None else X[rows]
+			labelled = ~np.isnan(y)
+			X, y = X[labelled], y[labelled].astype(int)
+
+		self._make_jobs(y, pops_inverse_enc)
+
+		if not self.jobs:
+			raise ValueError("error! no population comparisons with enough customers to rank features for...")
+
+		self._share(X, y, rows if mapped else None)
+		print("ranking features for {} population comparisons, {} workers...".format(len(self.jobs), self.n_jobs))
+
+		start_time = time.time()
+		tables = dict()
+
+		with ProcessPoolExecutor(max_workers=self.n_jobs, initializer=_init_worker,
+																initargs=(self.batch_dir, sparse.issparse(X), X.filename if mapped else None)) as pool:
+
+			futures = {pool.submit(_run_job, job, dict(self.pars), list(feature_names)): job for job in self.jobs}
+
+			for fut in as_completed(futures):
+				name, pos, neg = futures[fut]
+				tables[name], job_time = fut.result()
+				print("done {} ({} sec), {} of {} jobs...".format(name, round(job_time, 1), len(tables), len(self.jobs)))
+
+		print("batch ranking took {} sec...".format(round(time.time() - start_time, 1)))
+
+		# in the order of the jobs whichever finished first
+		return pd.concat([tables[name] for name, pos, neg in self.jobs], ignore_index=True)
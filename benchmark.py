@@ -0,0 +1,178 @@
+"""
+Benchmarks on synthetic transactions (see synthetic_data) for every size in BENCH_SIZES (rows) and every stage in BENCH_STAGES:
+
+	ingest		: read the transactions from a SQLite stand-in of the TEGA tables through DataHandler (the database
+				  is generated once per size and kept in BENCH_DIR)
+	features	: CustProfileCreator.create_customer_features
+	profile		: CustProfileCreator.create_profile
+	train		: the model search (ModelSearch.fit) on the labelled customers, with no cached fits
+
+every run appends its timings (see stage_profiler) to BENCH_RESULTS_FILE; a stage that takes more than BENCH_REGRESSION_THRESHOLD
+times the median wall time of the earlier runs of the same size (and at least half a second longer, so that the small sizes
+don't flag noise) is reported as a regression and the script exits with 1;
+note that the peak memory is that of the process, so it's only meaningful in the order the sizes are run
+
+run as
+	python benchmark.py
+
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+
+from data_handler import DataHandler
+from cust_profile_creator import CustProfileCreator
+from model_search import ModelSearch
+from rank_features import read_config
+from stage_profiler import StageProfiler
+from synthetic_data import make_transactions, to_sqlite
+
+class Benchmark(object):
+
+	STAGES = ["ingest", "features", "profile", "train"]
+
+	def __init__(self, pars):
+
+		self.pars = pars
+		self.sizes = [int(float(s)) for s in pars["BENCH_SIZES"].split()] or [10000, 100000, 1000000, 10000000]
+		self.stages = pars["BENCH_STAGES"].split() or self.STAGES
+		self.bench_dir = pars["BENCH_DIR"] or "./data/bench"
+		self.results_file = pars["BENCH_RESULTS_FILE"] or "./data/bench_results.csv"
+		self.threshold = float(pars["BENCH_REGRESSION_THRESHOLD"] or 1.25)
+		self.min_slowdown = 0.5  # seconds
+		self.end_date = "2017-01-01"  # the synthetic transactions go back 3 years from this date
+
+		for s in self.stages:
+			if s not in self.STAGES:
+				raise ValueError("error! unknown benchmark stage {}; choose from {}...".format(s, self.STAGES))
+
+		self.results = pd.DataFrame()
+
+	def _git_commit(self):
+
+		try:
+			return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+		except Exception:
+			return ""
+
+	#
+	# the configuration for a size: everything goes to the benchmark directory
+	#
+
+	def _size_pars(self, n):
+
+		pars = defaultdict(str, self.pars)
+		pars.update({"DSN": "sqlite:" + os.path.join(self.bench_dir, "bench_{}.db".format(n)), "CUST_DATA_TABLE": "AO_CustData",
+						"TRANS_INFO_TABLE": "AO_SalesFacts", "GET_NROWS": "*", "ENFORCE_DOWNLOAD": "yes", "DOWNLOAD_CHUNKSIZE": "0",
+						"CACHE_DIR": self.bench_dir, "CUST_PROF_FILE": os.path.join(self.bench_dir, "profile_{}".format(n)),
+						"REFERENCE_DATE": self.end_date, "PROFILE_STAGES": "yes",
+						"STAGE_REPORT_FILE": os.path.join(self.bench_dir, "stages_{}.json".format(n))})
+
+		return pars
+
+	def _run_size(self, n):
+
+		pars = self._size_pars(n)
+		prof = StageProfiler(pars)
+
+		print("---> benchmark on {} rows".format(n))
+
+		if "ingest" in self.stages:
+			db_file = pars["DSN"][len("sqlite:"):]
+			if not os.path.exists(db_file):
+				print("generating the SQLite database {}...".format(db_file))
+				to_sqlite(make_transactions(n, end_date=self.end_date), db_file)
+			with prof.stage("ingest") as st:
+				dg = DataHandler(pars)
+				dg.download_or_load(columns=CustProfileCreator.required_columns(pars))
+				df = dg.dwnl_tbl
+				st["rows_out"] = len(df.index)
+		else:
+			df = make_transactions(n, end_date=self.end_date)[CustProfileCreator.required_columns(pars)]
+
+		with prof.stage("features", rows_in=len(df.index)) as st:
+			fe = CustProfileCreator(df, pars)
+			fe.create_customer_features()
+			st["rows_out"] = len(fe.ucustomer_ids)
+
+		if ("profile" in self.stages) or ("train" in self.stages):
+			with prof.stage("profile", rows_in=len(fe.ucustomer_ids)) as st:
+				fe.create_profile()
+				st["rows_out"] = fe.customer_profile.shape[0] if fe.customer_matrix is None else fe.customer_matrix.shape[0]
+
+		if "train" in self.stages:
+
+			if fe.customer_matrix is not None:
+				labelled = ~np.isnan(fe.customer_labels)
+				X, y = fe.customer_matrix[labelled], fe.customer_labels[labelled].astype(int)
+			else:
+				labelled = fe.customer_profile["Population"].notnull()
+				X = fe.customer_profile.loc[labelled, [c for c in list(fe.customer_profile) if c not in ["Population", "CustomerID"]]]
+				y = fe.customer_profile.loc[labelled, "Population"].astype(int)
+
+			pars["SEARCH_CACHE_DIR"] = tempfile.mkdtemp()  # time the fits, not the cache
+
+			with prof.stage("train", rows_in=X.shape[0]):
+				ModelSearch(pars).fit(X, y)
+
+			shutil.rmtree(pars["SEARCH_CACHE_DIR"], ignore_errors=True)
+
+		prof.save()
+
+		return pd.DataFrame([rec for rec in prof.stages if rec["stage"] in self.stages]).assign(size=n)
+
+	#
+	# compare with the earlier runs in the results file, then add this run to it
+	#
+
+	def _compare(self):
+
+		self.results["baseline_sec"] = np.nan
+
+		if os.path.exists(self.results_file):
+			history = pd.read_csv(self.results_file, sep="\t")
+			baseline = history.groupby(["stage", "size"])["wall_sec"].median().rename("baseline_sec")
+			self.results["baseline_sec"] = baseline.reindex(pd.MultiIndex.from_frame(self.results[["stage", "size"]])).values
+
+		self.results["ratio"] = (self.results["wall_sec"]/self.results["baseline_sec"]).round(2)
+		self.results["regression"] = (self.results["ratio"] > self.threshold) & \
+											(self.results["wall_sec"] - self.results["baseline_sec"] > self.min_slowdown)
+
+		new_file = not os.path.exists(self.results_file)
+		self.results.drop(columns=["baseline_sec", "ratio", "regression"]).to_csv(self.results_file, sep="\t", index=False,
+																					mode="w" if new_file else "a", header=new_file)
+
+	def run(self):
+
+		if not os.path.exists(self.bench_dir):
+			os.makedirs(self.bench_dir)
+
+		run_id, commit = time.strftime("%Y-%m-%d %H:%M:%S"), self._git_commit()
+
+		self.results = pd.concat([self._run_size(n) for n in self.sizes], ignore_index=True)
+		self.results.insert(0, "run", run_id)
+		self.results.insert(1, "commit", commit)
+		self.results = self.results[["run", "commit", "stage", "size", "wall_sec", "cpu_sec", "peak_rss_mb", "rows_in", "rows_out", "rows_per_sec"]]
+
+		self._compare()
+
+		print("---> benchmark results (regression: over {} times the median of the earlier runs)".format(self.threshold))
+		print(self.results[["stage", "size", "wall_sec", "cpu_sec", "peak_rss_mb", "rows_per_sec", "baseline_sec", "ratio", "regression"]].to_string(index=False))
+		print("saved results to {}...".format(self.results_file))
+
+		return self.results
+
+if __name__ == "__main__":
+
+	config_parameters = read_config()
+
+	results = Benchmark(config_parameters).run()
+
+	sys.exit(1 if results["regression"].any() else 0)
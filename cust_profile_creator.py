@@ -12,30 +12,57 @@ OUTPUT: a data frame containing features for the customers, that is, it has the
 
 """
 
+import json
+import os
+import numpy as np
 import pandas as pd
-import pickle
+from scipy import sparse
 from collections import defaultdict, Counter
-import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from dedup import DuplicateResolver
+from mosaic_classes import MosaicLookup
+from table_store import ChunkStore, cache_format
+from transaction_summary import TransactionSummary
 from datetime import datetime, timedelta
 from datetime import date
 
 class CustProfileCreator(object):
 
+	# the columns of the transaction table the features are made of; no need to load any other
+	REQUIRED_COLUMNS = ["CustomerID", "Gender", "ageGroup", "MosaicType", "CustomerState", "CustPop", "SalePop", 
+							"transID", "MTypePrimary", "MTypeSecondary", "Sales", "AdmitQty", "transactionDate"]
+
+	# what the time window features add up (besides counting the transactions) and the feature name prefixes
+	WINDOW_SUMS = {"Sales": "sales_", "AdmitQty": "admitqty_"}
+
+	# the customer level attributes; one value per customer
+	ATTRIBUTE_COLUMNS = ["MosaicType", "ageGroup", "Gender", "CustomerState"]
+
+	# feature families and the sets of features by type they go to; the population is what we want 
+	# to predict rather than a feature
+	FEATURE_FAMILIES = {"mosaic_letter": "mosaic_letter_features", "mosaic_income": "mosaic_income_features", 
+						"mosaic_education": "mosaic_education_features", "age": "age_features", "gender": "gender_features", 
+						"customer_state": "customer_state_features", "mtype_primary": "mtype_primary_features", 
+						"mtype_secondary": "mtype_secondary_features", "over_time": "over_time_features", 
+						"multi_population": "multi_population_features", "transactional": "transactional_features", "population": None}
+
 	def __init__(self, transaction_df, pars):
 
-		# IMPORTANT! drop duplicates on CustomerID and transaction ID because the same customer and transaction can be 
-		# in several customer populations; with keep=False the rows related to customers belonging to multiple populations 
-		# are removed COMPLETELY
+		# IMPORTANT! resolve the duplicates on CustomerID and transaction ID because the same customer and transaction can be 
+		# in several customer populations; with DEDUP_POLICY = drop_all the rows related to customers belonging to multiple 
+		# populations are removed COMPLETELY (see dedup for the other policies)
 
-		self.df = transaction_df.drop_duplicates(subset=["CustomerID", "transID"], keep=False, inplace=False)
+		self.dedup = DuplicateResolver(pars)
+		self.df = self.dedup.resolve(transaction_df)
 		
 
 		#self.noriginal_trans = len(transaction_df.index)
 		self.ucustomer_ids = list(self.df["CustomerID"].unique())  # list of unique customer IDs
 		self.pops = set(self.df["CustPop"]) | set(self.df["SalePop"]) 
 		
-		self.pops_enc = dict(zip(self.pops, range(1,len(self.pops) + 1)))
+		# the codes in the alphabetical order of the populations (not the set's, which changes from process to process)
+		self.pops_enc = dict(zip(sorted(self.pops, key=str), range(1,len(self.pops) + 1)))
 		self.pops_inverse_enc = {v: k for k, v in self.pops_enc.items()}
 		
 		#self.nuc = len(self.ucustomer_ids)
@@ -52,18 +79,70 @@ class CustProfileCreator(object):
 		self.mtype_primary_features = set()
 		self.mtype_secondary_features = set()
 		self.over_time_features = set()
+		self.multi_population_features = set()
+		self.transactional_features = set()
 		self.pop_features = set()
 
 		# junk values
 		self.mtype_secondary_junk = pars["MTYPE_SECONDARY_JUNK"].split()
 		self.mtype_primary_junk = pars["MTYPE_PRIMARY_JUNK"].split()
 
-		self.popular_sec_mtypes = sorted([(k,v) for k,v in Counter(self.df["MTypeSecondary"]).items() 
-													if (k.isalnum() and k not in self.mtype_secondary_junk)], key=lambda x: x[1], reverse=True)[:int(pars["NTOP_SEC_MTYPES_INTO_FEATURES"])]
+		self.ntop_sec_mtypes = int(pars["NTOP_SEC_MTYPES_INTO_FEATURES"])
+		self.popular_sec_mtypes = self._popular_sec_mtypes(self.df["MTypeSecondary"].value_counts(sort=False))
 		self.list_popular_sec_mtypes = [tp for tp, co in self.popular_sec_mtypes]
 		self.mosaic_flag = pars["HANDLE_CUSTOMERS_WITH_NO_MOSAIC_GROUP"]
+		self.mosaic = MosaicLookup(pars["MOSAIC_CLASSES_FILE"] or "mosaic_classes.info")  # Mosaic type -> letter, income, education
 		self.gender_flag = pars["HANDLE_CUSTOMERS_WITH_NO_GENDER"]
-		self.savetofile = pars["CUST_PROF_FILE"]
+		self.cache_fmt = cache_format(pars["CACHE_FORMAT"])
+		self.savetofile = pars["CUST_PROF_FILE"] + self.cache_fmt.extension
+
+		# dense: a data frame with a column per feature; sparse: a CSR matrix built straight from the features 
+		# in long format plus the customer IDs, feature names and populations that go with it
+		self.profile_format = pars["PROFILE_FORMAT"].strip().lower() or "dense"
+		self.savetofile_sparse = pars["CUST_PROF_FILE"] + ".npz"
+		self.savetofile_meta = pars["CUST_PROF_FILE"] + ".json"
+
+		# the dense profile can also go into a memory-mapped feature matrix (uint8 if all the features fit, else float32) 
+		# with the labels and customer IDs next to it, for training to read by row positions rather than copy
+		self.profile_matrix = (pars["PROFILE_MATRIX"].lower().strip() == "yes")
+		self.matrix_files = {part: pars["CUST_PROF_FILE"] + "_" + part + ".npy" for part in ["matrix", "labels", "customers"]}
+		self.matrix_file = None  # set once the matrix has been saved or found with a loaded profile
+		self.nan_features = []  # the dense profile's features whose missing values stay NaN rather than zero
+		self.customer_matrix = None
+		self.customer_ids = None
+		self.feature_names = None
+		self.customer_labels = None
+
+		# which feature engine to use: "vectorized" (default) or "loop" (the original per-customer loop, kept 
+		# as the reference implementation to check the vectorized one against)
+		self.feature_engine = pars["FEATURE_ENGINE"].strip().lower() or "vectorized"
+		self.n_jobs = int(pars["FEATURE_N_JOBS"] or 0) or os.cpu_count()  # the parallel loop engine
+		self.block_customers = int(pars["FEATURE_BLOCK_CUSTOMERS"] or 2000)
+		self.pars = pars
+		
+		# features in long format, one row per (CustomerID, feature, value, family); filled by the vectorized engine
+		self.cust_feature_long = None
+
+		# the temporal features count the transactions back from this date; fix it (REFERENCE_DATE) to get
+		# the same profile from the same transactions whenever it is created
+		self.reference_date = pd.Timestamp(pars["REFERENCE_DATE"]).date() if pars["REFERENCE_DATE"].strip() else date.today()
+
+		# the time windows to count the transactions and add up sales and admissions over, like 1m 3m 6m 12m 24m
+		# (d: days, w: weeks, m: months, y: years)
+		self.time_windows = pars["TIME_WINDOWS"].split() or ["1m", "3m", "6m", "12m", "24m"]
+
+		# the transactional features (vectorized engine only): per-customer counts of the values of TRANS_FEATURE_COLUMNS, 
+		# either of the TRANS_FEATURE_VOCAB_SIZE most frequent values of every column (vocab) or hashed into 
+		# TRANS_FEATURE_HASH_BUCKETS buckets (hash), plus mean DaysAhead and total sales and admissions (TRANS_FEATURE_NUMERIC)
+		self.trans_columns = pars["TRANS_FEATURE_COLUMNS"].split()
+		self.trans_mode = pars["TRANS_FEATURE_MODE"].strip().lower() or "hash"
+		self.trans_vocab_size = int(pars["TRANS_FEATURE_VOCAB_SIZE"] or 500)
+		self.trans_buckets = int(pars["TRANS_FEATURE_HASH_BUCKETS"] or 256)
+		self.trans_numeric = (pars["TRANS_FEATURE_NUMERIC"].lower().strip() == "yes")
+		self.trans_vocab = None  # vocab: the values to keep by column; when given, those of all the customers (see sharded_profile)
+
+		if self.trans_mode not in ["vocab", "hash"]:
+			raise ValueError("error! unknown transactional feature mode {}; choose from vocab or hash...".format(self.trans_mode))
 
 		# intermediate features:
 		self.cust_mtype_counts = defaultdict(lambda: defaultdict(int))
@@ -74,82 +153,46 @@ class CustProfileCreator(object):
 		# population by state, ABS; 2016
 		self.AU_state_pops_Ks = {"NSW": 7704.3, "VIC": 6039.1, "QLD": 4827.0, "SA": 1706.5, "WA": 2613.7, "TAS": 518.5, "NT": 244.0, "ACT": 395.2}
 
-	def data_summary(self):
+		self._summary = None  # see summary
 
-		print("---> some data info")
-		print("number or rows: {}".format(len(self.df.index)))
-		print("unique customers: {}".format(len(self.ucustomer_ids)))
-		print("unique transactions: {}".format(len( list(self.df["transID"].unique()))))
-		print("populations: {}".format(len(self.pops)))
+	#
+	# the summaries of the transactions, computed in one pass the first time they are asked for (see transaction_summary)
+	#
 
-		gc = Counter(self.df["Gender"])  # gender counts
+	def summary(self):
 
-		print("males: {}% females: {}% no gender: {}%".format( *map(lambda _: round(100* _/sum(gc.values()),1), 
-			[gc["M"], gc["F"], sum(gc.values()) - gc["M"] - gc["F"]])))
+		if self._summary is None:
+			self._summary = TransactionSummary(self.df, self.mosaic, self.AU_state_pops_Ks)
 
-		print("customers with known Mosaic type: {}%".format(round(sum(self.df["MosaicType"].notnull())/len(self.df.index)*100,2) )
-)
-		missings = self.df.count() - len(self.df.index)
-		print("missing values:\n", missings[missings < 0])
-		
+		return self._summary
 
-	def _decompose_mosaic(self, mostype):
-	
-		mosaic_mask = re.compile('(^[A-M]{1})(\d{2}$)')
-		
-		match_res = mosaic_mask.match(mostype)  # match objects always have a boolean value of True
-		assert match_res, "error! this is not a Mosaic group name.." 
-		
-		mos_letter = match_res.group(1)  # mosaic letter
-		mosn = int(match_res.group(2))  # mosaic number
-		assert (mosn < 50), "error! the Mosaic class number should be under 50..."	
+	def data_summary(self):
 
-		return (mos_letter, mosn)
+		self.summary().show(["info"])
 
 	def show_mosaic_representation(self):
 
-		# extract letters only
-		ccc = Counter(self.df["MosaicType"].loc[self.df["MosaicType"].notnull()].apply(lambda _: self._decompose_mosaic(_)[0], 1))
-		count_all_letters = sum(ccc.values())
-
-		letter_ranking = sorted([(k,round(v*100/count_all_letters,1)) for k,v in ccc.items()], key=lambda x: x[1], reverse=True)
-
-		print("---> customers by mosaic letters")
-		print("{}\t{}".format("  ","%"))
-		for t in letter_ranking:
-			print("{}:\t{}".format(*t))
+		self.summary().show(["mosaic"])
 
 	def show_cust_state_representation(self):
 
-		stt = Counter(self.df["CustomerState"].loc[self.df["CustomerState"].notnull()])
-		count_all_states = sum(stt.values())
+		self.summary().show(["state"])
 
-		state_ranking = sorted([(k,round(v*100/count_all_states,1)) for k,v in stt.items()], key=lambda x: x[1], reverse=True)
-		print("---> customers by state")
-		print("{}\t{}".format("  ","%"))
-		for t in state_ranking:
-			print("{}:\t{}".format(*t))
-		
-		state_ranking_pops = sorted([(k,round(v*100/(self.AU_state_pops_Ks[k]*1000),2)) for k,v in stt.items()], key=lambda x: x[1], reverse=True)
-		
-		print("---> customers by state as % of state population (2016)")
-		for t in state_ranking_pops:
-			print("{}:\t{}".format(*t))
+	def show_cust_age_representation(self):
 
+		self.summary().show(["age"])
 
-	def show_cust_age_representation(self):
+	#
+	# the transaction columns to download: the required ones and those the transactional features are made of
+	#
 
-		agc = Counter(self.df["ageGroup"].loc[self.df["ageGroup"].notnull() & ~self.df["ageGroup"].isin(["UNK"])])
-		count_all_ages = sum(agc.values())
+	@classmethod
+	def required_columns(cls, pars):
 
-		age_ranking = sorted([(k,round(v*100/count_all_ages,1)) for k,v in agc.items()], key=lambda x: x[1], reverse=True)
-		
-		print("---> customers by age")
-		print("{}\t{}".format("  ","%"))
-		for t in age_ranking:
-			print("{}:\t{}".format(*t))
+		extra = pars["TRANS_FEATURE_COLUMNS"].split() + (["DaysAhead"] if pars["TRANS_FEATURE_NUMERIC"].lower().strip() == "yes" else [])
+
+		return cls.REQUIRED_COLUMNS + [c for i, c in enumerate(extra) if (c not in cls.REQUIRED_COLUMNS) and (c not in extra[:i])]
 
-	
 	def _approve_feature(self, col):
 
 		list_whats_in_column = list(Counter(col).keys())
@@ -157,7 +200,7 @@ class CustProfileCreator(object):
 		if len(list_whats_in_column) > 1:
 				print("warning! this customer belongs to multiple classes meant to be mutually eclusive!")
 
-		if len(list_whats_in_column) > 0 and (list_whats_in_column[0] is not None) and (list_whats_in_column[0] != "UNK"):
+		if len(list_whats_in_column) > 0 and pd.notnull(list_whats_in_column[0]) and (list_whats_in_column[0] != "UNK"):
 
 			return (True, list_whats_in_column[0])
 
@@ -165,174 +208,617 @@ class CustProfileCreator(object):
 
 			return (False, list_whats_in_column[0])
 
-	def create_customer_features(self):
+	def create_customer_features(self, engine=None):
+
+		engine = engine or self.feature_engine
+
+		if (self.trans_columns or self.trans_numeric) and (engine != "vectorized"):
+			raise ValueError("error! the transactional features need the vectorized feature engine...")
+
+		if engine == "vectorized":
+			self._create_customer_features_vectorized()
+		elif engine == "loop":
+			self._create_customer_features_loop()
+		elif engine == "parallel":
+			self._create_customer_features_parallel()
+		else:
+			raise ValueError("error! unknown feature engine {}...".format(engine))
+
+	#
+	# the original implementation: go through the customers one by one; every customer costs a full scan 
+	# of the transaction data frame so this is slow but it's the reference to compare the vectorized engine to
+	#
+
+	def _create_customer_features_loop(self):
 	
+		self.cust_feature_long = None
+		multi_pops = self.dedup.multi_pops.groupby("CustomerID")["key"].apply(list).to_dict()
+
 		for customer in self.ucustomer_ids:
 			
 			# create a data frame containing stansactions only for this customer
 			df_only_this_customer = self.df.loc[self.df["CustomerID"] == customer]
+			self._loop_customer_features(customer, df_only_this_customer, multi_pops)
 
-			self.cust_mtype_counts[customer] = {k: v for k,v in Counter(df_only_this_customer["MTypeSecondary"]).items() 
-															if k in self.list_popular_sec_mtypes}  # note: count only popular secondary mtypes
+	#
+	# the features of one customer from the customer's transactions (the loop engine and its parallel version)
+	#
 
-			self.cust_pmtype_counts[customer] = Counter(df_only_this_customer["MTypePrimary"])
-			
-			tmp_mostypes = list(Counter(df_only_this_customer["MosaicType"]).keys())  # just in case someone is in multiple Mosaic classes
+	def _loop_customer_features(self, customer, df_only_this_customer, multi_pops):
 
-			self.cust_pop_counts[customer] = Counter(df_only_this_customer["CustPop"]) + Counter(df_only_this_customer["SalePop"])
+		self.cust_mtype_counts[customer] = {k: v for k,v in Counter(df_only_this_customer["MTypeSecondary"]).items() 
+														if k in self.list_popular_sec_mtypes}  # note: count only popular secondary mtypes
 
-			if len(tmp_mostypes) > 1:
-				print("warning! customer with id {} is in multiple Mosaic classes: {}".format(customer, tmp_mostypes))
+		self.cust_pmtype_counts[customer] = Counter(df_only_this_customer["MTypePrimary"])
+		
+		tmp_mostypes = list(Counter(df_only_this_customer["MosaicType"]).keys())  # just in case someone is in multiple Mosaic classes
 
-			# given the Mosaic class moscl for a customer, create customer features based on the class description;
-			# a proper Mosaic class looks like [letter][digit1][digit2], for example, "A02"
-			# note: there are 49 Mosaic classes in total, hence "<50" when doing sanity check
-			
-			#
-			# collect Mosaic features
-			#
-			if len(tmp_mostypes) > 0 and (tmp_mostypes[0] is not None):
-
-				# mosaic_mask = re.compile('(^[A-M]{1})(\d{2}$)')
-				# match_res = mosaic_mask.match(tmp_mostypes[0])  # match objects always have a boolean value of True
-				# assert match_res, "error! this is not a Mosaic group name.." 
-				# mos_letter = match_res.group(1)  # mosaic letter
-				# # print("mosaic letter is ", mos_letter)
-				# mosn = int(match_res.group(2))  # mosaic number
-				# assert (mosn < 50), "error! the Mosaic class number should be under 50..."
-				
-				mos_letter, mosn = self._decompose_mosaic(tmp_mostypes[0])
-				# mosaic letter is a feature:
-				self.cust_feature_dict[customer]["mos_letter_" + mos_letter] = 1
-				self.mosaic_letter_features.add("mos_letter_" + mos_letter)
+		self.cust_pop_counts[customer] = Counter(df_only_this_customer["CustPop"]) + Counter(df_only_this_customer["SalePop"])
+
+		if len(tmp_mostypes) > 1:
+			print("warning! customer with id {} is in multiple Mosaic classes: {}".format(customer, tmp_mostypes))
+
+		# given the Mosaic class moscl for a customer, create customer features based on the class description;
+		# a proper Mosaic class looks like [letter][digit1][digit2], for example, "A02"
+		# note: there are 49 Mosaic classes in total, hence "<50" when doing sanity check
 		
-				# income level features:		
-				if (mos_letter in ["A","D"] or 					    # all A and D are rich 
-					(mos_letter == "B" and mosn in range(5,9)) or   # B05 to B08 are rich but B09 aren't ("simple needs")
-					(mos_letter == "C" and mosn in [10, 12, 13]) or # C11 and C14 are likely to have average income
-					(mos_letter == "E" and mosn in [17,18]) or  	# E18 and E19 are probably not that rich
-					(mos_letter == "F" and mosn in [21])):  		# F22 to F24 may have average income
-					self.cust_feature_dict[customer]["high_income"] = 1
-					self.mosaic_income_features.add("high_income")
-
-				elif ((mos_letter in ["B"] and mosn in [9]) or      # these are "the good life" older couples
-					(mos_letter in ["G","H"]) or
-					(mos_letter == "C" and mosn in [11]) or   		# educated singles and couples in early career "inner city aspirations" 
-					(mos_letter == "E" and mosn in [19,20])):
-					self.cust_feature_dict[customer]["average_income"] = 1
-					self.mosaic_income_features.add("average_income")
-
-				else:
-					self.cust_feature_dict[customer]["low_income"] = 1
-					self.mosaic_income_features.add("low_income")
-
-				# education features:
-				if ((mos_letter in ["A","B","C", "I"]) or 
-					(mos_letter == "H" and mosn in [30])):
-					self.cust_feature_dict[customer]["good_education"] = 1
-					self.mosaic_education_features.add("good_education")
-
-				elif ((mos_letter in ["D","F"]) or
-					(mos_letter == "H" and mosn in [31,32])):
-					self.cust_feature_dict[customer]["average_education"] = 1
-					self.mosaic_education_features.add("average_education")
-
-				else:
-					self.cust_feature_dict[customer]["poor_education"] = 1
-					self.mosaic_education_features.add("poor_education")
-
-			# 
-			# collect primary Mtype features
-			#
-			for pmt in self.cust_pmtype_counts[customer].keys():
-				if pmt not in self.mtype_primary_junk:
-					self.cust_feature_dict[customer][pmt] = 1
-					self.mtype_primary_features.add(pmt)
-
-			# 
-			# collect secondary MType features
-			#
-			for smt in self.cust_mtype_counts[customer].keys():
-				self.cust_feature_dict[customer][smt] = 1 
-				self.mtype_secondary_features.add(smt)
-
-			#
-			# collect age group feature
-			#
-
-			flag, val = self._approve_feature(df_only_this_customer["ageGroup"])
+		#
+		# collect Mosaic features
+		#
+		if len(tmp_mostypes) > 0 and pd.notnull(tmp_mostypes[0]):
+
+			mos_letter, income_feature, education_feature = self.mosaic.lookup(tmp_mostypes[0])
+			# mosaic letter is a feature:
+			self.cust_feature_dict[customer]["mos_letter_" + mos_letter] = 1
+			self.mosaic_letter_features.add("mos_letter_" + mos_letter)
+	
+			# income level and education features:
+			self.cust_feature_dict[customer][income_feature] = 1
+			self.mosaic_income_features.add(income_feature)
+			self.cust_feature_dict[customer][education_feature] = 1
+			self.mosaic_education_features.add(education_feature)
+
+		# 
+		# collect primary Mtype features
+		#
+		for pmt in self.cust_pmtype_counts[customer].keys():
+			if pd.notnull(pmt) and (pmt not in self.mtype_primary_junk):
+				self.cust_feature_dict[customer][pmt] = 1
+				self.mtype_primary_features.add(pmt)
+
+		# 
+		# collect secondary MType features
+		#
+		for smt in self.cust_mtype_counts[customer].keys():
+			self.cust_feature_dict[customer][smt] = 1 
+			self.mtype_secondary_features.add(smt)
+
+		#
+		# collect age group feature
+		#
+
+		flag, val = self._approve_feature(df_only_this_customer["ageGroup"])
+		if flag:
+			ag_feature = "age_group=" + val
+			self.cust_feature_dict[customer][ag_feature] = 1
+			self.age_features.add(ag_feature)
+
+		# 
+		# collect gender feature
+		#
+
+		if self.gender_flag != "0":
+			flag, val = self._approve_feature(df_only_this_customer["Gender"])
 			if flag:
-				ag_feature = "age_group=" + val
-				self.cust_feature_dict[customer][ag_feature] = 1
-				self.age_features.add(ag_feature)
+				gend_feature = "gender=" + val
+				self.cust_feature_dict[customer][gend_feature] = 1
+				self.gender_features.add(gend_feature)
+
+
+		# 
+		# collect customer state features
+		#
+
+		flag, val = self._approve_feature(df_only_this_customer["CustomerState"])
+		if flag:
+			cstate_feature = "cust_state=" + val
+			self.cust_feature_dict[customer][cstate_feature] = 1
+			self.customer_state_features.add(cstate_feature)
+
+		#
+		# temporal sales features: we look into the purchases during the time windows back from the reference date 
+		# if the customer has been buying for longer than that
+		#
+
+		tr_days = df_only_this_customer["transactionDate"].dt.normalize()  # e.g. 2012-05-17 00:00:00
+
+		for feature, col, ago in self.window_features():
+			if tr_days.min() < ago:
+				in_window = (tr_days >= ago)
+				self.cust_feature_dict[customer][feature] = in_window.sum() if col == "n" else \
+																df_only_this_customer.loc[in_window, col].astype(float).sum()
+				self.over_time_features.add(feature)
+
+		#
+		# collect multi-membership features: the populations the customer's duplicated transactions came with
+		#
+		for pop in multi_pops.get(customer, []):
+			self.cust_feature_dict[customer]["multi_pop=" + pop] = 1
+			self.multi_population_features.add("multi_pop=" + pop)
+
+		# 
+		# collect population features
+		#
+		# for j in range(len(self.cust_pop_counts[customer].keys()),1,-1):
+		# 	if j:
+		# 		pop_feature = "in_" + str(j) + "_pops"
+		# 		self.pop_features.add(pop_feature)
+		# 		self.cust_feature_dict[customer][pop_feature] = 1 
+		
+		if len(self.cust_pop_counts[customer].keys()) == 1:  # if only in one population
+			for k in self.cust_pop_counts[customer].keys():
+				self.cust_feature_dict[customer]["Population"] = self.pops_enc[k]
 
-			# 
-			# collect gender feature
-			#
+	#
+	# the loop engine in parallel: the transactions are sorted by CustomerID and the customers split into blocks of 
+	# FEATURE_BLOCK_CUSTOMERS consecutive customers, so every block (and every customer in it) is a slice rather than 
+	# a scan; the blocks go to FEATURE_N_JOBS worker processes and their features are put together in the order of 
+	# ucustomer_ids, so the result is the same as the loop's whatever the number of workers
+	#
 
-			if self.gender_flag != "0":
-				flag, val = self._approve_feature(df_only_this_customer["Gender"])
-				if flag:
-					gend_feature = "gender=" + val
-					self.cust_feature_dict[customer][gend_feature] = 1
-					self.gender_features.add(gend_feature)
+	def _create_customer_features_parallel(self):
 
+		self.cust_feature_long = None
+		multi_pops = self.dedup.multi_pops.groupby("CustomerID")["key"].apply(list).to_dict()
 
-			# 
-			# collect customer state features
-			#
+		df = self.df.sort_values("CustomerID", kind="stable")  # stable: the transactions of a customer stay in order
+		ids = df["CustomerID"].values
+		customers = pd.unique(ids)
+		blocks = [customers[i:i + self.block_customers] for i in range(0, len(customers), self.block_customers)]
+		bounds = [(np.searchsorted(ids, b[0], side="left"), np.searchsorted(ids, b[-1], side="right")) for b in blocks]
 
-			flag, val = self._approve_feature(df_only_this_customer["CustomerState"])
-			if flag:
-				cstate_feature = "cust_state=" + val
-				self.cust_feature_dict[customer][cstate_feature] = 1
-				self.customer_state_features.add(cstate_feature)
-
-			#
-			# temporal sales features: we look into the purchases during last 12 months from NOW if available
-			#
- 
-			now = date.today()   # datetime.date(2016, 12, 19)
-			# timedelta object represents a duration, the difference between two dates or times
-			one_year = timedelta(days=365)
-			half_year = timedelta(weeks=26)
-
-			one_year_ago = now - one_year
-			half_year_ago = now - half_year
-			# 2016-09-25 14:04:47.000
-			df_only_this_customer.loc[:,"transactionDate"] = df_only_this_customer.loc[:,"transactionDate"].dt.date    #  e.g. 2012-05-17
-			# index where the customer purchased 
-			if min(df_only_this_customer["transactionDate"]) < one_year_ago:
-				last_year_idx = (df_only_this_customer["transactionDate"] >= one_year_ago)
-				# print("last year transactions:",df_only_this_customer[last_year_idx])
-				self.cust_feature_dict[customer]["total_trans_12m"] = len(df_only_this_customer[last_year_idx])
-				self.over_time_features.add("total_trans_12m")
-			if min(df_only_this_customer["transactionDate"]) < half_year_ago:
-				half_year_idx = (df_only_this_customer["transactionDate"] >= half_year_ago)
-				# print("last year transactions:",df_only_this_customer[last_year_idx])
-				self.cust_feature_dict[customer]["total_trans_6m"] = len(df_only_this_customer[half_year_idx])
-				self.over_time_features.add("total_trans_6m")
-
-
-
-			# 
-			# collect population features
-			#
-			# for j in range(len(self.cust_pop_counts[customer].keys()),1,-1):
-			# 	if j:
-			# 		pop_feature = "in_" + str(j) + "_pops"
-			# 		self.pop_features.add(pop_feature)
-			# 		self.cust_feature_dict[customer][pop_feature] = 1 
-			
-			if len(self.cust_pop_counts[customer].keys()) == 1:  # if only in one population
-				for k in self.cust_pop_counts[customer].keys():
-					self.cust_feature_dict[customer]["Population"] = self.pops_enc[k]
+		# what every block has to agree on
+		shared = {"popular_sec_mtypes": self.popular_sec_mtypes, "list_popular_sec_mtypes": self.list_popular_sec_mtypes, 
+					"pops": self.pops, "pops_enc": self.pops_enc, "pops_inverse_enc": self.pops_inverse_enc, "reference_date": self.reference_date}
+
+		executor = ProcessPoolExecutor if self.n_jobs > 1 else ThreadPoolExecutor
+
+		print("creating features for {} customers in {} blocks, {} workers...".format(len(customers), len(blocks), self.n_jobs))
+
+		with executor(max_workers=self.n_jobs) as pool:
+			results = list(pool.map(_loop_features_block, [df.iloc[lo:hi] for lo, hi in bounds], blocks, [dict(self.pars)]*len(blocks), 
+											[shared]*len(blocks), [{c: multi_pops[c] for c in b if c in multi_pops} for b in blocks]))
+
+		features = dict()
+		for block_features, block_sets in results:
+			features.update(block_features)
+			for name, feature_set in block_sets.items():
+				getattr(self, name).update(feature_set)
+
+		for customer in self.ucustomer_ids:
+			if customer in features:
+				self.cust_feature_dict[customer] = features[customer]
+
+	#
+	# the vectorized engine: the same features as the loop above but computed with a handful of passes over 
+	# the whole transaction data frame (groupby and friends); the transactions are first collapsed into per-customer 
+	# aggregates (which is also what the incremental mode keeps between runs) and the features are made of these;
+	# the features are collected in long format, i.e. one row per (CustomerID, feature, value, family), which 
+	# create_profile then pivots
+	#
+
+	def _long_features(self, customer_ids, features, family, values=1):
+
+		return pd.DataFrame({"CustomerID": customer_ids, "feature": features, "value": values, "family": family})
+
+	#
+	# collapse transactions into per-customer aggregates:
+	#	attrs:  the customer level attributes; the loop takes the first value it sees for these, so we take 
+	#			the values from the first transaction of every customer
+	#	counts: how many times every customer has every primary MType, secondary MType and population (kind, key)
+	#	daily:  how many transactions every customer made on every day (n) and their total sales and admissions
+	#
+
+	def _aggregate_transactions(self, df):
+
+		attrs = df.drop_duplicates(subset=["CustomerID"], keep="first").set_index("CustomerID")[self.ATTRIBUTE_COLUMNS]
+
+		counts = []
+
+		for kind, cols in [("MTypePrimary", ["MTypePrimary"]), ("MTypeSecondary", ["MTypeSecondary"]), ("Pop", ["CustPop", "SalePop"])]:
+			keys = pd.concat([df[["CustomerID", col]].rename(columns={col: "key"}) for col in cols])
+			keys["key"] = keys["key"].astype(object)
+			counts.append(keys.groupby(["CustomerID", "key"], sort=False).size().rename("n").reset_index().assign(kind=kind))
+
+		# the populations the duplicated transactions came with (only with DEDUP_POLICY = multi_pop_feature)
+		multi_pops = self.dedup.multi_pops
+		if len(multi_pops.index):
+			counts.append(multi_pops.loc[multi_pops["CustomerID"].isin(attrs.index)].assign(kind="MultiPop"))
+
+		# the values of the transactional feature columns; with TRANS_FEATURE_MODE = hash they are hashed into buckets 
+		# right here (kind <column>#), so a customer never has more counts than there are buckets whatever the number of values
+		for col in self.trans_columns:
+			vals = df[col].loc[df[col].notnull()]
+			keys = self._hash_buckets(vals) if self.trans_mode == "hash" else vals.astype(object).values
+			trans_counts = pd.DataFrame({"CustomerID": df["CustomerID"].loc[vals.index].values, "key": keys})
+			trans_counts = trans_counts.groupby(["CustomerID", "key"], sort=False).size().rename("n").reset_index()
+			if self.trans_mode == "hash":
+				trans_counts["key"] = trans_counts["key"].astype(str)
+			counts.append(trans_counts.assign(kind=col + "#" if self.trans_mode == "hash" else col))
+
+		# DaysAhead adds up into a sum and a count per customer (kind DaysAhead), the mean is made of these
+		if self.trans_numeric:
+			days_ahead = df["DaysAhead"].astype(float).groupby(df["CustomerID"], sort=False).agg(["sum", "count"])
+			for key in ["sum", "count"]:
+				counts.append(pd.DataFrame({"CustomerID": days_ahead.index, "kind": "DaysAhead", "key": key, 
+																			"n": days_ahead[key].round().astype("int64").values}))
+
+		counts = pd.concat(counts, ignore_index=True)[["CustomerID", "kind", "key", "n"]]
+
+		daily = df.assign(n=1, **{col: df[col].astype(float) for col in self.WINDOW_SUMS}).groupby([df["CustomerID"], 
+					df["transactionDate"].dt.normalize().rename("day")], sort=False)[["n"] + list(self.WINDOW_SUMS)].sum().reset_index()
+
+		return (attrs, counts, daily)
+
+	#
+	# the most popular secondary MTypes from the counts of all secondary MTypes; ties go to the MType that comes first
+	# in alphabetical order, so the full, pushdown, sharded and incremental profiles pick the same ones whatever order
+	# the counts come in
+	#
+
+	def _popular_sec_mtypes(self, sec_counts):
+
+		return sorted([(k,v) for k,v in sec_counts.items() if (v > 0 and k.isalnum() and k not in self.mtype_secondary_junk)], 
+																		key=lambda x: (-x[1], x[0]))[:self.ntop_sec_mtypes]
+
+	#
+	# all features but the temporal ones from the per-customer aggregates
+	#
+
+	def _features_from_aggregates(self, attrs, counts):
+
+		parts = []
+
+		#
+		# collect Mosaic features; the lookup table is applied once per unique Mosaic type
+		#
+		mos_classes = self.mosaic.classify(attrs["MosaicType"].dropna())
+		mos_classes["letter"] = "mos_letter_" + mos_classes["letter"].astype(str)
+
+		for col, family in [("letter", "mosaic_letter"), ("income", "mosaic_income"), ("education", "mosaic_education")]:
+			parts.append(self._long_features(mos_classes.index, mos_classes[col].astype(str).values, family))
+
+		# 
+		# collect primary and secondary MType features
+		#
+		pmts = counts.loc[(counts["kind"] == "MTypePrimary") & ~counts["key"].isin(self.mtype_primary_junk)]
+		parts.append(self._long_features(pmts["CustomerID"].values, pmts["key"].values, "mtype_primary"))
+
+		smts = counts.loc[(counts["kind"] == "MTypeSecondary") & counts["key"].isin(self.list_popular_sec_mtypes)]  # note: only popular secondary mtypes
+		parts.append(self._long_features(smts["CustomerID"].values, smts["key"].values, "mtype_secondary"))
+
+		#
+		# collect age group, gender and customer state features
+		#
+		for col, prefix, family in [("ageGroup", "age_group=", "age"), ("Gender", "gender=", "gender"), ("CustomerState", "cust_state=", "customer_state")]:
+
+			if (col == "Gender") and (self.gender_flag == "0"):
+				continue
+
+			vals = attrs[col]
+			vals = vals[vals.notnull() & (vals != "UNK")].astype(str)
+			parts.append(self._long_features(vals.index, (prefix + vals).values, family))
+
+		#
+		# collect multi-membership features
+		#
+		multi = counts.loc[counts["kind"] == "MultiPop"]
+		parts.append(self._long_features(multi["CustomerID"].values, ("multi_pop=" + multi["key"].astype(str)).values, "multi_population"))
+
+		# 
+		# collect population features: the encoded population for the customers who are in one population only
+		#
+		pops = counts.loc[counts["kind"] == "Pop"]
+		npops = pops.groupby("CustomerID", sort=False)["key"].transform("size")
+		single_pop = pops.loc[npops == 1]
+		parts.append(self._long_features(single_pop["CustomerID"].values, "Population", "population", 
+																			single_pop["key"].map(self.pops_enc).astype(int).values))
+
+		# a later feature with the same name wins, like it would in the feature dictionary
+		return pd.concat(parts, ignore_index=True).drop_duplicates(subset=["CustomerID", "feature"], keep="last")
+
+	#
+	# the buckets the values of a transactional feature column are hashed into (the same in every run and process)
+	#
+
+	def _hash_buckets(self, values):
+
+		return pd.util.hash_array(np.asarray(values.astype(str), dtype=object)) % np.uint64(self.trans_buckets)
+
+	#
+	# the TRANS_FEATURE_VOCAB_SIZE most frequent values of every transactional feature column from the total counts 
+	# indexed by (kind, key); ties go to the value that comes first in alphabetical order
+	#
+
+	def _trans_vocab(self, totals):
+
+		totals = totals.rename("n").reset_index()
+		totals["key_str"] = totals["key"].astype(str)
+		totals = totals.loc[totals["n"] > 0].sort_values(["kind", "n", "key_str"], ascending=[True, False, True])
+
+		return {col: set(totals.loc[totals["kind"] == col, "key"].iloc[:self.trans_vocab_size]) for col in self.trans_columns}
+
+	#
+	# the transactional features from the per-customer counts (and daily sums for the totals): 
+	#	vocab:	<column>=<value> for the values in the vocabulary, <column>=other for the rest
+	#	hash:	<column>#<bucket>; values the database counted (pushdown) are hashed here
+	# the values are the numbers of transactions; these are recomputed for every customer like the temporal features 
+	# because the vocabulary changes with the counts of all the customers
+	#
+
+	def _transactional_features(self, counts, daily):
+
+		parts = [self._long_features(pd.Series([], dtype="int64"), pd.Series([], dtype=str), "transactional")]
+
+		if self.trans_mode == "vocab" and self.trans_columns:
+			if self.trans_vocab is None:
+				# kept with the profile so that customers scored later get the same features (see feature_state)
+				self.trans_vocab = self._trans_vocab(counts.loc[counts["kind"].isin(self.trans_columns)].groupby(["kind", "key"])["n"].sum())
+			vocab = self.trans_vocab
+
+		for col in self.trans_columns:
+
+			if self.trans_mode == "hash":
+				raw = counts.loc[counts["kind"] == col]  # as the database counted them
+				col_counts = pd.concat([counts.loc[counts["kind"] == col + "#"], raw.assign(key=self._hash_buckets(raw["key"]).astype(str))])
+				names = col + "#" + col_counts["key"].astype(str)
+			else:
+				col_counts = counts.loc[counts["kind"] == col]
+				names = pd.Series(col + "=" + col_counts["key"].astype(str), index=col_counts.index).where(col_counts["key"].isin(vocab[col]), col + "=other")
+
+			n = col_counts["n"].groupby([col_counts["CustomerID"], names.rename("feature")], sort=False).sum()
+			parts.append(self._long_features(n.index.get_level_values(0), n.index.get_level_values(1), "transactional", n.values))
+
+		if self.trans_numeric:
+
+			days_ahead = counts.loc[counts["kind"] == "DaysAhead"].pivot(index="CustomerID", columns="key", values="n")
+			days_ahead = days_ahead.reindex(columns=["sum", "count"], fill_value=0)
+			days_ahead = days_ahead.loc[days_ahead["count"] > 0]
+			parts.append(self._long_features(days_ahead.index, "mean_days_ahead", "transactional", (days_ahead["sum"]/days_ahead["count"]).values))
+
+			totals = daily.groupby("CustomerID", sort=False)[list(self.WINDOW_SUMS)].sum()
+			for col in self.WINDOW_SUMS:
+				parts.append(self._long_features(totals.index, "total_" + col.lower(), "transactional", totals[col].values))
+
+		return pd.concat(parts, ignore_index=True)
+
+	#
+	# temporal sales features: for the customers who have been buying for longer than a time window, the number of 
+	# purchases and total sales and admissions in that window back from the reference date; total_trans_12m and 
+	# total_trans_6m (365 days and 26 weeks) are the original ones
+	#
+
+	def _window_cutoff(self, window):
+
+		n, unit = int(window[:-1]), window[-1]
+		offset = {"d": pd.DateOffset(days=n), "w": pd.DateOffset(weeks=n), "m": pd.DateOffset(months=n), "y": pd.DateOffset(years=n)}
+
+		if unit not in offset:
+			raise ValueError("error! time window {} should look like 30d, 8w, 6m or 2y...".format(window))
+
+		return pd.Timestamp(self.reference_date) - offset[unit]
+
+	def window_features(self):
+
+		now = pd.Timestamp(self.reference_date)
+		features = [("total_trans_12m", "n", now - timedelta(days=365)), ("total_trans_6m", "n", now - timedelta(weeks=26))]
+
+		for window in self.time_windows:
+			ago = self._window_cutoff(window)
+			features.append(("trans_" + window, "n", ago))
+			features.extend((prefix + window, col, ago) for col, prefix in self.WINDOW_SUMS.items())
+
+		return features
+
+	def temporal_cutoffs(self):
+
+		return sorted(set(ago for feature, col, ago in self.window_features()))
+
+	#
+	# one pass over the daily aggregates: every day goes to the bucket between two consecutive cutoffs, the buckets 
+	# are added up by customer and a window is then the sum of the buckets from its cutoff on
+	#
+
+	def _temporal_features(self, daily):
+
+		parts = []
+		cutoffs = self.temporal_cutoffs()
+
+		bucket = np.searchsorted(np.array(cutoffs, dtype="datetime64[ns]"), daily["day"].values.astype("datetime64[ns]"), side="right")
+		sums = daily.groupby([daily["CustomerID"], pd.Series(bucket, index=daily.index, name="bucket")], 
+												sort=False)[["n"] + list(self.WINDOW_SUMS)].sum()
+		sums = sums.unstack("bucket", fill_value=0)
+		first_days = daily.groupby("CustomerID", sort=False)["day"].min().reindex(sums.index)
+
+		for feature, col, ago in self.window_features():
 			
+			k = cutoffs.index(ago) + 1  # the first bucket in the window
+			in_window = sums[col].reindex(columns=range(k, len(cutoffs) + 1), fill_value=0).sum(axis=1)
+			in_window = in_window[(first_days < ago).values]
+			parts.append(self._long_features(in_window.index, feature, "over_time", in_window.values))
+
+		return pd.concat(parts, ignore_index=True)
+
+	#
+	# put the features in long format into the sets of features by type
+	#
+
+	def _register_features(self, long_features):
+
+		for family, features in long_features.groupby("family", sort=False)["feature"]:
+			if self.FEATURE_FAMILIES.get(family):
+				getattr(self, self.FEATURE_FAMILIES[family]).update(features.unique())
+
+	def _create_customer_features_vectorized(self):
+
+		cid = self.df["CustomerID"]
+
+		nmos = self.df.groupby("CustomerID", sort=False)["MosaicType"].nunique(dropna=False)
+		for customer in nmos.index[nmos > 1]:
+			print("warning! customer with id {} is in multiple Mosaic classes: {}".format(customer, 
+																list(self.df.loc[cid == customer, "MosaicType"].unique())))
+
+		for col in ["ageGroup", "Gender", "CustomerState"]:
+			nvals = self.df.groupby("CustomerID", sort=False)[col].nunique(dropna=False)
+			if (nvals > 1).any():
+				print("warning! {} customers belong to multiple {} classes meant to be mutually eclusive!".format((nvals > 1).sum(), col))
+
+		attrs, counts, daily = self._aggregate_transactions(self.df)
+
+		self.cust_feature_long = pd.concat([self._features_from_aggregates(attrs, counts), self._temporal_features(daily), 
+																self._transactional_features(counts, daily)], ignore_index=True)
+		self._register_features(self.cust_feature_long)
+
+	#
+	# features from the per-customer aggregates computed elsewhere (by the database, see DataHandler.download_aggregates) 
+	# rather than from the transactions this object was created with; when the aggregates are only for some of the 
+	# customers (a shard), pops_enc, popular_sec_mtypes and trans_vocab have to be those of all the customers
+	#
+
+	def create_customer_features_from_aggregates(self, attrs, counts, daily, pops_enc=None, popular_sec_mtypes=None, trans_vocab=None):
+
+		self.ucustomer_ids = list(attrs.index)
+
+		if pops_enc is None:
+			pops = set(counts.loc[counts["kind"] == "Pop", "key"])
+			pops_enc = dict(zip(sorted(pops, key=str), range(1,len(pops) + 1)))
+
+		self.pops = set(pops_enc)
+		self.pops_enc = dict(pops_enc)
+		self.pops_inverse_enc = {v: k for k, v in self.pops_enc.items()}
+
+		if popular_sec_mtypes is None:
+			popular_sec_mtypes = self._popular_sec_mtypes(counts.loc[counts["kind"] == "MTypeSecondary"].groupby("key")["n"].sum())
+
+		self.popular_sec_mtypes = list(popular_sec_mtypes)
+		self.list_popular_sec_mtypes = [tp for tp, co in self.popular_sec_mtypes]
+		self.trans_vocab = trans_vocab
+
+		self.cust_feature_long = pd.concat([self._features_from_aggregates(attrs, counts), self._temporal_features(daily), 
+																self._transactional_features(counts, daily)], ignore_index=True)
+		self._register_features(self.cust_feature_long)
+
+	#
+	# incremental mode: merge the (new) transactions this object was created with into the profile state kept 
+	# between runs and recompute the features only for the customers whose aggregates have changed; the temporal 
+	# features are recomputed for everyone from the daily counts because they move with the reference date
+	#
+
+	def update_profile(self, state):
+
+		df = self.df
+
+		if state.hwm is not None:
+			# the transactions at the high-water mark were seen last time and come back with this pull
+			seen = pd.MultiIndex.from_frame(df[["CustomerID", "transID"]]).isin(pd.MultiIndex.from_frame(state.boundary))
+			print("skipping {} rows seen in the previous run...".format(seen.sum()))
+			df = df.loc[~seen]
+
+		if (state.attrs is None) and (len(df.index) == 0):
+			print("no transactions to create a profile from...")
+			return
+
+		attrs, counts, daily = self._aggregate_transactions(df)
+		changed = state.merge(attrs, counts, daily)
+
+		# keep the population encoding from the earlier runs; new populations get the next codes
+		for pop in sorted([p for p in self.pops if pd.notnull(p) and (p not in state.pops_enc)], key=str):
+			state.pops_enc[pop] = len(state.pops_enc) + 1
+
+		self.pops = set(state.pops_enc)
+		self.pops_enc = dict(state.pops_enc)
+		self.pops_inverse_enc = {v: k for k, v in self.pops_enc.items()}
+
+		self.popular_sec_mtypes = self._popular_sec_mtypes(state.sec_mtype_counts())
+		self.list_popular_sec_mtypes = [tp for tp, co in self.popular_sec_mtypes]
+
+		# if the popular secondary MTypes are not what they used to be, every customer needs new features
+		if (state.features is None) or (self.list_popular_sec_mtypes != state.popular_sec_mtypes):
+			changed = state.attrs.index
+			state.popular_sec_mtypes = self.list_popular_sec_mtypes
+
+		print("recomputing features for {} of {} customers...".format(len(changed), len(state.attrs.index)))
+		
+		new_features = self._features_from_aggregates(state.attrs.loc[changed], state.counts.loc[state.counts["CustomerID"].isin(changed)])
+		
+		if state.features is None:
+			state.features = new_features
+		else:
+			state.features = pd.concat([state.features.loc[~state.features["CustomerID"].isin(changed)], new_features], ignore_index=True)
+
+		# move the high-water mark
+		if len(df.index):
+			last = df["transactionDate"].max().floor("s")
+			at_last = df.loc[df["transactionDate"] >= last, ["CustomerID", "transID"]]
+			if (state.hwm is not None) and (last == state.hwm):
+				at_last = pd.concat([state.boundary, at_last], ignore_index=True).drop_duplicates()
+			if (state.hwm is None) or (last >= state.hwm):
+				state.hwm, state.boundary = last, at_last
+
+		state.save()
+
+		self.ucustomer_ids = list(state.attrs.index)
+		self.cust_feature_long = pd.concat([state.features, self._temporal_features(state.daily), 
+														self._transactional_features(state.counts, state.daily)], ignore_index=True)
+		self._register_features(self.cust_feature_long)
+
+		self.create_profile()
+
+	#
+	# the sparse profile: a customers x features CSR matrix built straight from the features in long format, so it 
+	# costs as much as there are non-zero features; a feature a customer doesn't have is a zero; the population 
+	# goes into customer_labels rather than the matrix (NaN for the customers in more than one population)
+	#
+
+	def _create_sparse_profile(self):
+
+		if self.cust_feature_long is None:
+			raise ValueError("error! the sparse profile needs the vectorized feature engine...")
+
+		is_label = (self.cust_feature_long["family"] == "population")
+		feats = self.cust_feature_long.loc[~is_label]
+		labels = self.cust_feature_long.loc[is_label]
+
+		self.customer_ids = pd.Index(self.ucustomer_ids).intersection(pd.Index(self.cust_feature_long["CustomerID"].unique()), sort=False)
+		rows = self.customer_ids.get_indexer(feats["CustomerID"])
+		cols, feature_names = pd.factorize(feats["feature"], sort=True)
+		self.feature_names = list(feature_names)
+
+		self.customer_matrix = sparse.csr_matrix((feats["value"].astype("float32").values, (rows, cols)), 
+														shape=(len(self.customer_ids), len(self.feature_names)), dtype="float32")
+
+		self.customer_labels = np.full(len(self.customer_ids), np.nan)
+		self.customer_labels[self.customer_ids.get_indexer(labels["CustomerID"])] = labels["value"].values
+
+		print("created a sparse customer profile for {} customers; total number of features is {}, non-zeros {}...".format(
+											self.customer_matrix.shape[0], self.customer_matrix.shape[1], self.customer_matrix.nnz))
+
+		self.save_profile()
+
 	def create_profile(self):
 
+		if self.profile_format == "sparse":
+			return self._create_sparse_profile()
+
 		# first create a data frame
 
-		self.customer_profile = pd.DataFrame.from_dict(self.cust_feature_dict, orient="index")
+		if self.cust_feature_long is not None:
+			# missing (customer, feature) pairs become NaNs just like they do with the feature dictionary
+			self.customer_profile = self.cust_feature_long.pivot(index="CustomerID", columns="feature", values="value")
+			self.customer_profile = self.customer_profile.reindex(pd.Index(self.ucustomer_ids).intersection(self.customer_profile.index, sort=False))
+			self.customer_profile.columns.name = None
+		else:
+			self.customer_profile = pd.DataFrame.from_dict(self.cust_feature_dict, orient="index")
 		self.customer_profile["CustomerID"] = self.customer_profile.index
 
 		
@@ -341,17 +827,187 @@ class CustProfileCreator(object):
 		# fill the below features with zeros where the values are missing
 
 		print("setting missing values to zero...")
-		idx_missing_zero = self.mtype_primary_features | self.mtype_secondary_features | self.customer_state_features | self.pop_features | self.age_features | self.mosaic_letter_features | self.mosaic_income_features | self.mosaic_education_features | self.over_time_features
+		idx_missing_zero = self.mtype_primary_features | self.mtype_secondary_features | self.customer_state_features | self.pop_features | self.age_features | self.mosaic_letter_features | self.mosaic_income_features | self.mosaic_education_features | self.over_time_features | self.multi_population_features | self.transactional_features
 
+		idx_missing_zero = list(idx_missing_zero)
 		self.customer_profile.loc[:,idx_missing_zero] = \
 		self.customer_profile.loc[:,idx_missing_zero].fillna(0)
+		self.nan_features = sorted(c for c in list(self.customer_profile) if c not in set(idx_missing_zero) | {"Population", "CustomerID"})
 		
 		print("created a customer profile for {} customers; total number of features is {}...".format(len(self.customer_profile.index), 
 																						len(list(self.customer_profile))))
 		
-		self.customer_profile.to_pickle(self.savetofile )
-		print("saved profile to file {}...".format(self.savetofile ))
+		self.save_profile()
+
+	#
+	# the profile on disk: the data frame (CUST_PROF_FILE with the cache format extension) or the sparse matrix (.npz)
+	# plus the population encoding (.json) for whatever reads the profile later, e.g. rank_features.py rank
+	#
+
+	def save_profile(self):
+
+		if self.customer_matrix is not None:
+			np.savez(self.savetofile_sparse, data=self.customer_matrix.data, indices=self.customer_matrix.indices, 
+						indptr=self.customer_matrix.indptr, shape=self.customer_matrix.shape, customer_ids=np.asarray(self.customer_ids), 
+						feature_names=np.array(self.feature_names, dtype=str), labels=self.customer_labels)
+			print("saved profile to file {}...".format(self.savetofile_sparse))
+		else:
+			ChunkStore(self.savetofile, self.cache_fmt).write(self.customer_profile)
+			print("saved profile to file {}...".format(self.savetofile ))
+
+		meta = {"format": "sparse" if self.customer_matrix is not None else "dense", 
+					"pops_enc": {str(k): int(v) for k, v in self.pops_enc.items() if pd.notnull(k)}}
+		meta.update(self.feature_state())
+
+		if self.profile_matrix and (self.customer_matrix is None):
+			self._save_feature_matrix()
+			meta["feature_names"] = self.feature_names
+
+		with open(self.savetofile_meta, "w") as f:
+			json.dump(meta, f, indent=1)
+
+	#
+	# the dense profile as a customers x features matrix in a .npy file; the features are checked a column at a time and
+	# written a block of columns at a time, so that there is never more than a block of the profile copied in memory; 
+	# uint8 when every feature is a whole number between 0 and 255
+	#
+
+	def _save_feature_matrix(self, block=256):
+
+		self.feature_names = [c for c in list(self.customer_profile) if c not in ["Population", "CustomerID"]]
+		shape = (len(self.customer_profile.index), len(self.feature_names))
+
+		fits_uint8 = True
+
+		for c in self.feature_names:
+			vals = self.customer_profile[c].astype(float)  # NaN fails every comparison
+			if not ((vals >= 0) & (vals <= 255) & (vals == vals.round())).all():
+				fits_uint8 = False
+				break
+
+		dtype = "uint8" if fits_uint8 else "float32"
+
+		matrix = np.lib.format.open_memmap(self.matrix_files["matrix"], mode="w+", dtype=dtype, shape=shape)
+		for j in range(0, shape[1], block):
+			matrix[:, j:j + block] = self.customer_profile[self.feature_names[j:j + block]].to_numpy(dtype=dtype)
+		matrix.flush()
+		del matrix
+
+		np.save(self.matrix_files["labels"], self.customer_profile["Population"].astype(float).values)
+		np.save(self.matrix_files["customers"], self.customer_profile["CustomerID"].values)
+		self.matrix_file = self.matrix_files["matrix"]
+
+		print("saved {} feature matrix ({} x {}) to file {}...".format(dtype, shape[0], shape[1], self.matrix_file))
+
+	#
+	# the memory-mapped feature matrix with the labels (NaN for the customers in more than one population)
+	#
+
+	def feature_matrix(self):
+
+		return (np.load(self.matrix_files["matrix"], mmap_mode="r"), np.load(self.matrix_files["labels"]))
+
+	def load_profile(self):
+
+		if not os.path.exists(self.savetofile_meta):
+			raise IOError("error! no saved profile in {}; create one first (rank_features.py profile)...".format(self.savetofile_meta))
+
+		with open(self.savetofile_meta, "r") as f:
+			meta = json.load(f)
+
+		self.pops_enc = meta["pops_enc"]
+		self.pops = set(self.pops_enc)
+		self.pops_inverse_enc = {v: k for k, v in self.pops_enc.items()}
+		self.set_feature_state(meta)
+
+		if meta["format"] == "sparse":
+			self.customer_matrix, self.customer_ids, self.feature_names, self.customer_labels = load_sparse_profile(self.savetofile_sparse)
+			self.customer_profile = pd.DataFrame()
+			self.ucustomer_ids = list(self.customer_ids)
+			loaded_from = self.savetofile_sparse
+		elif ("feature_names" in meta) and os.path.exists(self.matrix_files["matrix"]):
+			# no need for the data frame, the matrix is read by row positions when training
+			self.matrix_file = self.matrix_files["matrix"]
+			self.feature_names = meta["feature_names"]
+			self.ucustomer_ids = list(np.load(self.matrix_files["customers"]))
+			loaded_from = self.matrix_file
+		else:
+			self.customer_profile = ChunkStore(self.savetofile, self.cache_fmt).read()
+			self.customer_matrix = None
+			self.ucustomer_ids = list(self.customer_profile["CustomerID"])
+			loaded_from = self.savetofile
+
+		print("loaded profile of {} customers from file {}...".format(len(self.ucustomer_ids), loaded_from))
+
+	#
+	# what the features depend on besides the transactions of the customers themselves: the popular secondary MTypes, 
+	# the vocabulary of the transactional features and which missing values are NaN; customers scored with a model 
+	# trained on this profile get their features made the same way (see customer_scorer)
+	#
+
+	def feature_state(self):
+
+		vocab = None
+		if self.trans_vocab is not None:
+			vocab = {col: sorted([v.item() if hasattr(v, "item") else v for v in vals], key=str) for col, vals in self.trans_vocab.items()}
+
+		return {"popular_sec_mtypes": [[tp, int(co)] for tp, co in self.popular_sec_mtypes], "trans_vocab": vocab, 
+																					"nan_features": list(self.nan_features)}
+
+	def set_feature_state(self, state):
+
+		if "popular_sec_mtypes" in state:  # profiles saved before these were kept don't have them
+			self.popular_sec_mtypes = [(tp, co) for tp, co in state["popular_sec_mtypes"]]
+			self.list_popular_sec_mtypes = [tp for tp, co in self.popular_sec_mtypes]
+		if state.get("trans_vocab") is not None:
+			self.trans_vocab = {col: set(vals) for col, vals in state["trans_vocab"].items()}
+		self.nan_features = list(state.get("nan_features", []))
+
+	#
+	# what a created profile comes down to (see artifact_cache): the profile, the customers and populations in it and the
+	# features by family; restore_profile puts it back into a CustProfileCreator made of no transactions
+	#
+
+	def profile_artifacts(self):
+
+		names = ["ucustomer_ids", "pops", "pops_enc", "pops_inverse_enc", "customer_profile", "customer_matrix", "customer_ids",
+					"feature_names", "customer_labels", "pop_features", "popular_sec_mtypes", "list_popular_sec_mtypes", "trans_vocab", 
+					"nan_features"] + [f for f in self.FEATURE_FAMILIES.values() if f]
+
+		return {name: getattr(self, name) for name in names}
+
+	def restore_profile(self, artifacts):
+
+		for name, value in artifacts.items():
+			setattr(self, name, value)
+
+#
+# the loop engine on a block of customers in a worker process: the block has the transactions of the customers sorted by 
+# CustomerID; returns the features by customer and the sets of features by family
+#
+
+def _loop_features_block(block, customers, pars, shared, multi_pops):
+
+	fe = CustProfileCreator(block.iloc[:0], defaultdict(str, pars))
+	for name, value in shared.items():
+		setattr(fe, name, value)
+
+	ids = block["CustomerID"].values
+	starts, ends = np.searchsorted(ids, customers, side="left"), np.searchsorted(ids, customers, side="right")
+
+	for customer, lo, hi in zip(customers, starts, ends):
+		fe._loop_customer_features(customer, block.iloc[lo:hi], multi_pops)
+
+	families = ["pop_features"] + [f for f in CustProfileCreator.FEATURE_FAMILIES.values() if f]
 
+	return ({c: dict(fe.cust_feature_dict[c]) for c in customers if c in fe.cust_feature_dict}, {f: getattr(fe, f) for f in families})
 
+#
+# load a sparse profile saved by create_profile: (matrix, customer IDs, feature names, encoded populations)
+#
 
+def load_sparse_profile(path):
 
+	with np.load(path) as f:
+		matrix = sparse.csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"]))
+		return (matrix, pd.Index(f["customer_ids"]), list(f["feature_names"]), f["labels"])
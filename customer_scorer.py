@@ -0,0 +1,202 @@
+"""
+Score new customers with the model a ranking run trained: rank_features.py rank saves the best estimator to MODEL_FILE
+together with the feature columns it was trained on and what the features depend on besides the customers' own
+transactions (the popular secondary MTypes, the transactional feature vocabulary, which missing values are NaN and the
+configuration the profile was made with, see CustProfileCreator.feature_state); then
+
+	rank_features.py score
+
+streams the transactions of the customers to score (SCORE_CUST_DATA_TABLE and SCORE_TRANS_INFO_TABLE, the training
+tables if not given) in chunks into SCORE_SHARDS on-disk shards by customer (see DataHandler.download_to_shards), and
+in SCORE_N_JOBS worker processes (0 means one per CPU) makes the features of every shard the way CustProfileCreator does,
+lines them up with the model's columns in a sparse matrix (features the model hasn't seen are dropped, so there is never
+a dense frame with every feature of every customer) and predicts the population probabilities SCORE_BATCH_SIZE customers
+at a time; the scores go to SCORES_FILE shard by shard as they come in, with the customers per second of every shard
+
+"""
+
+import os
+import pickle
+import time
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from scipy import sparse
+
+from artifact_cache import PROFILE_KEYS
+from cust_profile_creator import CustProfileCreator
+from estimator_backends import get_backend
+from data_handler import DataHandler
+from table_store import ChunkStore, cache_format
+
+#
+# save what scoring needs: the estimator, the feature columns in the order it was trained on, the populations and
+# the feature state and configuration of the profile it was trained on
+#
+
+def save_model(path, estimator, fe, feature_names, pars):
+
+	model = {"estimator": estimator, "feature_names": list(feature_names), "pops_inverse_enc": dict(fe.pops_inverse_enc),
+				"sparse": (fe.customer_matrix is not None) and not get_backend(pars["ESTIMATOR_BACKEND"]).dense_input, "profile_pars": {k: pars[k] for k in PROFILE_KEYS}}
+	model.update(fe.feature_state())
+
+	tmp_path = "{}.{}.tmp".format(path, os.getpid())
+	with open(tmp_path, "wb") as f:
+		pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+	os.replace(tmp_path, path)
+
+	print("saved the model and its {} feature columns to {}...".format(len(model["feature_names"]), path))
+
+# the model the worker processes score with, set once per worker by _init_worker rather than sent with every shard
+_model = None
+
+def _init_worker(model):
+
+	global _model
+	_model = model
+
+#
+# the features of the customers in a shard as a sparse matrix with the model's columns, plus the customer IDs
+#
+
+def _shard_matrix(shard_path, pars, model):
+
+	fmt = cache_format(pars["CACHE_FORMAT"])
+	fe = CustProfileCreator(ChunkStore(shard_path, fmt).read(), pars)  # drops the duplicates
+	attrs, counts, daily = fe._aggregate_transactions(fe.df)
+
+	# the populations are what we predict, so whatever the customers come with is left out (it may not even be known)
+	counts = counts.loc[counts["kind"] != "Pop"]
+	fe.set_feature_state(model)
+	fe.create_customer_features_from_aggregates(attrs, counts, daily, {}, fe.popular_sec_mtypes, fe.trans_vocab)
+
+	customers = pd.Index(fe.ucustomer_ids)
+	feats = fe.cust_feature_long
+	cols = pd.Index(model["feature_names"]).get_indexer(feats["feature"])
+	known = (cols >= 0) & (feats["family"] != "population").values
+	rows = customers.get_indexer(feats["CustomerID"].values[known])
+
+	X = sparse.csr_matrix((feats["value"].values[known].astype("float32"), (rows, cols[known])),
+																shape=(len(customers), len(model["feature_names"])), dtype="float32")
+
+	# where the customers have the features whose missing values are NaN (dense profiles only)
+	nan_cols = pd.Index(model["feature_names"]).get_indexer(pd.Index(model["nan_features"]))
+	nan_cols = nan_cols[nan_cols >= 0]
+	present = sparse.csr_matrix((np.ones(known.sum(), dtype=bool), (rows, cols[known])), shape=X.shape)[:, nan_cols]
+
+	return (customers, X, nan_cols, present, len(fe.df.index))
+
+def _score_shard(shard_path, pars, batch_size):
+
+	start_time = time.time()
+	pars = defaultdict(str, pars)
+	customers, X, nan_cols, present, nrows = _shard_matrix(shard_path, pars, _model)
+	estimator = _model["estimator"]
+	pops = [_model["pops_inverse_enc"][c] for c in estimator.classes_]
+
+	scores = []
+
+	for i in range(0, X.shape[0], batch_size):
+
+		if _model["sparse"]:
+			X_batch = X[i:i + batch_size]
+		else:
+			X_batch = X[i:i + batch_size].toarray()
+			X_batch[:, nan_cols] = np.where(present[i:i + batch_size].toarray(), X_batch[:, nan_cols], np.nan)
+
+		probs = estimator.predict_proba(X_batch)
+		batch = pd.DataFrame(probs, columns=["prob_" + str(p) for p in pops])
+		batch.insert(0, "Population", np.array(pops, dtype=object)[probs.argmax(axis=1)] if len(pops) else None)
+		batch.insert(0, "CustomerID", customers[i:i + batch_size].values)
+		scores.append(batch)
+
+	scores = pd.concat(scores, ignore_index=True) if scores else pd.DataFrame(columns=["CustomerID", "Population"])
+
+	return (scores, nrows, time.time() - start_time)
+
+class CustomerScorer(object):
+
+	def __init__(self, pars):
+
+		self.model_file = pars["MODEL_FILE"] or "./data/model.pkl"
+		self.n_shards = int(pars["SCORE_SHARDS"] or 16)
+		self.shard_dir = pars["SCORE_SHARD_DIR"] or "./data/score_shards"
+		self.n_jobs = int(pars["SCORE_N_JOBS"] or 0) or os.cpu_count()
+		self.batch_size = int(pars["SCORE_BATCH_SIZE"] or 10000)
+		self.cache_fmt = cache_format(pars["CACHE_FORMAT"])
+		self.scores_file = (pars["SCORES_FILE"] or "./data/scores") + self.cache_fmt.extension
+		self.pars = pars
+
+		self.model = None
+		self.throughput = pd.DataFrame()  # customers, transactions and seconds by shard
+
+	def load_model(self):
+
+		if not os.path.exists(self.model_file):
+			raise IOError("error! no model in {}; train one first (rank_features.py rank)...".format(self.model_file))
+
+		with open(self.model_file, "rb") as f:
+			self.model = pickle.load(f)
+
+		print("loaded the model with {} feature columns from {}...".format(len(self.model["feature_names"]), self.model_file))
+
+		return self
+
+	#
+	# the configuration to make the features with: the profile settings the model was trained with (the reference date
+	# stays ours, the customers are scored as of now) and the scoring tables in place of the training ones
+	#
+
+	def _scoring_pars(self):
+
+		pars = defaultdict(str, self.pars)
+
+		for k, v in self.model["profile_pars"].items():
+			if (k != "REFERENCE_DATE") and (pars[k] != v):
+				print("note: {} is {} for the model, not {}...".format(k, v, pars[k]))
+				pars[k] = v
+
+		for k in ["CUST_DATA_TABLE", "TRANS_INFO_TABLE"]:
+			pars[k] = self.pars["SCORE_" + k] or self.pars[k]
+
+		return pars
+
+	def score(self, dg=None):
+
+		if self.model is None:
+			self.load_model()
+
+		start_time = time.time()
+		pars = self._scoring_pars()
+		dg = dg or DataHandler(pars)
+
+		shards = dg.download_to_shards(self.shard_dir, self.n_shards, CustProfileCreator.required_columns(pars))
+
+		store = ChunkStore(self.scores_file, self.cache_fmt)
+		store.remove()
+
+		executor = ProcessPoolExecutor if self.n_jobs > 1 else ThreadPoolExecutor
+		throughput = []
+
+		print("scoring {} shards, {} workers...".format(len(shards), self.n_jobs))
+
+		with executor(max_workers=self.n_jobs, initializer=_init_worker, initargs=(self.model,)) as pool:
+
+			for shard, (scores, nrows, secs) in zip(shards, pool.map(_score_shard, shards, [dict(pars)]*len(shards),
+																							[self.batch_size]*len(shards))):
+				if len(scores.index):
+					store.append(scores)
+				throughput.append({"shard": os.path.basename(shard), "customers": len(scores.index), "transactions": nrows, "sec": secs})
+				print("scored {} customers ({} transactions) of {} ({} customers/sec)...".format(len(scores.index), nrows,
+																	os.path.basename(shard), round(len(scores.index)/max(secs, 1e-6))))
+
+		store.close()
+
+		self.throughput = pd.DataFrame(throughput, columns=["shard", "customers", "transactions", "sec"])
+		ncustomers, secs = int(self.throughput["customers"].sum()), time.time() - start_time
+
+		print("scored {} customers in {} sec ({} customers/sec); the scores are in {}...".format(ncustomers, round(secs, 1),
+																			round(ncustomers/max(secs, 1e-6)), self.scores_file))
+
+		return ncustomers
@@ -1,13 +1,29 @@
 """
 Data Grabber
 """
-import pyodbc
 import sys
+import numpy as np
 import pandas as pd
-import pickle
 import time
 import os.path
+import sqlite3
 from collections import defaultdict
+from dedup import DuplicateResolver
+from table_store import ChunkStore, cache_format, cache_key
+from transaction_summary import TransactionSummary
+
+# compact dtypes for the columns in join_tabs_query, applied as the data comes in:
+# categoricals for the (low cardinality) strings, the smallest integers that fit and proper dates;
+# the capitalised integer types are the nullable ones for the columns that may have NULLs; Sales stays float64
+# since float32 can't hold amounts like 361.24 exactly and the sales features add them up
+
+TRANSACTION_SCHEMA = {"CustomerID": "int64", "Gender": "category", "ageGroup": "category", "MosaicType": "category",
+						"CustomerState": "category", "CustPop": "category", "SalePop": "category", "transID": "int64",
+						"DaysAhead": "Int16", "ValueAdmitQty": "Int16", "AdmitQty": "Int16", "Sales": "float64",
+						"VenueState": "category", "pk_event_dim": "Int32", "CancelledFlag": "Int8", "BChannel": "category",
+						"MTypePrimary": "category", "MTypeSecondary": "category", "CardType": "category",
+						"EventNameStandard": "category", "PrimaryShow": "category", "PrimaryShowDesc": "category",
+						"pk_attribute_dim": "Int32", "transactionDate": "datetime64[ns]"}
 
 class DataHandler(object):
 
@@ -17,7 +33,16 @@ class DataHandler(object):
 		self._tran_tbl = pars["TRANS_INFO_TABLE"]
 		self._nrow_get = pars["GET_NROWS"]
 		self._nrow = 0  # how many rows o get
-		self._tran_pkl = pars["TABLE_FILE"]  # to pickle downloaded table
+		self._cache_dir = pars["CACHE_DIR"] or "./data"  # where to cache downloaded tables
+		self._cache_fmt = cache_format(pars["CACHE_FORMAT"])  # parquet, feather or pickle
+		self._cache_mmap = (pars["MEMORY_MAP_CACHE"].lower().strip() == "yes")  # memory-map cached tables when reading
+		self._chunksize = int(pars["DOWNLOAD_CHUNKSIZE"] or 0)  # rows per chunk; 0 means download in one go
+		self._dsn = pars["DSN"]
+		self._result_sink = pars["RESULT_SINK"].strip() or "db"  # where write_results writes to
+		self._upload_batch = int(pars["UPLOAD_BATCH_SIZE"] or 10000)  # rows per executemany and commit
+		self._pool = dict()  # open connections by DSN, reused for writing results
+		self.dedup = DuplicateResolver(pars)  # scans the (CustomerID, transID) pairs as they are downloaded in chunks
+		self._summary, self._summary_of = None, None  # the summary of the downloaded table and the table it is of
 		self._auth = "DSN=" + pars["DSN"] +";" + "PWD=" + pars["PWD"]
 		self.join_tabs_query = ("SELECT c.[CustomerID],"
 								"[Gender],[ageGroup],[MosaicType],"
@@ -39,33 +64,170 @@ class DataHandler(object):
 		self._dwl_time = 0
 		self._vexpl = defaultdict(str)
 
-		with open("var_explanation.txt", "r") as f:
-			for line in f:
-				var, expl = [v.strip() for v in [line[:line.index(":")], line[line.index(":")+1:]]]
-				self._vexpl[var] = expl
+		if os.path.exists("var_explanation.txt"):  # only show_table needs these
+			with open("var_explanation.txt", "r") as f:
+				for line in f:
+					var, expl = [v.strip() for v in [line[:line.index(":")], line[line.index(":")+1:]]]
+					self._vexpl[var] = expl
+
+		# the downloaded table is cached under a key derived from the query, the dtypes it is stored in and the relevant 
+		# parameters
+		self._tran_cache = ChunkStore(os.path.join(self._cache_dir, "transactions_" + 
+													cache_key(self._create_query() + str(sorted(TRANSACTION_SCHEMA.items())), pars) + 
+																				self._cache_fmt.extension), self._cache_fmt)
+
+	#
+	# connect to the database; a DSN like sqlite:./data/tega.db connects to a local SQLite stand-in instead
+	#
+
+	def _is_sqlite(self, dsn=None):
+
+		return (dsn or self._dsn).startswith("sqlite:")
+
+	def _connect(self, dsn=None):
+
+		if self._is_sqlite(dsn):
+			return sqlite3.connect((dsn or self._dsn)[len("sqlite:"):])
+
+		import pyodbc
+		
+		return pyodbc.connect(self._auth)
+
+	#
+	# connections for writing results are opened once and then reused
+	#
+
+	def _pooled_connection(self, dsn):
+
+		if dsn not in self._pool:
+			self._pool[dsn] = self._connect(dsn)
+
+		return self._pool[dsn]
+
+	def close_connections(self):
+
+		for conn in self._pool.values():
+			conn.close()
+
+		self._pool = dict()
+
+	#
+	# cast a downloaded chunk (or the whole table) to the compact dtypes in TRANSACTION_SCHEMA
+	#
+
+	def _apply_schema(self, df):
+
+		for col, dtype in TRANSACTION_SCHEMA.items():
+
+			if (col not in df) or (df[col].dtype == dtype):
+				continue
+
+			if dtype.lower().startswith("int"):
+				vals = pd.to_numeric(df[col])
+				lims = np.iinfo(dtype.lower())
+				if (vals.min() < lims.min) or (vals.max() > lims.max):
+					raise ValueError("error! values in column {} don't fit into {}...".format(col, dtype))
+				df[col] = vals.astype(dtype)
+			elif dtype.startswith("float"):
+				df[col] = pd.to_numeric(df[col]).astype(dtype)
+			elif dtype.startswith("datetime64"):
+				df[col] = pd.to_datetime(df[col]).astype(dtype)
+			else:
+				df[col] = df[col].astype(dtype)
+
+		return df
+
+	def _mem_mb(self, df):
+
+		return round(df.memory_usage(deep=True).sum()/1024**2, 1)
+
+	#
+	# stream the result of the supplied SQL string into the on-disk store chunk by chunk so that at any time 
+	# we hold at most one chunk in memory; then load the store; the (CustomerID, transID) pairs are only scanned 
+	# and the duplicates counted here (the other copy of a pair may well come in a later chunk), the store keeps 
+	# every row and the duplicates are resolved in the profile step (see CustProfileCreator and dedup)
+	#
+
+	def _sql_to_store(self, sql_string):
+
+		start_time = time.time()
+		print("setting up database connection...", end="")
+				
+		conn = self._connect()
+		print("ok")
+
+		cursor = conn.cursor()
+		cursor.execute(sql_string)
+		cols = [d[0] for d in cursor.description]
+
+		store = self._tran_cache
+		os.makedirs(self._cache_dir, exist_ok=True)  # a fresh checkout has no cache directory yet
+
+		print("streaming SQL table into {} in chunks of {} rows...".format(store.path, self._chunksize))
+
+		mem_before, mem_after = 0, 0
+		cust_col, trans_col = cols.index("CustomerID"), cols.index("transID")
+		self.dedup.reset()
+
+		while True:
+			rows = cursor.fetchmany(self._chunksize)
+			if not rows:
+				break
+			self.dedup.scan(np.fromiter((r[cust_col] for r in rows), dtype="int64", count=len(rows)), 
+								np.fromiter((r[trans_col] for r in rows), dtype="int64", count=len(rows)))
+			chunk = pd.DataFrame.from_records([tuple(r) for r in rows], columns=cols)
+			mem_before += self._mem_mb(chunk)
+			chunk = self._apply_schema(chunk)
+			mem_after += self._mem_mb(chunk)
+			store.append(chunk)
+			print("downloaded rows...{} ({} rows/sec)".format(store.nrows, round(store.nrows/max(time.time() - start_time, 1e-6))))
+
+		store.close()
+		cursor.close()
+		conn.close()
+
+		print("memory as downloaded...{} MB, in compact dtypes...{} MB (chunk by chunk)".format(round(mem_before, 1), round(mem_after, 1)))
+		print("rows with duplicated (CustomerID, transID)...{}".format(self.dedup.n_duplicated))
+
+		print("loading stored table...", end="")
+		df = self._apply_schema(store.read())
+		print("ok")
+		print("memory of loaded table...{} MB".format(self._mem_mb(df)))
+		end_time = time.time()
+		
+		tm = round((end_time-start_time)/60,1)  # elapsed time in minutes
+
+		return (df, tm)
 
 	#
 	# get a table using the supplied SQL string then put it in a data frame and save this data frame 
-	# locally as a pickle; 
+	# locally in the cache; 
 	# use this function when the data we are after is not available locally or it is but you still prefer
-	# to download it again and rewrite the pickle file
+	# to download it again and rewrite the cached file
 	#
 
 	def _sql_to_df(self, sql_string):
 
+		if self._chunksize > 0:
+			return self._sql_to_store(sql_string)
+
 		start_time = time.time()
 		print("setting up database connection...", end="")
 				
-		conn = pyodbc.connect(self._auth)
+		conn = self._connect()
 		print("ok")
 		
 		print("reading SQL table into data frame...", end="")
 		df = pd.read_sql(sql_string, conn)
 		print("ok")
+		mem_before = self._mem_mb(df)
+		df = self._apply_schema(df)
+		print("memory as downloaded...{} MB, in compact dtypes...{} MB".format(mem_before, self._mem_mb(df)))
 		print("downloaded rows...", end="")
 		print(len(df.index))
-		print("pickling...", end="")
-		df.to_pickle(self._tran_pkl)
+		print("caching to {}...".format(self._tran_cache.path), end="")
+		os.makedirs(self._cache_dir, exist_ok=True)  # a fresh checkout has no cache directory yet
+		self._tran_cache.write(df)
 		print("ok")
 		end_time = time.time()
 		
@@ -78,36 +240,119 @@ class DataHandler(object):
 	# finalise the query to be sent to join the customer and transaction info tables
 	#	
 
-	def _create_query(self):
+	def _create_query(self, since=None):
 
 		_mosa_add_qry = ""
 
 		if self._mosa_flg == "0":  # if ignore people with no known Mosaic group
 			_mosa_add_qry = " where k.[MosaicType] IS NOT NULL"
 
-		# if no need to get all rows
-		if self._nrow_get != "*":
+		# if no need to get all rows; incremental pulls (since a date) always get all new rows
+		get_all = (self._nrow_get == "*") or (since is not None)
+
+		if not get_all and not self._is_sqlite():
 
 			extra_bit = " top " + str(self._nrow_get) + " * "
 		else:
 			extra_bit = " * "
 			
 		sql_line = ("select " + extra_bit + " from (" + self.join_tabs_query + 
-														") as k" + self._mosa_add_qry + ";")
+														") as k" + self._mosa_add_qry)
+
+		if since is not None:
+			sql_line += (" and " if self._mosa_add_qry else " where ") + "k.[transactionDate] >= '" + since.strftime("%Y-%m-%d %H:%M:%S") + "'"
+
+		# the first rows are the same rows every time the query runs (the aggregate queries run it several times over)
+		if not get_all:
+			sql_line += " order by k.[CustomerID], k.[transID], k.[CustPop], k.[SalePop]"
+
+		# SQLite has no TOP
+		if not get_all and self._is_sqlite():
+			sql_line += " limit " + str(self._nrow_get)
+
+		sql_line += ";"
  
 		return sql_line
 
+	#
+	# queries for the server-side aggregation: the database collapses the transactions into the per-customer aggregates 
+	# CustProfileCreator makes the features of (see _aggregate_transactions there), so we only transfer a few rows 
+	# per customer instead of every transaction;
+	#
+	# the transactions are those of _create_query, less the (CustomerID, transID) pairs that come up more than once 
+	# (like drop_duplicates with keep=False does); the query is evaluated separately in each aggregate query (and twice
+	# in each, for the pairs), which _create_query orders by customer and transaction so that with GET_NROWS all of them
+	# see the same transactions; cutoffs are the dates the temporal features count the transactions 
+	# from and the days are bucketed by these, so the daily aggregate has at most one row per customer and window plus 
+	# one for the earlier transactions; its day is the earliest day in the bucket
+	#
+
+	def _create_aggregate_queries(self, cutoffs, trans_columns=(), days_ahead=False):
+
+		day = "date(transactionDate)" if self._is_sqlite() else "CAST(transactionDate AS DATE)"
+		cutoffs = sorted(set(pd.Timestamp(c).strftime("%Y-%m-%d") for c in cutoffs), reverse=True)
+
+		trans = ("WITH k AS (" + self._create_query().rstrip(";") + "), "
+					"t AS (SELECT k.* FROM k INNER JOIN (SELECT CustomerID, transID FROM k GROUP BY CustomerID, transID "
+					"HAVING COUNT(*) = 1) AS u ON (k.CustomerID = u.CustomerID) AND (k.transID = u.transID)) ")
+
+		attrs = trans + ("SELECT CustomerID, " + ", ".join("MIN({0}) AS {0}".format(c) for c in ["MosaicType", "ageGroup", "Gender", "CustomerState"]) + 
+							" FROM t GROUP BY CustomerID;")
+
+		counts = trans + " UNION ALL ".join("SELECT CustomerID, '{}' AS kind, [key], COUNT(*) AS n FROM (".format(kind) + 
+							" UNION ALL ".join("SELECT CustomerID, {} AS [key] FROM t".format(c) for c in cols) + 
+							") AS x WHERE [key] IS NOT NULL GROUP BY CustomerID, [key]" 
+								for kind, cols in [("MTypePrimary", ["MTypePrimary"]), ("MTypeSecondary", ["MTypeSecondary"]), 
+																				("Pop", ["CustPop", "SalePop"])] + 
+																	[(c, [c]) for c in trans_columns])
+		if days_ahead:
+			counts += "".join(" UNION ALL SELECT CustomerID, 'DaysAhead' AS kind, '{}' AS [key], {}(DaysAhead) AS n FROM t GROUP BY CustomerID".format(key, agg) 
+																					for key, agg in [("sum", "SUM"), ("count", "COUNT")])
+		counts += ";"
+
+		bucket = "CASE " + " ".join("WHEN {} >= '{}' THEN '{}'".format(day, c, c) for c in cutoffs) + " ELSE NULL END" if cutoffs else "NULL"
+		daily = trans + ("SELECT CustomerID, MIN(day) AS day, COUNT(*) AS n, SUM(Sales) AS Sales, SUM(AdmitQty) AS AdmitQty FROM "
+							"(SELECT CustomerID, {} AS day, {} AS bucket, Sales, AdmitQty FROM t) AS x GROUP BY CustomerID, bucket;").format(day, bucket)
+
+		return (attrs, counts, daily)
+
+	#
+	# get the per-customer aggregates (attrs, counts, daily) computed by the database; trans_columns and days_ahead 
+	# add the counts of the transactional features (see CustProfileCreator._transactional_features)
+	#
+
+	def download_aggregates(self, cutoffs, trans_columns=(), days_ahead=False):
+
+		start_time = time.time()
+		print("aggregating transactions on the server...")
+
+		conn = self._connect()
+		attrs_qry, counts_qry, daily_qry = self._create_aggregate_queries(cutoffs, trans_columns, days_ahead)
+
+		attrs = self._apply_schema(pd.read_sql(attrs_qry, conn)).set_index("CustomerID")
+		counts = pd.read_sql(counts_qry, conn).astype({"CustomerID": "int64", "kind": object, "key": object, "n": "int64"})
+		daily = pd.read_sql(daily_qry, conn).astype({"CustomerID": "int64", "n": "int64", "Sales": float, "AdmitQty": float})
+		daily["day"] = pd.to_datetime(daily["day"])
+
+		conn.close()
+
+		print("downloaded aggregates for {} customers: {} counts, {} daily rows ({} sec)".format(len(attrs.index), len(counts.index), 
+																				len(daily.index), round(time.time() - start_time, 1)))
+
+		return (attrs, counts[["CustomerID", "kind", "key", "n"]], daily[["CustomerID", "day", "n", "Sales", "AdmitQty"]])
+
 	# 
-	# decide if downloading the table is needed
+	# decide if downloading the table is needed;
+	# columns: load only these columns (e.g. the ones the feature builder needs)
+	# filters: load only the rows (and for Parquet, row groups) matching these, e.g. [("CustPop", "==", "AO2016")]
 	#
 
-	def download_or_load(self):
+	def download_or_load(self, columns=None, filters=None):
 
 		if self._enf_down == "yes":
 
 			# delete file if exists
-			if os.path.exists(self._tran_pkl):
-				os.remove(self._tran_pkl)
+			self._tran_cache.remove()
 			
 			# attempt download
 			self.dwnl_tbl, self._dwl_time = self._sql_to_df(self._create_query())
@@ -116,29 +361,196 @@ class DataHandler(object):
 		elif self._enf_down == "no":
 
 			# if file exists, load data frame from there
-			if os.path.exists(self._tran_pkl):
-				
-				with open(self._tran_pkl, "rb") as f:
-					self.dwnl_tbl = pickle.load(f)
-					print("loaded data from local pickle...")
+			if self._tran_cache.exists():
+
+				self.dwnl_tbl = self._apply_schema(self._tran_cache.read(columns=columns, filters=filters, memory_map=self._cache_mmap))
+				print("loaded data from local {} cache ({} MB)...".format(self._cache_fmt.name, self._mem_mb(self.dwnl_tbl)))
+				columns, filters = None, None  # already applied
 			else:
 				# if there's no file, attempt donwload
 				self.dwnl_tbl, self._dwl_time = self._sql_to_df(self._create_query())
 
+		# what we have just downloaded is the whole table, so apply the projection and filters now
+		if filters:
+			self.dwnl_tbl = self._apply_schema(self._tran_cache.read(columns=columns, filters=filters))
+		elif columns is not None:
+			self.dwnl_tbl = self.dwnl_tbl[columns]
+
 		self._nrow = len(self.dwnl_tbl.index)
 
+	#
+	# incremental pulls: get only the transactions made since the given date (the high-water mark of the 
+	# profile state); these are not cached because they only matter until they are merged into the state
+	#
+
+	def download_since(self, since=None, columns=None):
+
+		start_time = time.time()
+
+		if since is None:
+			print("no high-water mark yet, pulling all transactions...")
+		else:
+			print("pulling transactions since {}...".format(since))
+
+		conn = self._connect()
+		sql_string = self._create_query(since)
+
+		if self._chunksize > 0:
+			chunks = [self._apply_schema(chunk) for chunk in pd.read_sql(sql_string, conn, chunksize=self._chunksize)]
+			df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=list(TRANSACTION_SCHEMA))
+			df = self._apply_schema(df)
+		else:
+			df = self._apply_schema(pd.read_sql(sql_string, conn))
+
+		conn.close()
+
+		if columns is not None and len(df.index):
+			df = df[columns]
+
+		print("new rows...{} ({} sec)".format(len(df.index), round(time.time() - start_time, 1)))
+
+		return df
+
+	#
+	# the transactions chunk by chunk, from the local cache (unless ENFORCE_DOWNLOAD = yes) or else straight from the database
+	#
+
+	def _iter_transactions(self, columns=None, chunksize=500000):
+
+		if (self._enf_down == "no") and self._tran_cache.exists():
+
+			print("reading transactions from local {} cache in chunks of {} rows...".format(self._cache_fmt.name, chunksize))
+			for chunk in self._tran_cache.iter_chunks(columns=columns, batch_size=chunksize, memory_map=self._cache_mmap):
+				yield self._apply_schema(chunk)
+
+		else:
+
+			print("streaming transactions from the database in chunks of {} rows...".format(chunksize))
+			conn = self._connect()
+			cursor = conn.cursor()
+			cursor.execute(self._create_query())
+			cols = [d[0] for d in cursor.description]
+
+			while True:
+				rows = cursor.fetchmany(chunksize)
+				if not rows:
+					break
+				chunk = self._apply_schema(pd.DataFrame.from_records([tuple(r) for r in rows], columns=cols))
+				yield chunk if columns is None else chunk[columns]
+
+			cursor.close()
+			conn.close()
+
+	#
+	# partition the transactions into n_shards on-disk shards by a hash of CustomerID, so that all the transactions of 
+	# a customer (and so all the copies of any transaction) are in the same shard; returns the paths of the shards
+	#
+
+	def download_to_shards(self, shard_dir, n_shards, columns=None):
+
+		start_time = time.time()
+
+		if not os.path.exists(shard_dir):
+			os.makedirs(shard_dir)
+
+		stores = [ChunkStore(os.path.join(shard_dir, "shard_{:04d}{}".format(i, self._cache_fmt.extension)), self._cache_fmt) 
+																								for i in range(n_shards)]
+		for store in stores:
+			store.remove()
+
+		nrows = 0
+
+		for chunk in self._iter_transactions(columns, self._chunksize or 500000):
+
+			shard = pd.util.hash_array(chunk["CustomerID"].values) % n_shards
+			for i, part in chunk.groupby(shard, sort=False):
+				stores[i].append(part)
+
+			nrows += len(chunk.index)
+			print("sharded rows...{} ({} rows/sec)".format(nrows, round(nrows/max(time.time() - start_time, 1e-6))))
+
+		for store in stores:
+			store.close()
+
+		print("{} rows into {} shards in {}...".format(nrows, sum(store.nrows > 0 for store in stores), shard_dir))
+
+		return [store.path for store in stores if store.nrows > 0]
+
+	#
+	# write a table of results (e.g. feature importances) to the result sink, replacing whatever was there:
+	#
+	# db			: table in the database we download from (SQL Server or the SQLite stand-in)
+	# sqlite:<path>	: table in a local SQLite database
+	# file:<path>	: a tab-separated file
+	#
+	# rows go to the database with parameterised executemany (fast_executemany with pyodbc) in batches, 
+	# committing after every batch
+	#
+
+	def write_results(self, df, table, sink=None):
+
+		sink = sink or self._result_sink
+		start_time = time.time()
+
+		if sink.startswith("file:"):
+
+			df.to_csv(sink[len("file:"):], sep="\t", index=False)
+
+		else:
+
+			dsn = self._dsn if sink == "db" else sink
+			conn = self._pooled_connection(dsn)
+			cursor = conn.cursor()
+
+			if self._is_sqlite(dsn):
+				table = table.split(".")[-1].strip("[]")  # SQLite knows nothing about databases and schemas
+				cursor.execute("DROP TABLE IF EXISTS " + table + ";")
+			else:
+				cursor.execute("IF OBJECT_ID(N'" + table + "', N'U') IS NOT NULL BEGIN DROP TABLE " + table + " END;")
+				cursor.fast_executemany = True
+
+			sql_types = [("real" if df[c].dtype.kind == "f" else "int" if df[c].dtype.kind in "iub" else "varchar(255)") for c in list(df)]
+			cursor.execute("CREATE TABLE " + table + " (" + ", ".join("[{}] {}".format(c, t) for c, t in zip(list(df), sql_types)) + ");")
+
+			insert_query = ("INSERT INTO " + table + " (" + ", ".join("[{}]".format(c) for c in list(df)) + ") VALUES (" + 
+																		", ".join(["?"]*df.shape[1]) + ");")
+
+			# plain Python values, None for missing ones
+			rows = df.astype(object).where(df.notnull(), None).values.tolist()
+
+			for i in range(0, len(rows), self._upload_batch):
+				cursor.executemany(insert_query, rows[i:i + self._upload_batch])
+				conn.commit()
+
+			cursor.close()
+
+		print("wrote {} rows to {} ({}) in {} sec...".format(len(df.index), table, sink, round(time.time() - start_time, 1)))
+
 	#
 	# preview the data frame created from that table
 	#
 
+	#
+	# the summaries of the downloaded table (see transaction_summary), computed once for every table downloaded or loaded
+	#
+
+	def summary(self):
+
+		if (self._summary is None) or (self._summary_of is not self.dwnl_tbl):
+			self._summary, self._summary_of = TransactionSummary(self.dwnl_tbl), self.dwnl_tbl
+
+		return self._summary
+
 	def show_table(self, n=10):
 
+		summary = self.summary()
+
 		print(self.dwnl_tbl.head(n))
 		print("---> summary on downloaded table")
 		print("rows...{}".format(self._nrow))
 		print("columns...{}".format(self.dwnl_tbl.shape[1]))
-		print("unique customers...{}".format(len(list(self.dwnl_tbl["CustomerID"].unique()))))
-		print("unique transactions...{}".format(len(list(self.dwnl_tbl["transID"].unique()))))
+		print("unique customers...{}".format(summary.customers))
+		print("unique transactions...{}".format(summary.transactions))
 
 		for v in list(self.dwnl_tbl):
 			try:
@@ -0,0 +1,213 @@
+"""
+Resolve the transactions that come up more than once, i.e. the (CustomerID, transID) pairs found in several populations
+(the same transaction joined to more than one population of the customer or the sale); DEDUP_POLICY is one of
+
+	drop_all			: drop every copy, so the transaction doesn't count at all (what we have always done)
+	keep_first			: keep one copy, the one with the first populations (CustPop, then SalePop) in sorted order, so
+						  the same data keep the same copy whatever order the database returns it in
+	multi_pop_feature	: keep that copy and give the customer a multi_pop=<population> feature for every population
+						  the duplicates came with
+
+the pairs are encoded into one integer key (CustomerID*2^32 + transID while both fit into 32 bits, else a hash of the
+pair with the matches checked on the actual pairs kept from the scan; once a chunk has IDs over 32 bits the keys of the
+chunks before it are hashed too), so finding the duplicates costs one pass over two integer columns and doesn't copy
+the transaction data frame; the keys can be scanned chunk by chunk as the data comes in (scan), then the rows of every
+chunk resolved (mask); report has what has been dropped by population pair
+
+"""
+
+import numpy as np
+import pandas as pd
+
+class DuplicateResolver(object):
+
+	POLICIES = ["drop_all", "keep_first", "multi_pop_feature"]
+
+	def __init__(self, pars):
+
+		self.policy = pars["DEDUP_POLICY"].strip().lower() or "drop_all"
+
+		if self.policy not in self.POLICIES:
+			raise ValueError("error! unknown duplicate policy {}; choose from {}...".format(self.policy, self.POLICIES))
+
+		self.reset()
+
+	def reset(self):
+
+		self._keys = []  # the keys scanned so far, chunk by chunk
+		self._dup_keys = None  # sorted keys that come up more than once
+		self._hashed = False  # keys are hashes rather than the pairs themselves
+		self._pairs = []  # with hashed keys, the (CustomerID, transID) pairs scanned so far, chunk by chunk
+		self._dup_pairs = None  # with hashed keys, the pairs that come up more than once (not just their hashes)
+		self._emitted = set()  # keep_first: the duplicated keys whose first copy has been kept
+		self.nrows = 0
+		self.report = pd.DataFrame(columns=["populations", "rows", "transactions", "customers", "customers_lost"])
+		self.multi_pops = pd.DataFrame({"CustomerID": np.array([], dtype="int64"), "key": np.array([], dtype=object), 
+																					"n": np.array([], dtype="int64")})
+
+	@staticmethod
+	def _hash(cust_ids, trans_ids):
+
+		return pd.util.hash_array(cust_ids)*np.uint64(0x100000001b3) ^ pd.util.hash_array(trans_ids)
+
+	#
+	# from the pair keys to the hash keys: the pairs are taken back out of the keys scanned so far and hashed
+	#
+
+	def _to_hashed(self):
+
+		pairs = [((k >> np.uint64(32)).astype("int64"), (k & np.uint64(0xFFFFFFFF)).astype("int64")) for k in self._keys]
+		self._keys = [self._hash(c, t) for c, t in pairs]
+		self._pairs = pairs
+
+		emitted = np.fromiter(self._emitted, dtype="uint64", count=len(self._emitted))
+		self._emitted = set(self._hash((emitted >> np.uint64(32)).astype("int64"), (emitted & np.uint64(0xFFFFFFFF)).astype("int64")).tolist())
+
+		self._hashed = True
+		self._dup_keys, self._dup_pairs = None, None
+
+	def _encode(self, cust_ids, trans_ids):
+
+		cust_ids = np.asarray(cust_ids, dtype="int64")
+		trans_ids = np.asarray(trans_ids, dtype="int64")
+
+		fits = (len(cust_ids) == 0) or ((cust_ids.min() >= 0) and (cust_ids.max() < 2**32) and (trans_ids.min() >= 0) and (trans_ids.max() < 2**32))
+
+		if fits and not self._hashed:
+			return (cust_ids.astype("uint64") << np.uint64(32)) | trans_ids.astype("uint64")
+
+		if not self._hashed:
+			self._to_hashed()
+
+		return self._hash(cust_ids, trans_ids)
+
+	#
+	# add a chunk of (CustomerID, transID) pairs, e.g. the columns of the records fetched from the database
+	#
+
+	def scan(self, cust_ids, trans_ids):
+
+		keys = self._encode(cust_ids, trans_ids)  # may hash the keys scanned so far (see _to_hashed)
+		self._keys.append(keys)
+		if self._hashed:
+			self._pairs.append((np.asarray(cust_ids, dtype="int64"), np.asarray(trans_ids, dtype="int64")))
+		self.nrows += len(self._keys[-1])
+		self._dup_keys, self._dup_pairs = None, None
+
+	def _duplicated_keys(self):
+
+		if self._dup_keys is None:
+			keys = np.concatenate(self._keys) if self._keys else np.array([], dtype="uint64")
+			self._dup_keys = np.unique(keys[pd.Series(keys).duplicated(keep=False).values])
+
+			if self._hashed:
+				# the pairs behind the duplicated hashes, from all the chunks, less those that only share a hash
+				pairs = [(c[np.isin(k, self._dup_keys)], t[np.isin(k, self._dup_keys)]) for k, (c, t) in zip(self._keys, self._pairs)]
+				pairs = pd.MultiIndex.from_arrays([np.concatenate([c for c, t in pairs]), np.concatenate([t for c, t in pairs])])
+				self._dup_pairs = pairs[pairs.duplicated(keep=False)].unique()
+
+		return self._dup_keys
+
+	#
+	# which of the rows with these keys and pairs are duplicated
+	#
+
+	def _is_duplicated(self, keys, cust_ids, trans_ids):
+
+		dup = np.isin(keys, self._duplicated_keys())
+
+		if self._hashed and dup.any():
+			# make sure it's the pairs that match and not just their hashes
+			dup[dup] = pd.MultiIndex.from_arrays([np.asarray(cust_ids, dtype="int64")[dup], 
+															np.asarray(trans_ids, dtype="int64")[dup]]).isin(self._dup_pairs)
+
+		return dup
+
+	@property
+	def n_duplicated(self):
+
+		if self._hashed:
+			return int(sum(self._is_duplicated(k, c, t).sum() for k, (c, t) in zip(self._keys, self._pairs)))
+
+		keys = self._duplicated_keys()
+
+		return int(sum(np.isin(k, keys).sum() for k in self._keys))
+
+	#
+	# which rows of a chunk to keep (a chunk that has been scanned, or is part of what has been scanned); ranks, if
+	# given, order the copies of a pair and the one ranked first is kept, else the first in the chunk
+	#
+
+	def mask(self, cust_ids, trans_ids, ranks=None):
+
+		keys = self._encode(cust_ids, trans_ids)
+		dup = self._is_duplicated(keys, cust_ids, trans_ids)
+
+		if self.policy == "drop_all":
+			return ~dup
+
+		# the first copy of a duplicated pair in this chunk, unless its first copy came with an earlier chunk
+		order = np.arange(len(keys)) if ranks is None else np.argsort(ranks, kind="stable")
+		first = np.zeros(len(keys), dtype=bool)
+		first[order] = ~pd.Series(keys[order]).duplicated(keep="first").values
+		first &= dup
+		first[first] = ~np.isin(keys[first], np.fromiter(self._emitted, dtype="uint64", count=len(self._emitted)))
+		self._emitted.update(keys[first].tolist())
+
+		return ~dup | first
+
+	#
+	# what the duplicates are by population pair (all the populations a duplicated transaction came with);
+	# customers_lost are the customers who have no transactions left
+	#
+
+	def _report(self, df, keep):
+
+		dup = df.loc[~keep | self._is_duplicated(self._encode(df["CustomerID"].values, df["transID"].values), 
+																					df["CustomerID"].values, df["transID"].values),
+																					["CustomerID", "transID", "CustPop", "SalePop"]]
+
+		if len(dup.index) == 0:
+			return
+
+		pops = pd.concat([dup[["CustomerID", "transID", c]].rename(columns={c: "key"}) for c in ["CustPop", "SalePop"]])
+		pops["key"] = pops["key"].astype(object)
+		pops = pops.dropna().drop_duplicates().sort_values("key")
+
+		pairs = pops.groupby(["CustomerID", "transID"], sort=False)["key"].agg(" & ".join).rename("populations")
+		dropped = df.loc[~keep, ["CustomerID", "transID"]].join(pairs, on=["CustomerID", "transID"])
+
+		lost = dropped.loc[~dropped["CustomerID"].isin(df.loc[keep, "CustomerID"])]
+
+		self.report = dropped.groupby("populations").agg(rows=("transID", "size"), transactions=("transID", "nunique"), 
+																					customers=("CustomerID", "nunique"))
+		self.report["customers_lost"] = lost.groupby("populations")["CustomerID"].nunique().reindex(self.report.index, fill_value=0)
+		self.report = self.report.reset_index()
+
+		if self.policy == "multi_pop_feature":
+			self.multi_pops = pops.groupby(["CustomerID", "key"], sort=False).size().rename("n").reset_index()
+
+	#
+	# resolve the duplicates in a whole transaction data frame; the data frame comes back as it is if there are none
+	#
+
+	def resolve(self, df):
+
+		self.reset()
+		self.scan(df["CustomerID"].values, df["transID"].values)
+
+		# the copies of a pair by their populations in sorted order, not by the order the rows came in
+		ranks = None
+
+		if (self.policy != "drop_all") and len(df.index):
+			ranks = pd.factorize(df["CustPop"].astype(str) + "\t" + df["SalePop"].astype(str), sort=True)[0]
+
+		keep = self.mask(df["CustomerID"].values, df["transID"].values, ranks)
+
+		self._report(df, keep)
+
+		if len(self.report.index):
+			print("---> duplicated transactions ({}): dropped {} rows".format(self.policy, (~keep).sum()))
+			print(self.report.to_string(index=False))
+
+		return df if keep.all() else df.loc[keep]
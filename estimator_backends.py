@@ -0,0 +1,140 @@
+"""
+The estimators the features can be ranked with (ESTIMATOR_BACKEND), all behind the same interface: the estimator the
+model search starts from and the parameters it searches over, whether it needs dense input and the model's own
+importances (see FeatureRanker; the permutation and stability importances work with any of them)
+
+	random_forest	: random forests with 1 to 11 trees (the original backend); impurity importances with confidence
+					  intervals from the spread over the trees
+	extra_trees		: extremely randomized trees; the split points are drawn at random rather than searched for, so
+					  ensembles of hundreds of trees fit in the time a few random forest trees take and their impurity
+					  importances are much less noisy
+	hist_gb			: histogram-based gradient boosting; the features are binned into at most 255 bins once and every
+					  split is found on the bins, so it gets to a good fit in few iterations; needs dense input and has
+					  no importances of its own (only permutation and stability)
+	l1_logistic		: L1-regularized logistic regression on the features scaled to [-1, 1] (which keeps the sparse
+					  indicators sparse), a quick baseline; the importances are the absolute coefficients averaged over
+					  the populations, the confidence intervals come from the spread over the populations
+
+"""
+
+import numpy as np
+import sklearn
+from scipy import sparse
+from sklearn.ensemble import ExtraTreesClassifier, HistGradientBoostingClassifier, RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import FunctionTransformer, MaxAbsScaler
+
+#
+# missing values (the features of the dense profile that aren't filled with zeros) are zeros to the linear model;
+# works on sparse matrices and on any dtype, like the uint8 of a memory-mapped profile
+#
+
+def _zero_missing(X):
+
+	if sparse.issparse(X):
+		X = X.copy()
+		X.data = np.nan_to_num(X.data)
+		return X
+
+	return np.nan_to_num(np.asarray(X, dtype="float32"))
+
+class EstimatorBackend(object):
+
+	name = None
+	native = "impurity"  # what the model's own importances are called in the ranked table
+	dense_input = False  # True if the estimator can't take sparse matrices
+
+	def estimator(self):
+
+		raise NotImplementedError
+
+	def param_grid(self):
+
+		raise NotImplementedError
+
+	#
+	# the model's own importances and the same by ensemble member (tree, population) for the confidence intervals;
+	# None if the model has none
+	#
+
+	def importances(self, model):
+
+		return None
+
+class RandomForestBackend(EstimatorBackend):
+
+	name = "random_forest"
+
+	def estimator(self):
+
+		return RandomForestClassifier(random_state=113)
+
+	def param_grid(self):
+
+		return {'n_estimators': np.arange(1,12,1).tolist(), 'min_weight_fraction_leaf': np.round(np.arange(0.01,0.5,0.01), 2).tolist()}
+
+	def importances(self, model):
+
+		return (model.feature_importances_, np.array([t.feature_importances_ for t in model.estimators_]))
+
+class ExtraTreesBackend(RandomForestBackend):
+
+	name = "extra_trees"
+
+	def estimator(self):
+
+		return ExtraTreesClassifier(random_state=113)
+
+	def param_grid(self):
+
+		return {'n_estimators': [50, 100, 200, 400], 'max_features': ["sqrt", 0.2, 0.5], 'min_samples_leaf': [1, 3, 10, 30]}
+
+class HistGradientBoostingBackend(EstimatorBackend):
+
+	name = "hist_gb"
+	dense_input = True
+
+	def estimator(self):
+
+		return HistGradientBoostingClassifier(random_state=113)
+
+	def param_grid(self):
+
+		return {'max_iter': [50, 100, 200], 'learning_rate': [0.03, 0.1, 0.3], 'max_leaf_nodes': [7, 15, 31],
+																			'l2_regularization': [0.0, 0.1, 1.0]}
+
+class L1LogisticBackend(EstimatorBackend):
+
+	name = "l1_logistic"
+	native = "coefficient"
+
+	def estimator(self):
+
+		# penalty is deprecated in favour of l1_ratio from scikit-learn 1.8 on
+		version = tuple(int(v) for v in sklearn.__version__.split(".")[:2])
+		l1 = {"l1_ratio": 1.0} if version >= (1, 8) else {"penalty": "l1"}
+
+		return Pipeline([("fill", FunctionTransformer(_zero_missing, accept_sparse=True)), ("scale", MaxAbsScaler()),
+							("logit", LogisticRegression(solver="saga", C=0.1, max_iter=500, tol=1e-3, random_state=113, **l1))])
+
+	def param_grid(self):
+
+		return {'logit__C': [0.003, 0.01, 0.03, 0.1, 0.3, 1.0, 3.0]}
+
+	def importances(self, model):
+
+		per_pop = np.abs(model.named_steps["logit"].coef_)  # one row for two populations, else one per population
+
+		return (per_pop.mean(axis=0), per_pop)
+
+BACKENDS = {b.name: b for b in [RandomForestBackend, ExtraTreesBackend, HistGradientBoostingBackend, L1LogisticBackend]}
+
+def get_backend(name):
+
+	name = name.strip().lower() or "random_forest"
+
+	if name not in BACKENDS:
+		raise ValueError("error! unknown estimator backend {}; choose from {}...".format(name, sorted(BACKENDS)))
+
+	return BACKENDS[name]()
@@ -0,0 +1,183 @@
+"""
+Feature importance ranking for a fitted model; the methods (RANKING_METHODS) are
+
+	impurity	: the model's own importances (see estimator_backends): the impurity-based importances of the forests
+				  with the confidence interval from the spread over the trees, so nothing is refitted, or the absolute
+				  coefficients of l1_logistic (ranked as coefficient); hist_gb has none and is ranked by the others
+	permutation	: the drop in test accuracy when a feature's values are shuffled; the features are shuffled in
+				  parallel worker processes, repeat after repeat, until the top RANKING_TOP_K features stay in
+				  the same order for RANKING_PATIENCE repeats in a row (or RANKING_N_REPEATS repeats are done)
+	stability	: a bootstrap over the test customers of the permutation results (so it needs no refits and no
+				  extra predictions): the mean importance with a confidence interval and the share of the
+				  bootstrap samples in which the feature made the top RANKING_TOP_K
+
+the model's predictions on the unshuffled test set are computed once and reused by every method; with 
+RANKING_N_JOBS = 1 the features are shuffled in this process
+
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from scipy import sparse
+
+from estimator_backends import get_backend
+
+# what the worker processes need, set once per worker by _init_worker
+_model = None
+_X = None
+_y = None
+
+def _init_worker(model, X, y):
+
+	global _model, _X, _y
+	_model, _X, _y = model, X, y
+
+#
+# which test customers are still classified correctly after shuffling feature j
+#
+
+def _permuted_correct(j, seed):
+
+	col = _X[:, j].copy()
+	_X[:, j] = np.random.RandomState(seed).permutation(col)
+	correct = (_model.predict(_X) == _y)
+	_X[:, j] = col  # every worker has its own copy of the data (or there is only one), so shuffle in place and put it back
+
+	return correct
+
+class FeatureRanker(object):
+
+	def __init__(self, pars, backend=None):
+
+		self.backend = backend or get_backend(pars["ESTIMATOR_BACKEND"])
+		self.methods = pars["RANKING_METHODS"].split() or ["impurity", "permutation", "stability"]
+		self.n_repeats = int(pars["RANKING_N_REPEATS"] or 30)
+		self.top_k = int(pars["RANKING_TOP_K"] or 20)
+		self.patience = int(pars["RANKING_PATIENCE"] or 5)
+		self.n_bootstrap = int(pars["RANKING_N_BOOTSTRAP"] or 200)
+		self.n_jobs = int(pars["RANKING_N_JOBS"] or 0) or os.cpu_count()
+		self.confidence = 0.95
+		self.random_state = 113
+
+		for m in self.methods:
+			if m not in ["impurity", "permutation", "stability"]:
+				raise ValueError("error! unknown ranking method {}...".format(m))
+
+		self.base_correct = None  # the cached predictions on the test set: correct or not
+		self.perm_correct = None  # repeats x features x test customers
+		self.n_repeats_done = 0
+
+	def _ci(self, samples, axis=0):
+
+		alpha = (1 - self.confidence)/2
+
+		return (np.percentile(samples, 100*alpha, axis=axis), np.percentile(samples, 100*(1 - alpha), axis=axis))
+
+	def _table(self, method, feature_names, importance, ci_low, ci_high, **extra):
+
+		tbl = pd.DataFrame(dict({"feature": feature_names, "method": method, "importance": importance,
+																"ci_low": ci_low, "ci_high": ci_high}, **extra))
+		tbl = tbl.sort_values("importance", ascending=False).reset_index(drop=True)
+		tbl["rank"] = np.arange(1, len(tbl.index) + 1)
+
+		return tbl
+
+	def _impurity(self, model, feature_names):
+
+		own = self.backend.importances(model)
+
+		if own is None:
+			print("note: {} models have no importances of their own, skipping impurity...".format(self.backend.name))
+			return None
+
+		importance, per_member = own
+		ci_low, ci_high = self._ci(per_member)
+
+		return self._table(self.backend.native, feature_names, importance, ci_low, ci_high)
+
+	def _top_k(self, importance):
+
+		return tuple(np.argsort(-importance, kind="stable")[:self.top_k])
+
+	#
+	# shuffle every feature repeat after repeat; stop early once the top k have settled
+	#
+
+	def _permute(self, model, X, y):
+
+		n_features = X.shape[1]
+		perm_correct = []
+		last_top, same_for = None, 0
+
+		executor = ProcessPoolExecutor if self.n_jobs > 1 else ThreadPoolExecutor
+
+		with executor(max_workers=self.n_jobs, initializer=_init_worker, initargs=(model, X, y)) as pool:
+
+			for r in range(self.n_repeats):
+
+				seeds = self.random_state + r*n_features + np.arange(n_features)
+				perm_correct.append(np.array(list(pool.map(_permuted_correct, range(n_features), seeds,
+																	chunksize=max(1, n_features//(4*self.n_jobs))))))
+
+				importance = (self.base_correct.mean() - np.array(perm_correct).mean(axis=2)).mean(axis=0)
+				top = self._top_k(importance)
+				same_for = same_for + 1 if top == last_top else 0
+				last_top = top
+
+				if same_for >= self.patience:
+					print("top {} features settled after {} repeats...".format(self.top_k, r + 1))
+					break
+
+		self.perm_correct = np.array(perm_correct, dtype=bool)
+		self.n_repeats_done = len(perm_correct)
+
+	def _permutation(self, feature_names):
+
+		per_repeat = self.base_correct.mean() - self.perm_correct.mean(axis=2)  # repeats x features
+		ci_low, ci_high = self._ci(per_repeat)
+
+		return self._table("permutation", feature_names, per_repeat.mean(axis=0), ci_low, ci_high)
+
+	def _stability(self, feature_names):
+
+		rng = np.random.RandomState(self.random_state)
+		n = len(self.base_correct)
+
+		# importance of every feature per test customer, averaged over the repeats
+		drop = self.base_correct[np.newaxis, :].astype("float32") - self.perm_correct.mean(axis=0)  # features x customers
+
+		boot = np.empty((self.n_bootstrap, drop.shape[0]))
+		in_top = np.zeros(drop.shape[0])
+
+		for b in range(self.n_bootstrap):
+			boot[b] = drop[:, rng.randint(0, n, n)].mean(axis=1)
+			in_top[list(self._top_k(boot[b]))] += 1
+
+		ci_low, ci_high = self._ci(boot)
+
+		return self._table("stability", feature_names, boot.mean(axis=0), ci_low, ci_high, top_k_share=in_top/self.n_bootstrap)
+
+	def rank(self, model, X_test, y_test, feature_names):
+
+		X = X_test.toarray() if sparse.issparse(X_test) else np.array(X_test)  # a copy we can shuffle the features of
+		y = np.asarray(y_test)
+
+		self.base_correct = (model.predict(X) == y)
+		tables = []
+
+		if "impurity" in self.methods:
+			tables.append(self._impurity(model, feature_names))
+
+		if ("permutation" in self.methods) or ("stability" in self.methods):
+			print("permutation importances for {} features on {} test customers, {} workers...".format(X.shape[1], X.shape[0], self.n_jobs))
+			self._permute(model, X, y)
+
+		if "permutation" in self.methods:
+			tables.append(self._permutation(feature_names))
+
+		if "stability" in self.methods:
+			tables.append(self._stability(feature_names))
+
+		return pd.concat([t for t in tables if t is not None], ignore_index=True)
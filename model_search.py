@@ -0,0 +1,278 @@
+"""
+Hyperparameter search for the estimator of ESTIMATOR_BACKEND (see estimator_backends; random forests by default, where
+the candidates are (n_estimators, min_weight_fraction_leaf) pairs) and every (candidate, cross-validation fold) fit runs
+in a pool of worker processes;
+
+SEARCH_STRATEGY
+	grid		: every candidate on all the training data
+	random		: SEARCH_N_CANDIDATES random candidates on all the training data
+	halving		: successive halving; SEARCH_N_CANDIDATES random candidates start on a small share of the training
+				  data and only the best third goes on to the next round with three times as much data
+
+the search stops submitting new fits once SEARCH_MAX_EVALS fits have been done or SEARCH_TIME_BUDGET seconds
+have passed; the score of every fit is cached in SEARCH_CACHE_DIR under a key made of a fingerprint of the data,
+the candidate, the fold and the amount of data used, so reruns on the same profile skip the fits done before;
+with SEARCH_N_JOBS = 1 the fits run in this process (e.g. when the search itself runs in a worker process);
+the data can be a memory-mapped matrix (see CustProfileCreator.feature_matrix) with the positions of the training rows
+in it: the folds are index arrays into these and the workers map the same file instead of getting a copy each
+
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from scipy import sparse
+from sklearn.base import clone
+from sklearn.model_selection import ParameterGrid, ParameterSampler, StratifiedKFold
+
+from estimator_backends import get_backend
+
+# data the worker processes fit on, set once per worker by _init_worker rather than sent with every fit;
+# _rows are the positions of the samples in _X
+_X = None
+_y = None
+_rows = None
+
+def _init_worker(X, y, rows):
+
+	global _X, _y, _rows
+	_X = np.load(X, mmap_mode="r") if isinstance(X, str) else X  # a file name: map it
+	_y, _rows = y, rows
+
+#
+# the rows of X at positions idx, made dense for the estimators that need it
+#
+
+def _take(X, idx, dense_input):
+
+	X = X[idx]
+
+	return X.toarray() if dense_input and sparse.issparse(X) else X
+
+def _fit_and_score(estimator, params, train_idx, test_idx, dense_input=False):
+
+	start_time = time.time()
+	est = clone(estimator).set_params(**params)
+	est.fit(_take(_X, _rows[train_idx], dense_input), _y[train_idx])
+	score = est.score(_take(_X, _rows[test_idx], dense_input), _y[test_idx])
+
+	return (score, time.time() - start_time)
+
+#
+# a fingerprint of the data to key the cached fits with
+#
+
+def data_fingerprint(X, y, rows=None):
+
+	h = hashlib.sha1()
+
+	# hashed straight from the buffers (no copies of the data, which may be memory-mapped)
+	if sparse.issparse(X):
+		X = X.tocsr()
+		for a in [X.data, X.indices, X.indptr, np.array(X.shape)]:
+			h.update(np.ascontiguousarray(a))
+	else:
+		h.update(np.ascontiguousarray(X))
+		h.update(np.array(X.shape))
+
+	h.update(np.ascontiguousarray(y))
+
+	if rows is not None:
+		h.update(np.ascontiguousarray(rows, dtype="int64"))
+
+	return h.hexdigest()
+
+class ModelSearch(object):
+
+	def __init__(self, pars, estimator=None, param_grid=None, dense_input=False):
+
+		backend = get_backend(pars["ESTIMATOR_BACKEND"])
+
+		self.estimator = estimator if estimator is not None else backend.estimator()
+		self.param_grid = param_grid or backend.param_grid()
+		self.dense_input = dense_input if estimator is not None else backend.dense_input
+		self.strategy = pars["SEARCH_STRATEGY"].strip().lower() or "halving"
+		self.n_candidates = int(pars["SEARCH_N_CANDIDATES"] or 60)
+		self.n_jobs = int(pars["SEARCH_N_JOBS"] or 0) or os.cpu_count()
+		self.max_evals = int(pars["SEARCH_MAX_EVALS"] or 0)  # 0: no limit
+		self.time_budget = float(pars["SEARCH_TIME_BUDGET"] or 0)  # seconds; 0: no limit
+		self.cache_dir = pars["SEARCH_CACHE_DIR"] or "./data/search_cache"
+		self.n_folds = 3
+		self.factor = 3  # successive halving: keep 1/factor of the candidates, give them factor times more data
+		self.random_state = 113
+
+		if self.strategy not in ["grid", "random", "halving"]:
+			raise ValueError("error! unknown search strategy {}...".format(self.strategy))
+
+		self.results_ = pd.DataFrame()
+		self.best_params_ = None
+		self.best_score_ = None
+		self.best_estimator_ = None
+
+	def _candidates(self):
+
+		if self.strategy == "grid":
+			return list(ParameterGrid(self.param_grid))
+
+		return list(ParameterSampler(self.param_grid, n_iter=self.n_candidates, random_state=self.random_state))
+
+	def _cache_file(self, fingerprint, params, fold, n_train):
+
+		key = json.dumps([fingerprint, type(self.estimator).__name__, sorted(params.items()), fold, n_train,
+															self.n_folds, self.random_state], default=str)
+
+		return os.path.join(self.cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+	def _out_of_budget(self, n_evals, start_time):
+
+		return ((self.max_evals > 0) and (n_evals >= self.max_evals)) or \
+					((self.time_budget > 0) and (time.time() - start_time >= self.time_budget))
+
+	#
+	# evaluate candidates on every fold using (at most) n_train training samples per fold; returns one row per fit
+	#
+
+	def _evaluate(self, pool, candidates, folds, n_train, fingerprint, start_time, n_evals):
+
+		rows = []
+		pending = dict()
+		tasks = [(c, f) for c in range(len(candidates)) for f in range(len(folds))]
+
+		while tasks or pending:
+
+			while tasks and (len(pending) < 2*self.n_jobs) and not self._out_of_budget(n_evals + len(pending), start_time):
+
+				c, f = tasks.pop(0)
+				train_idx, test_idx = folds[f]
+				train_idx = train_idx[:n_train]
+				cache_file = self._cache_file(fingerprint, candidates[c], f, len(train_idx))
+
+				if os.path.exists(cache_file):
+					with open(cache_file, "r") as fl:
+						cached = json.load(fl)
+					rows.append({"candidate": c, "fold": f, "n_train": len(train_idx), "score": cached["score"],
+																		"fit_time": cached["fit_time"], "cached": True})
+					continue
+
+				pending[pool.submit(_fit_and_score, self.estimator, candidates[c], train_idx, test_idx, self.dense_input)] = (c, f, len(train_idx), cache_file)
+
+			if not pending:
+				break
+
+			done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+
+			for fut in done:
+				c, f, nt, cache_file = pending.pop(fut)
+				score, fit_time = fut.result()
+				n_evals += 1
+				# write to a temporary file first: other searches (e.g. the batch jobs) may be reading the same cache
+				tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+				with open(tmp_file, "w") as fl:
+					json.dump({"score": score, "fit_time": fit_time}, fl)
+				os.replace(tmp_file, cache_file)
+				rows.append({"candidate": c, "fold": f, "n_train": nt, "score": score, "fit_time": fit_time, "cached": False})
+
+		return (pd.DataFrame(rows), n_evals)
+
+	#
+	# rows: the positions of the samples (with the labels in y) in X, e.g. the training customers in a memory-mapped
+	# feature matrix; all the rows of X if not given
+	#
+
+	def fit(self, X, y, rows=None):
+
+		X = X.values if hasattr(X, "iloc") else X
+		X = X.tocsr() if sparse.issparse(X) else X
+		y = np.asarray(y)
+
+		# the worker processes map a memory-mapped X themselves rather than get a copy of it (if X is the whole file
+		# and not a view of a part of it)
+		mapped = isinstance(X, np.memmap) and isinstance(X.base, mmap.mmap) and (self.n_jobs > 1)
+
+		os.makedirs(self.cache_dir, exist_ok=True)  # several searches may be starting at once
+
+		start_time = time.time()
+		fingerprint = data_fingerprint(X, y, rows)
+		all_rows = rows is None
+		rows = np.arange(X.shape[0]) if all_rows else np.asarray(rows)
+
+		# the folds are fixed; the training part of every fold is shuffled once so that taking its first n samples
+		# is a random subsample
+		rng = np.random.RandomState(self.random_state)
+		folds = [(rng.permutation(tr), te) for tr, te in
+						StratifiedKFold(self.n_folds, shuffle=True, random_state=self.random_state).split(np.zeros(len(y)), y)]
+		n_train_max = min(len(tr) for tr, te in folds)
+
+		candidates = self._candidates()
+		alive = list(range(len(candidates)))
+
+		if self.strategy == "halving":
+			n_rounds = max(1, int(np.ceil(np.log(len(candidates))/np.log(self.factor))))
+			n_train = max(10*len(np.unique(y)), int(n_train_max/self.factor**(n_rounds - 1)))
+		else:
+			n_rounds = 1
+			n_train = n_train_max
+
+		print("searching over {} candidates ({}), {} folds, {} workers...".format(len(candidates), self.strategy, self.n_folds, self.n_jobs))
+
+		results = []
+		n_evals = 0
+
+		executor = ProcessPoolExecutor if self.n_jobs > 1 else ThreadPoolExecutor
+
+		with executor(max_workers=self.n_jobs, initializer=_init_worker, initargs=(X.filename if mapped else X, y, rows)) as pool:
+
+			for rnd in range(n_rounds):
+
+				res, n_evals = self._evaluate(pool, [candidates[c] for c in alive], folds, n_train, fingerprint, start_time, n_evals)
+
+				if res.empty:
+					break
+
+				res["candidate"] = [alive[c] for c in res["candidate"]]
+				res["round"] = rnd
+				results.append(res)
+
+				# only the candidates evaluated on every fold compete
+				scores = res.groupby("candidate")["score"].agg(["mean", "size"])
+				scores = scores.loc[scores["size"] == self.n_folds, "mean"].sort_values(ascending=False)
+
+				print("round {}: {} candidates on {} training samples, best mean score {}, {} fits so far ({} sec)...".format(
+						rnd + 1, len(alive), n_train, round(scores.iloc[0], 3) if len(scores) else None, n_evals, round(time.time() - start_time, 1)))
+
+				if self._out_of_budget(n_evals, start_time) or (rnd == n_rounds - 1) or (len(scores) < 2):
+					break
+
+				alive = list(scores.index[:max(1, int(np.ceil(len(scores)/self.factor)))])
+				n_train = min(n_train_max, n_train*self.factor)
+
+		if not results:
+			raise RuntimeError("error! the search budget ran out before any candidate was evaluated...")
+
+		self.results_ = pd.concat(results, ignore_index=True)
+
+		# per candidate and round: mean score and time spent
+		summary = self.results_.groupby(["round", "candidate", "n_train"]).agg(mean_score=("score", "mean"),
+							folds=("score", "size"), fit_time=("fit_time", "sum"), cached=("cached", "all")).reset_index()
+		summary["params"] = [candidates[c] for c in summary["candidate"]]
+		self.summary_ = summary
+
+		print("time per candidate (sec): mean {}, max {}; {} of {} fits were cached...".format(round(summary["fit_time"].mean(), 2),
+							round(summary["fit_time"].max(), 2), int(self.results_["cached"].sum()), len(self.results_.index)))
+
+		# the best candidate among those evaluated on every fold in the last round they got to
+		complete = summary.loc[summary["folds"] == self.n_folds].sort_values(["round", "mean_score"], ascending=[False, False])
+		best = complete.iloc[0] if len(complete.index) else summary.sort_values("mean_score", ascending=False).iloc[0]
+
+		self.best_params_ = candidates[best["candidate"]]
+		self.best_score_ = best["mean_score"]
+		print("best parameter values: {} (mean score {})".format(self.best_params_, round(self.best_score_, 3)))
+
+		self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_).fit(_take(X, slice(None) if all_rows else rows, self.dense_input), y)
+
+		return self.best_estimator_
@@ -0,0 +1,86 @@
+"""
+Mosaic lookup table: maps a Mosaic type to its Mosaic letter and to the income and education classes 
+described by the rules in the Mosaic classes file (see mosaic_classes.info);
+
+every Mosaic type is decomposed and matched against the rules only once, so classifying a column of 
+Mosaic types costs as much as the number of unique types in it
+
+"""
+
+import re
+import pandas as pd
+from collections import defaultdict
+
+# a proper Mosaic type looks like [letter][digit1][digit2], for example, "A02"
+MOSAIC_MASK = re.compile(r'(^[A-M]{1})(\d{2}$)')
+
+def decompose_mosaic(mostype):
+
+	match_res = MOSAIC_MASK.match(mostype)  # match objects always have a boolean value of True
+	assert match_res, "error! this is not a Mosaic group name.." 
+	
+	mos_letter = match_res.group(1)  # mosaic letter
+	mosn = int(match_res.group(2))  # mosaic number
+	assert (mosn < 50), "error! the Mosaic class number should be under 50..."	
+
+	return (mos_letter, mosn)
+
+class MosaicLookup(object):
+
+	def __init__(self, rules_file):
+
+		self.rules = defaultdict(list)  # {"INCOME": [("high_income", {"A", "D", "B05", ..}), ..], "EDUCATION": [..]}
+		self._table = dict()  # {"A02": ("A", "high_income", "good_education"), ..}
+
+		with open(rules_file, "r") as f:
+			for line in f:
+				if ("=" in line) and ("#" not in line):
+					what, rule = [w.strip() for w in line.split("=")]
+					kind, cls = what.split()
+					self.rules[kind.upper()].append((cls, set(rule.split())))
+
+		for kind in ["INCOME", "EDUCATION"]:
+			assert self.rules[kind], "error! no {} rules in {}...".format(kind.lower(), rules_file)
+
+	def _match(self, kind, mostype, mos_letter):
+
+		for cls, rule in self.rules[kind]:
+			if ("*" in rule) or (mos_letter in rule) or (mostype in rule):
+				return cls
+
+		raise ValueError("error! no {} class for Mosaic type {}...".format(kind.lower(), mostype))
+
+	#
+	# (letter, income class, education class) for a single Mosaic type
+	#
+
+	def lookup(self, mostype):
+
+		if mostype not in self._table:
+			mos_letter, mosn = decompose_mosaic(mostype)
+			self._table[mostype] = (mos_letter, self._match("INCOME", mostype, mos_letter), 
+														self._match("EDUCATION", mostype, mos_letter))
+
+		return self._table[mostype]
+
+	#
+	# the lookup table for a collection of Mosaic types as a data frame indexed by the Mosaic type
+	#
+
+	def table(self, mostypes):
+
+		mostypes = list(mostypes)
+
+		return pd.DataFrame([self.lookup(mt) for mt in mostypes], index=pd.Index(mostypes, name="MosaicType"), 
+																	columns=["letter", "income", "education"])
+
+	#
+	# classify a column of Mosaic types in one categorical map; nulls stay nulls
+	#
+
+	def classify(self, mostypes):
+
+		mostypes = mostypes.astype("category").cat.remove_unused_categories()
+		mos_table = self.table(mostypes.cat.categories)
+
+		return pd.DataFrame({col: mostypes.map(mos_table[col]) for col in list(mos_table)}, index=mostypes.index)
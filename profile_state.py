@@ -0,0 +1,113 @@
+"""
+Customer profile state kept between runs for incremental profile updates:
+
+	attrs:		the customer level attributes (first value seen)
+	counts:		per-customer counts of primary MTypes, secondary MTypes, populations and the values of the transactional
+				feature columns
+	daily:		per-customer transaction counts, sales and admissions by day; the temporal features are recomputed from these
+				whenever the reference date moves
+	features:	the customer features that don't depend on the reference date, in long format
+	meta:		population encoding, popular secondary MTypes and the high-water mark, i.e. the latest
+				transactionDate seen and the transactions on it (these come back with the next pull
+				and have to be skipped)
+
+every part is stored as a data frame in the cache format (see table_store)
+
+"""
+
+import json
+import os
+import pandas as pd
+
+from table_store import ChunkStore
+
+class ProfileState(object):
+
+	PARTS = ["attrs", "counts", "daily", "features", "boundary"]
+
+	def __init__(self, state_dir, fmt):
+
+		self.state_dir = state_dir
+		self.fmt = fmt
+
+		self.attrs = None
+		self.counts = None
+		self.daily = None
+		self.features = None
+		self.boundary = None  # (CustomerID, transID) of the transactions at the high-water mark
+		self.pops_enc = dict()
+		self.popular_sec_mtypes = []
+		self.hwm = None  # the latest transactionDate seen, truncated to seconds
+
+	def _store(self, part):
+
+		return ChunkStore(os.path.join(self.state_dir, part + self.fmt.extension), self.fmt)
+
+	def _meta_file(self):
+
+		return os.path.join(self.state_dir, "meta.json")
+
+	def exists(self):
+
+		return os.path.exists(self._meta_file())
+
+	def load(self):
+
+		if not self.exists():
+			print("no profile state in {}, starting from scratch...".format(self.state_dir))
+			return self
+
+		for part in self.PARTS:
+			setattr(self, part, self._store(part).read())
+
+		self.attrs = self.attrs.set_index("CustomerID")
+
+		with open(self._meta_file(), "r") as f:
+			meta = json.load(f)
+
+		self.pops_enc = dict(meta["pops_enc"])
+		self.popular_sec_mtypes = meta["popular_sec_mtypes"]
+		self.hwm = pd.Timestamp(meta["hwm"]) if meta["hwm"] else None
+
+		print("loaded profile state for {} customers; high-water mark {}...".format(len(self.attrs.index), self.hwm))
+
+		return self
+
+	def save(self):
+
+		if not os.path.exists(self.state_dir):
+			os.makedirs(self.state_dir)
+
+		for part in self.PARTS:
+			df = getattr(self, part)
+			self._store(part).write(df.reset_index() if part == "attrs" else df.reset_index(drop=True))
+
+		with open(self._meta_file(), "w") as f:
+			json.dump({"pops_enc": [[k, v] for k, v in self.pops_enc.items()], "popular_sec_mtypes": self.popular_sec_mtypes,
+																"hwm": None if self.hwm is None else str(self.hwm)}, f)
+
+		print("saved profile state to {}...".format(self.state_dir))
+
+	#
+	# merge the aggregates of new transactions; returns the IDs of the customers whose aggregates have changed
+	#
+
+	def merge(self, attrs, counts, daily):
+
+		changed = attrs.index
+
+		if self.attrs is None:
+			self.attrs, self.counts, self.daily = attrs, counts, daily
+			return changed
+
+		# the attributes of known customers stay as they were first seen
+		self.attrs = pd.concat([self.attrs, attrs.loc[~attrs.index.isin(self.attrs.index)]])
+
+		self.counts = pd.concat([self.counts, counts]).groupby(["CustomerID", "kind", "key"], sort=False)["n"].sum().reset_index()
+		self.daily = pd.concat([self.daily, daily]).groupby(["CustomerID", "day"], sort=False).sum().reset_index()
+
+		return changed
+
+	def sec_mtype_counts(self):
+
+		return self.counts.loc[self.counts["kind"] == "MTypeSecondary"].groupby("key", sort=False)["n"].sum()
@@ -0,0 +1,123 @@
+"""
+Check that the profile the database makes (PROFILE_MODE = pushdown, see DataHandler.download_aggregates) is the profile
+made of the downloaded transactions: both are made of the same synthetic transactions (see synthetic_data, PARITY_SIZE
+rows) in a SQLite stand-in of the TEGA tables kept in PARITY_DIR, once for every GET_NROWS in PARITY_NROWS (* for all
+the rows, a number for the first rows only), and compared feature by feature and customer by customer; the sums of the
+database may differ from those of pandas in the last digits, so the features are compared to PARITY_RTOL;
+the script exits with 1 if any of the profiles differ
+
+run as
+	python pushdown_parity.py
+
+"""
+
+import os
+import sys
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+
+from data_handler import DataHandler
+from cust_profile_creator import CustProfileCreator
+from rank_features import read_config
+from synthetic_data import make_transactions, to_sqlite
+
+class PushdownParity(object):
+
+	def __init__(self, pars):
+
+		self.pars = pars
+		self.size = int(float(pars["PARITY_SIZE"] or 20000))
+		self.nrows = pars["PARITY_NROWS"].split() or ["*", str(self.size//2)]
+		self.parity_dir = pars["PARITY_DIR"] or "./data/parity"
+		self.rtol = float(pars["PARITY_RTOL"] or 1e-6)
+		self.end_date = "2017-01-01"  # the synthetic transactions go back 3 years from this date
+
+		self.results = pd.DataFrame()
+
+	#
+	# the configuration for GET_NROWS = nrows: the synthetic database, the duplicates dropped (the only policy pushdown
+	# has) and a dense profile in the parity directory
+	#
+
+	def _nrows_pars(self, nrows):
+
+		pars = defaultdict(str, self.pars)
+		pars.update({"DSN": "sqlite:" + os.path.join(self.parity_dir, "parity_{}.db".format(self.size)), "CUST_DATA_TABLE": "AO_CustData",
+						"TRANS_INFO_TABLE": "AO_SalesFacts", "GET_NROWS": nrows, "ENFORCE_DOWNLOAD": "yes", "DOWNLOAD_CHUNKSIZE": "0",
+						"CACHE_DIR": self.parity_dir, "CUST_PROF_FILE": os.path.join(self.parity_dir, "profile"),
+						"REFERENCE_DATE": self.end_date, "DEDUP_POLICY": "drop_all", "PROFILE_FORMAT": "dense", "PROFILE_MATRIX": "no"})
+
+		return pars
+
+	#
+	# the profile with the population names rather than their codes, by customer and with the features in name order
+	#
+
+	def _comparable(self, fe):
+
+		df = fe.customer_profile.copy()
+		df["Population"] = df["Population"].map(fe.pops_inverse_enc).astype(str)
+
+		return df.set_index("CustomerID").sort_index().sort_index(axis=1)
+
+	def _run_nrows(self, nrows):
+
+		pars = self._nrows_pars(nrows)
+
+		print("---> pushdown parity with GET_NROWS = {}".format(nrows))
+
+		dg = DataHandler(pars)
+		dg.download_or_load(columns=CustProfileCreator.required_columns(pars))
+
+		full = CustProfileCreator(dg.dwnl_tbl, pars)
+		full.create_customer_features()
+		full.create_profile()
+
+		pushdown = CustProfileCreator(pd.DataFrame(columns=CustProfileCreator.REQUIRED_COLUMNS), pars)
+		pushdown.create_customer_features_from_aggregates(*dg.download_aggregates(pushdown.temporal_cutoffs(), pushdown.trans_columns,
+																									pushdown.trans_numeric))
+		pushdown.create_profile()
+
+		a, b = self._comparable(full), self._comparable(pushdown)
+
+		res = {"nrows": nrows, "customers": len(a.index), "features": a.shape[1],
+				"missing_customers": len(a.index.symmetric_difference(b.index)), "missing_features": len(a.columns.symmetric_difference(b.columns)),
+				"differing_customers": np.nan}
+
+		if (res["missing_customers"] == 0) and (res["missing_features"] == 0):
+			b = b.loc[a.index, a.columns]
+			num = [c for c in a if pd.api.types.is_numeric_dtype(a[c]) and pd.api.types.is_numeric_dtype(b[c])]
+			same = pd.DataFrame(np.isclose(a[num].astype(float), b[num].astype(float), rtol=self.rtol, equal_nan=True), index=a.index)
+			same = same.all(axis=1) & (a.drop(columns=num).astype(str) == b.drop(columns=num).astype(str)).all(axis=1)
+			res["differing_customers"] = int((~same).sum())
+
+		res["equal"] = (res["missing_customers"] == 0) and (res["missing_features"] == 0) and (res["differing_customers"] == 0)
+
+		return res
+
+	def run(self):
+
+		if not os.path.exists(self.parity_dir):
+			os.makedirs(self.parity_dir)
+
+		db_file = self._nrows_pars("*")["DSN"][len("sqlite:"):]
+
+		if not os.path.exists(db_file):
+			print("generating the SQLite database {}...".format(db_file))
+			to_sqlite(make_transactions(self.size, end_date=self.end_date), db_file)
+
+		self.results = pd.DataFrame([self._run_nrows(n) for n in self.nrows])
+
+		print("---> pushdown against full profiles on {} synthetic transactions".format(self.size))
+		print(self.results.to_string(index=False))
+
+		return self.results
+
+if __name__ == "__main__":
+
+	config_parameters = read_config()
+
+	results = PushdownParity(config_parameters).run()
+
+	sys.exit(0 if results["equal"].all() else 1)
@@ -1,62 +1,255 @@
+"""
+Rank the customer features by how well they tell the populations apart; run as
 
-from data_handler import DataHandler
-from cust_profile_creator import CustProfileCreator
+	python rank_features.py [command] [--summaries]
 
+where the command is one of
+
+	fetch		: download the transactions into the local cache (see CACHE_DIR)
+	summarize	: print the summaries of the transactions (data info, Mosaic, state and age representation)
+	profile		: create the customer profile (see PROFILE_MODE) and save it to CUST_PROF_FILE
+	rank		: train on the saved profile, rank the features and upload the importances; the model goes to MODEL_FILE
+	score		: predict the populations of new customers with the saved model (see customer_scorer)
+	compare		: fit time, memory and ranking stability of every estimator backend on the saved profile (see backend_comparison)
+	all		: profile and rank (the default)
+
+and --summaries prints the summaries while fetching and profiling, too (they are left out otherwise); the commands pass
+their results on through the files they save and import only the modules they need, so that e.g. a scheduled profile
+refresh never loads scikit-learn nor spends any time on the summaries
+
+"""
+
+import argparse
+import pprint  # pretty print..
 from collections import defaultdict, Counter
 
-import pyodbc
-import pprint  # pretty print.. 
-import pandas as pd
-import pickle
-import time
-import os.path
-import numpy as np
+COMMANDS = ["fetch", "summarize", "profile", "rank", "score", "compare", "all"]
 
-# machine learning related
-import sklearn
-from sklearn.model_selection import train_test_split, GridSearchCV
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.metrics import accuracy_score
+def read_config(path="config.info"):
 
-if __name__ == "__main__":
-	
 	config_parameters = defaultdict(str)
 
-	# read the configuration file
-
 	try:
-		with open("config.info", "r") as f:
+		with open(path, "r") as f:
 			for line in f:
 				if ("=" in line) and ("#" not in line):
 					tokens = [w.strip() for w in line.split("=")]
 					config_parameters[tokens[0]] = tokens[1]
 	except IOError as e:
-		print("I/O error ({}): {}".format(e.errno, e.sterror))
+		print("I/O error ({}): {}".format(e.errno, e.strerror))
 
+	return config_parameters
 
-	pp = pprint.PrettyPrinter(indent=1)
-	pp.pprint(config_parameters)
-	
-	# get table from the TEGA SQL database
+#
+# get table from the TEGA SQL database (or the local cache); summaries: show the first rows and a summary of it
+#
+
+def fetch(config_parameters, prof, summaries=False):
+
+	from data_handler import DataHandler
+	from cust_profile_creator import CustProfileCreator
 
 	dg = DataHandler(config_parameters)  # create DataHandler object
-	dg.download_or_load()  # either download tables or load from local drive
-	dg.show_table(4)
 
-	# create customer profile data frame
+	with prof.stage("download") as st:
+		dg.download_or_load(columns=CustProfileCreator.required_columns(config_parameters))  # either download tables or load from local drive
+		st["rows_out"] = len(dg.dwnl_tbl.index)
+
+	if summaries:
+		dg.show_table(4)
+
+	return dg
+
+def _show_summaries(fe, config_parameters):
 
-	fe = CustProfileCreator(dg.dwnl_tbl, config_parameters)
 	fe.data_summary()
 	fe.show_mosaic_representation()
 	fe.show_cust_state_representation()
 	fe.show_cust_age_representation()
-	fe.create_customer_features()
-	print("creating customer profile...")
-	fe.create_profile()
-	
+
+	fe.summary().save(config_parameters["SUMMARY_FILE"] or "./data/data_summary.json")
+
+def summarize(config_parameters, prof):
+
+	from cust_profile_creator import CustProfileCreator
+
+	dg = fetch(config_parameters, prof, summaries=True)
+
+	with prof.stage("summary", rows_in=len(dg.dwnl_tbl.index)):
+		_show_summaries(CustProfileCreator(dg.dwnl_tbl, config_parameters), config_parameters)
+
+#
+# create the customer profile the way PROFILE_MODE says and save it
+#
+
+def profile(config_parameters, prof, cache, summaries=False):
+
+	import pandas as pd
+	from data_handler import DataHandler
+	from cust_profile_creator import CustProfileCreator
+
+	mode = config_parameters["PROFILE_MODE"].strip().lower()
+
+	if mode == "incremental":
+
+		# pull only the transactions since the last run and update the customer profile with them
+
+		from profile_state import ProfileState
+		from table_store import cache_format
+
+		dg = DataHandler(config_parameters)
+		state = ProfileState(config_parameters["PROFILE_STATE_DIR"], cache_format(config_parameters["CACHE_FORMAT"])).load()
+
+		with prof.stage("download") as st:
+			new_trans = dg.download_since(state.hwm, columns=CustProfileCreator.required_columns(config_parameters))
+			st["rows_out"] = len(new_trans.index)
+
+		with prof.stage("update_profile", rows_in=len(new_trans.index)) as st:
+			fe = CustProfileCreator(new_trans, config_parameters)
+			print("updating customer profile...")
+			fe.update_profile(state)
+			st["rows_out"] = len(fe.ucustomer_ids)
+
+	elif mode == "pushdown":
+
+		# let the database collapse the transactions into per-customer aggregates and make the features of these
+
+		dg = DataHandler(config_parameters)
+		fe = CustProfileCreator(pd.DataFrame(columns=CustProfileCreator.REQUIRED_COLUMNS), config_parameters)
+
+		with prof.stage("download_aggregates") as st:
+			aggregates = dg.download_aggregates(fe.temporal_cutoffs(), fe.trans_columns, fe.trans_numeric)
+			st["rows_out"] = sum(len(a.index) for a in aggregates)
+
+		with prof.stage("features", rows_in=sum(len(a.index) for a in aggregates)) as st:
+			fe.create_customer_features_from_aggregates(*aggregates)
+			st["rows_out"] = len(fe.cust_feature_long.index)
+
+		with prof.stage("profile", rows_in=len(fe.cust_feature_long.index)) as st:
+			print("creating customer profile...")
+			fe.create_profile()
+			st["rows_out"] = len(fe.ucustomer_ids)
+
+	elif mode == "sharded":
+
+		# more transactions than memory: split them into shards by customer and make the features shard by shard
+
+		from sharded_profile import ShardedProfileBuilder
+
+		with prof.stage("sharded_features") as st:
+			fe = ShardedProfileBuilder(config_parameters).build(DataHandler(config_parameters))
+			st["rows_out"] = len(fe.ucustomer_ids)
+
+		with prof.stage("profile", rows_in=len(fe.cust_feature_long.index)) as st:
+			print("creating customer profile...")
+			fe.create_profile()
+			st["rows_out"] = len(fe.ucustomer_ids)
+
+	else:
+
+		from artifact_cache import PROFILE_KEYS, frame_fingerprint, file_fingerprint
+
+		dg = fetch(config_parameters, prof, summaries)
+
+		# the same transactions, configuration and Mosaic rules make the same profile, so it may be in the artifact cache
+
+		profile_key = cache.key(PROFILE_KEYS, frame_fingerprint(dg.dwnl_tbl), 
+									file_fingerprint(config_parameters["MOSAIC_CLASSES_FILE"] or "mosaic_classes.info")) if cache.enabled else None
+		cached_profile = cache.get("profile", profile_key)
+
+		if cached_profile is not None:
+
+			fe = CustProfileCreator(dg.dwnl_tbl.iloc[:0], config_parameters)
+			fe.restore_profile(cached_profile)
+			fe.save_profile()
+
+		else:
+
+			# create customer profile data frame
+
+			fe = CustProfileCreator(dg.dwnl_tbl, config_parameters)
+
+			if summaries:
+				with prof.stage("summary", rows_in=len(dg.dwnl_tbl.index)):
+					_show_summaries(fe, config_parameters)
+
+			with prof.stage("features", rows_in=len(fe.df.index)) as st:
+				fe.create_customer_features()
+				st["rows_out"] = len(fe.ucustomer_ids)
+
+			with prof.stage("profile", rows_in=len(fe.ucustomer_ids)) as st:
+				print("creating customer profile...")
+				fe.create_profile()
+				st["rows_out"] = fe.customer_profile.shape[0] if fe.customer_matrix is None else fe.customer_matrix.shape[0]
+
+			cache.put("profile", profile_key, fe.profile_artifacts())
+
 	print("customers included in the profile belong to the following {} classes:{}".format(len(fe.pops), fe.pops))
-	
-	# 
+
+	return fe
+
+#
+# the profile (the one just created or else the one saved) and the customers in it who have a label, i.e. are in one 
+# population only: the features, the labels, the positions of these customers in a memory-mapped feature matrix
+# (None unless there is one) and the feature names
+#
+
+def labelled_data(config_parameters, fe=None):
+
+	import numpy as np
+	import pandas as pd
+	from cust_profile_creator import CustProfileCreator
+
+	if fe is None:
+		fe = CustProfileCreator(pd.DataFrame(columns=CustProfileCreator.REQUIRED_COLUMNS), config_parameters)
+		fe.load_profile()
+
+	rows = None  # positions of the labelled customers in a memory-mapped feature matrix
+
+	if fe.matrix_file is not None:
+		# memory-mapped dense profile; X stays on disk with all the customers and rows picks the labelled ones
+		fe.customer_profile = pd.DataFrame()  # the matrix has it all
+		X, labels = fe.feature_matrix()
+		rows = np.flatnonzero(~np.isnan(labels))
+		y = labels[rows].astype(int)
+		feature_names = fe.feature_names
+	elif fe.customer_matrix is not None:
+		# sparse profile; only the customers who are in one population have a label
+		labelled = ~np.isnan(fe.customer_labels)
+		X, y = fe.customer_matrix[labelled], fe.customer_labels[labelled].astype(int)
+		feature_names = fe.feature_names
+	else:
+		# likewise for the dense profile
+		labelled = fe.customer_profile["Population"].notnull()
+		X = fe.customer_profile.loc[labelled, [c for c in list(fe.customer_profile) if c not in ["Population", "CustomerID"]]]
+		y = fe.customer_profile.loc[labelled,"Population"].astype(int)
+		feature_names = list(X)
+
+	return (fe, X, y, rows, feature_names)
+
+#
+# train on the profile (the one just created or else the one saved), rank the features and upload the importances
+#
+
+def rank(config_parameters, prof, cache, fe=None):
+
+	import numpy as np
+	from scipy import sparse
+
+	# machine learning related
+	import sklearn
+	from sklearn.model_selection import train_test_split
+	from sklearn.metrics import accuracy_score
+
+	from artifact_cache import RANKING_KEYS
+	from data_handler import DataHandler
+	from model_search import ModelSearch, data_fingerprint
+	from estimator_backends import get_backend
+	from feature_ranking import FeatureRanker
+	from batch_ranking import BatchRanker
+	from customer_scorer import save_model
+
+	#
 	# prediction
 
 	print("you are using scikit-learn version {}...".format(sklearn.__version__))
@@ -64,80 +257,158 @@ if __name__ == "__main__":
 	# training and testing set
 	# # note: splitting so that customers from each population comprise the same proportion in both the training and teting sets
 
-	X_train, X_test, y_train, y_test = train_test_split(fe.customer_profile.loc[:, [c for c in list(fe.customer_profile) if c not in ["Population", "CustomerID"]]],
-														 fe.customer_profile.loc[:,"Population"],
-								 test_size=0.2, stratify=fe.customer_profile.Population, random_state=113)
+	fe, X, y, rows, feature_names = labelled_data(config_parameters, fe)
+
+	# the same profile and configuration give the same split, model and importances
 
-	print("created the training and testing sets; the training set contains {} customers and the testing set {} customers...".format(len(X_train.index), len(X_test.index)))
-	print("in the training set, each population represented as below:")
-	print({fe.pops_inverse_enc[k]: v for k, v in Counter(y_train).items()})
-	# print("y_train:",y_train)
+	ranking_key = cache.key(RANKING_KEYS, data_fingerprint(X, y, rows), feature_names, sorted(fe.pops_inverse_enc.items())) if cache.enabled else None
+	cached_ranking = cache.get("ranking", ranking_key)
 
-	rf_parameters = {'n_estimators': np.arange(1,12,1).tolist(),'min_weight_fraction_leaf':np.arange(0.01,0.5,0.01).tolist()}
+	if cached_ranking is not None:
 
-	forest = RandomForestClassifier()
-	rf_grid = GridSearchCV(forest, rf_parameters)
-	print("training random forests...")
-	rf_grid.fit(X_train, y_train)
-	# print("best parameter values:", rf_grid.best_params_)
-	best_forest = rf_grid.best_estimator_
-	# best_rf.fit(X_train, y_train)
-	print("accuracy score is {}".format(round(accuracy_score(y_test, rf_grid.predict(X_test)), 2)))
+		importances = cached_ranking["importances"]
+		if "accuracy" in cached_ranking:
+			print("accuracy score is {}".format(cached_ranking["accuracy"]))
+		if "estimator" in cached_ranking:
+			save_model(config_parameters["MODEL_FILE"] or "./data/model.pkl", cached_ranking["estimator"], fe, feature_names, config_parameters)
 
-	# fimps = sorted( zip(list(X_test), best_forest.feature_importances_), key=lambda x: x[1], reverse=True)[:20]
+	elif config_parameters["RANKING_MODE"].strip().lower() == "batch":
 
-	# upload_df = pd.DataFrame({"feature":[k for k, v in fimps], "importance":[ "%.3f" % v for k,v in fimps]})
-	# upload_df["importance"] = upload_df["importance"].astype(float)
+		# one job per population comparison over the same feature matrix
 
-	# # print(upload_df)
+		with prof.stage("batch_ranking", rows_in=len(y)) as st:
+			importances = BatchRanker(config_parameters).rank(X, y, feature_names, fe.pops_inverse_enc, rows)
+			st["rows_out"] = len(importances.index)
 
-	# upload_df.to_csv("./data/importances_df.csv", sep="\t", index=False)
+		cache.put("ranking", ranking_key, {"importances": importances})
 
-	# # connect using the same details as before
-	# conn = pyodbc.connect(dg.auth)
-	# cursor = conn.cursor()
+	else:
 
-	# # first check if the table already exists
-	
-	
-	# fimps_ifexists_drop_quesry = ("IF OBJECT_ID(N'" + config_parameters["TABLE_FEATURE_IMPORTANCES"] + "', N'U') IS NOT NULL BEGIN DROP TABLE " + config_parameters["TABLE_FEATURE_IMPORTANCES"] + " END;")
-	# cursor.execute(fimps_ifexists_drop_quesry)
+		# split the positions of the customers so that the split can be kept with the model
+		train_idx, test_idx = train_test_split(np.arange(len(y)), test_size=0.2, stratify=y, random_state=113)
 
-	# fimps_new_table_query = ("CREATE TABLE " + config_parameters["TABLE_FEATURE_IMPORTANCES"] + 
-	# 							" (feature varchar(255), importance real);")
-	
-	# cursor.execute(fimps_new_table_query)
-	# print("created a new table called", config_parameters["TABLE_FEATURE_IMPORTANCES"])
-	
-	# time_now = time.time()
-	# print("uploading feature importances to the table...")
+		if hasattr(X, "iloc"):
+			# the model is fitted on the values (see ModelSearch.fit), so it is tested on them too rather than on a frame
+			# with feature names it wasn't fitted with
+			X_train, X_test, y_train, y_test = X.iloc[train_idx], X.iloc[test_idx].values, y.iloc[train_idx], y.iloc[test_idx]
+		elif rows is not None:
+			# the training set stays in the mapped matrix (the search takes its rows), the testing set is read into memory
+			X_train, X_test, y_train, y_test = X, np.array(X[rows[test_idx]]), y[train_idx], y[test_idx]
+		else:
+			X_train, X_test, y_train, y_test = X[train_idx], X[test_idx], y[train_idx], y[test_idx]
 
-	# for row in upload_df.itertuples():
+		backend = get_backend(config_parameters["ESTIMATOR_BACKEND"])
+		if backend.dense_input and sparse.issparse(X_test):
+			X_test = X_test.toarray()
 
-	# 	row_feature = row[1]
-	# 	row_importance = row[2]
+		print("created the training and testing sets; the training set contains {} customers and the testing set {} customers...".format(len(train_idx), len(test_idx)))
+		print("in the training set, each population represented as below:")
+		print({fe.pops_inverse_enc[k]: v for k, v in Counter(y_train).items()})
+		# print("y_train:",y_train)
 
-	# 	add_values_query = ("INSERT INTO " + config_parameters["TABLE_FEATURE_IMPORTANCES"] + " (feature, importance)" + 
-	# 										" values (" + "'" + row_feature + "'"  + "," + str(row_importance) + ");")
-	# 	cursor.execute(add_values_query)
+		with prof.stage("fit", rows_in=len(train_idx)):
+			search = ModelSearch(config_parameters)
+			print("training {} models...".format(backend.name))
+			best_model = search.fit(X_train, y_train, None if rows is None else rows[train_idx])
 
-	# conn.commit()
+		with prof.stage("score", rows_in=X_test.shape[0]):
+			accuracy = round(accuracy_score(y_test, best_model.predict(X_test)), 2)
+			print("accuracy score is {}".format(accuracy))
 
-	# time_after = time.time()
+		# rank the features
 
-	# print("done. elapsed time {} sec".format(round((time_after-time_now),1)))
-	# # bulk_insert_query = ("BULK INSERT " + config_parameters["TABLE_FEATURE_IMPORTANCES"] + 
-	# # 							" FROM './data/importances_df.csv' WITH (FIELDTERMINATOR='\\t',ROWTERMINATOR='\\n');")
-	# # cursor.execute(bulk_insert_query)
-	# # conn.commit()
+		with prof.stage("ranking", rows_in=X_test.shape[0]) as st:
+			ranker = FeatureRanker(config_parameters)
+			importances = ranker.rank(best_model, X_test, y_test, feature_names)
+			st["rows_out"] = len(importances.index)
 
-	# cursor.close()
-	# conn.close()
+		# the model and its feature columns, to score new customers with (rank_features.py score)
+		save_model(config_parameters["MODEL_FILE"] or "./data/model.pkl", best_model, fe, feature_names, config_parameters)
 
+		cache.put("ranking", ranking_key, {"train_idx": train_idx, "test_idx": test_idx, "estimator": best_model,
+																			"accuracy": accuracy, "importances": importances})
 
+	importances.to_csv(config_parameters["IMPORTANCES_FILE"] or "./data/importances_df.csv", sep="\t", index=False)
+	print("top features:")
+	print(importances.loc[importances["rank"] <= 10, [c for c in ["job", "method", "rank", "feature", "importance", "ci_low", "ci_high"]
+																					if c in importances]].to_string(index=False))
 
+	# upload the importances
 
+	dg = DataHandler(config_parameters)
 
+	with prof.stage("upload", rows_in=len(importances.index)):
+		dg.write_results(importances, config_parameters["TABLE_FEATURE_IMPORTANCES"])
+		dg.close_connections()
 
+	return importances
 
+#
+# fit and rank with every backend in COMPARE_BACKENDS on the same profile and split (see backend_comparison)
+#
+
+def compare(config_parameters, prof, fe=None):
+
+	import numpy as np
+	from sklearn.model_selection import train_test_split
+	from backend_comparison import BackendComparison
+
+	fe, X, y, rows, feature_names = labelled_data(config_parameters, fe)
+	train_idx, test_idx = train_test_split(np.arange(len(y)), test_size=0.2, stratify=y, random_state=113)
+
+	with prof.stage("compare_backends", rows_in=len(y)) as st:
+		results = BackendComparison(config_parameters).run(X, y, feature_names, train_idx, test_idx, rows)
+		st["rows_out"] = len(results.index)
+
+	return results
+
+#
+# the populations of the customers in the scoring tables as predicted by the model rank saved
+#
+
+def score(config_parameters, prof):
+
+	from customer_scorer import CustomerScorer
+
+	scorer = CustomerScorer(config_parameters).load_model()
+
+	with prof.stage("score") as st:
+		st["rows_out"] = scorer.score()
+		st["rows_in"] = int(scorer.throughput["transactions"].sum())
+
+	return scorer
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="rank the customer features that tell the populations apart")
+	parser.add_argument("command", nargs="?", default="all", choices=COMMANDS, help="what to do (default: all, i.e. profile and rank)")
+	parser.add_argument("--summaries", action="store_true", help="print the summaries of the transactions while fetching and profiling")
+	args = parser.parse_args()
+
+	config_parameters = read_config()
+
+	pp = pprint.PrettyPrinter(indent=1)
+	pp.pprint(config_parameters)
 
+	from stage_profiler import StageProfiler
+	from artifact_cache import ArtifactCache
+
+	prof = StageProfiler(config_parameters)  # time and memory by stage
+	cache = ArtifactCache(config_parameters)  # profiles and rankings made before of the same data and configuration
+
+	if args.command == "fetch":
+		fetch(config_parameters, prof, args.summaries)
+	elif args.command == "summarize":
+		summarize(config_parameters, prof)
+	elif args.command == "profile":
+		profile(config_parameters, prof, cache, args.summaries)
+	elif args.command == "rank":
+		rank(config_parameters, prof, cache)
+	elif args.command == "score":
+		score(config_parameters, prof)
+	elif args.command == "compare":
+		compare(config_parameters, prof)
+	else:
+		rank(config_parameters, prof, cache, profile(config_parameters, prof, cache, args.summaries))
+
+	prof.save()
@@ -0,0 +1,100 @@
+"""
+Out-of-core customer profile for transaction tables that don't fit in memory: DataHandler.download_to_shards partitions
+the transactions by a hash of CustomerID into PROFILE_SHARDS on-disk shards, so that all the transactions of a customer
+(and every copy of a transaction) end up in the same shard and dropping the (CustomerID, transID) pairs that come up more
+than once is as exact as on the whole table; then, in SHARD_N_JOBS worker processes,
+
+	pass 1: every shard is loaded on its own, its duplicates dropped and its transactions collapsed into per-customer
+			aggregates (see CustProfileCreator._aggregate_transactions), which are saved next to the shard
+	pass 2: with the populations and secondary MType counts of all the shards put together, the features are made
+			of every shard's aggregates
+
+and the features of all the shards are concatenated into one CustProfileCreator ready for create_profile
+
+"""
+
+import os
+import pandas as pd
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from cust_profile_creator import CustProfileCreator
+from table_store import ChunkStore, cache_format
+
+def _aggregate_store(shard_path, part, fmt):
+
+	return ChunkStore(shard_path[:-len(fmt.extension)] + "_" + part + fmt.extension, fmt)
+
+def _aggregate_shard(shard_path, pars):
+
+	pars = defaultdict(str, pars)
+	fmt = cache_format(pars["CACHE_FORMAT"])
+	fe = CustProfileCreator(ChunkStore(shard_path, fmt).read(), pars)  # drops the duplicates
+	attrs, counts, daily = fe._aggregate_transactions(fe.df)
+
+	_aggregate_store(shard_path, "attrs", fmt).write(attrs.reset_index())
+	_aggregate_store(shard_path, "counts", fmt).write(counts)
+	_aggregate_store(shard_path, "daily", fmt).write(daily)
+
+	return (set(p for p in fe.pops if pd.notnull(p)), counts.loc[counts["kind"] == "MTypeSecondary"].groupby("key")["n"].sum(), 
+				counts.loc[counts["kind"].isin(fe.trans_columns)].groupby(["kind", "key"])["n"].sum())
+
+def _shard_features(shard_path, pars, pops_enc, popular_sec_mtypes, trans_vocab):
+
+	pars = defaultdict(str, pars)
+	fmt = cache_format(pars["CACHE_FORMAT"])
+	attrs, counts, daily = [_aggregate_store(shard_path, part, fmt).read() for part in ["attrs", "counts", "daily"]]
+
+	fe = CustProfileCreator(pd.DataFrame(columns=CustProfileCreator.REQUIRED_COLUMNS), pars)
+	fe.create_customer_features_from_aggregates(attrs.set_index("CustomerID"), counts, daily, pops_enc, popular_sec_mtypes, trans_vocab)
+
+	return fe.cust_feature_long
+
+class ShardedProfileBuilder(object):
+
+	def __init__(self, pars):
+
+		self.pars = pars
+		self.n_shards = int(pars["PROFILE_SHARDS"] or 16)
+		self.shard_dir = pars["SHARD_DIR"] or "./data/shards"
+		self.n_jobs = int(pars["SHARD_N_JOBS"] or 0) or os.cpu_count()
+
+		self.shards = []
+
+	def build(self, dg, columns=None):
+
+		self.shards = dg.download_to_shards(self.shard_dir, self.n_shards, columns or CustProfileCreator.required_columns(self.pars))
+		pars = dict(self.pars)
+		executor = ProcessPoolExecutor if self.n_jobs > 1 else ThreadPoolExecutor
+
+		with executor(max_workers=self.n_jobs) as pool:
+
+			print("aggregating {} shards, {} workers...".format(len(self.shards), self.n_jobs))
+			pops, sec_counts, trans_counts = set(), [], []
+			for shard_pops, shard_sec_counts, shard_trans_counts in pool.map(_aggregate_shard, self.shards, [pars]*len(self.shards)):
+				pops |= shard_pops
+				sec_counts.append(shard_sec_counts)
+				trans_counts.append(shard_trans_counts)
+
+			# what the features of every shard have to agree on
+			fe = CustProfileCreator(pd.DataFrame(columns=CustProfileCreator.REQUIRED_COLUMNS), defaultdict(str, pars))
+			pops_enc = dict(zip(sorted(pops, key=str), range(1, len(pops) + 1)))
+			popular_sec_mtypes = fe._popular_sec_mtypes(pd.concat(sec_counts).groupby(level=0).sum())
+			trans_vocab = fe._trans_vocab(pd.concat(trans_counts).groupby(level=[0, 1]).sum()) if fe.trans_mode == "vocab" else None
+
+			print("creating features for {} shards...".format(len(self.shards)))
+			features = list(pool.map(_shard_features, self.shards, [pars]*len(self.shards), [pops_enc]*len(self.shards),
+																						[popular_sec_mtypes]*len(self.shards), [trans_vocab]*len(self.shards)))
+
+		fe.ucustomer_ids = [c for f in features for c in f["CustomerID"].unique()]
+		fe.pops, fe.pops_enc = set(pops_enc), pops_enc
+		fe.pops_inverse_enc = {v: k for k, v in pops_enc.items()}
+		fe.popular_sec_mtypes = popular_sec_mtypes
+		fe.list_popular_sec_mtypes = [tp for tp, co in popular_sec_mtypes]
+		fe.trans_vocab = trans_vocab
+		fe.cust_feature_long = pd.concat(features, ignore_index=True)
+		fe._register_features(fe.cust_feature_long)
+
+		print("features for {} customers from {} shards...".format(len(fe.ucustomer_ids), len(self.shards)))
+
+		return fe
@@ -0,0 +1,119 @@
+"""
+Timing and memory of the stages of a ranking run (download, profile, fit, ...); for every stage we record
+
+	wall_sec, cpu_sec	: elapsed wall-clock and CPU (user + system) time
+	peak_rss_mb			: the peak resident memory of the process so far, i.e. cumulative: a stage that needs less than one
+						  before it reports that stage's peak (where the resource module is available)
+	rss_added_mb		: how much the stage raised that peak, so the memory the stage itself needed on top of what the
+						  process had ever held before it (0 if it stayed under the earlier peak)
+	rows_in, rows_out	: as many rows as the stage reports going in and out
+	rows_per_sec		: rows in (or out if nothing went in) per wall-clock second
+
+and the report goes to STAGE_REPORT_FILE as JSON; STAGE_DEEP_PROFILE = cprofile or tracemalloc also dumps a cProfile
+file or the top allocations of every stage into STAGE_DUMP_DIR; with PROFILE_STAGES = no the stages cost nothing
+
+"""
+
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+	import resource
+except ImportError:  # not on Windows
+	resource = None
+
+def _peak_rss_mb():
+
+	if resource is None:
+		return None
+
+	return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, 1)  # kilobytes on Linux
+
+class StageProfiler(object):
+
+	def __init__(self, pars):
+
+		self.enabled = (pars["PROFILE_STAGES"].lower().strip() == "yes")
+		self.report_file = pars["STAGE_REPORT_FILE"] or "./data/stage_report.json"
+		self.deep = pars["STAGE_DEEP_PROFILE"].lower().strip() or "none"
+		self.dump_dir = pars["STAGE_DUMP_DIR"] or "./data/stage_dumps"
+
+		if self.deep not in ["none", "cprofile", "tracemalloc"]:
+			raise ValueError("error! unknown deep profile {}; choose from none, cprofile or tracemalloc...".format(self.deep))
+
+		self.started = time.strftime("%Y-%m-%d %H:%M:%S")
+		self.stages = []
+
+	#
+	# time a stage:
+	#
+	# with profiler.stage("download") as st:
+	#	...
+	#	st["rows_out"] = len(df.index)
+	#
+
+	@contextmanager
+	def stage(self, name, rows_in=None):
+
+		rec = {"stage": name, "rows_in": rows_in, "rows_out": None}
+
+		if not self.enabled:
+			yield rec
+			return
+
+		if self.deep != "none" and not os.path.exists(self.dump_dir):
+			os.makedirs(self.dump_dir)
+
+		prof = cProfile.Profile() if self.deep == "cprofile" else None
+
+		if self.deep == "tracemalloc":
+			tracemalloc.start()
+		if prof is not None:
+			prof.enable()
+
+		wall_start, cpu_start, rss_start = time.perf_counter(), time.process_time(), _peak_rss_mb()
+
+		try:
+			yield rec
+		finally:
+
+			rec["wall_sec"] = round(time.perf_counter() - wall_start, 3)
+			rec["cpu_sec"] = round(time.process_time() - cpu_start, 3)
+
+			if prof is not None:
+				prof.disable()
+				prof.dump_stats(os.path.join(self.dump_dir, name + ".prof"))
+
+			if self.deep == "tracemalloc":
+				rec["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1]/1024**2, 1)
+				with open(os.path.join(self.dump_dir, name + ".tracemalloc.txt"), "w") as f:
+					for s in tracemalloc.take_snapshot().statistics("lineno")[:25]:
+						f.write(str(s) + "\n")
+				tracemalloc.stop()
+
+			rec["peak_rss_mb"] = _peak_rss_mb()
+			rec["rss_added_mb"] = None if rss_start is None else round(rec["peak_rss_mb"] - rss_start, 1)
+			rows = rec["rows_in"] if rec["rows_in"] is not None else rec["rows_out"]
+			rec["rows_per_sec"] = None if rows is None else round(rows/max(rec["wall_sec"], 1e-6))
+
+			self.stages.append(rec)
+
+	def save(self):
+
+		if not self.enabled:
+			return
+
+		os.makedirs(os.path.dirname(self.report_file) or ".", exist_ok=True)
+
+		with open(self.report_file, "w") as f:
+			json.dump({"started": self.started, "deep_profile": self.deep, "stages": self.stages}, f, indent=1)
+
+		print("---> time by stage (sec)")
+		for rec in self.stages:
+			print("{}:\twall {}\tcpu {}\tpeak RSS so far {} MB (+{} MB)\trows/sec {}".format(rec["stage"], rec["wall_sec"], rec["cpu_sec"],
+																		rec["peak_rss_mb"], rec["rss_added_mb"], rec["rows_per_sec"]))
+		print("saved stage report to {}...".format(self.report_file))
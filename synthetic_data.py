@@ -0,0 +1,104 @@
+"""
+Synthetic transaction data with the columns of DataHandler.join_tabs_query (in the compact dtypes of TRANSACTION_SCHEMA)
+for benchmarking without access to the TEGA database:
+
+	customers			: about one per 8 transactions; the number of transactions per customer is skewed (a few buy a lot)
+	customer attributes	: Gender, ageGroup (some UNK and missing), CustomerState (by state population), MosaicType (the 49
+						  types, 10% missing) and the population the customer is in, all fixed per customer
+	transactions		: MTypePrimary (8 types) and MTypeSecondary (60, Zipf-like plus some junk), events and shows, sales
+						  and admissions, dates over the 3 years before the end date; about 1% of the transactions come up
+						  again under another population (like customers who are in two populations do)
+
+the same arguments always give the same data
+
+"""
+
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from data_handler import TRANSACTION_SCHEMA
+
+POPULATIONS = ["AO2010", "AO2016", "AO2017", "MTC2016"]
+STATES = {"NSW": 7704.3, "VIC": 6039.1, "QLD": 4827.0, "SA": 1706.5, "WA": 2613.7, "TAS": 518.5, "NT": 244.0, "ACT": 395.2}
+MTYPES_PRIMARY = ["Sport", "Music", "Theatre", "Family", "Comedy", "Festival", "Arts", "---"]
+
+# the Mosaic types A01..M49: four types per letter, the rest in M
+MOSAIC_TYPES = ["{}{:02d}".format("ABCDEFGHIJKLM"[min((i - 1)//4, 12)], i) for i in range(1, 50)]
+
+def _zipf_probs(n, a=1.1):
+
+	p = 1/np.arange(1, n + 1)**a
+
+	return p/p.sum()
+
+def make_transactions(n_rows, n_customers=None, seed=113, end_date="2017-01-01"):
+
+	rng = np.random.RandomState(seed)
+	n_customers = n_customers or max(1, n_rows//8)
+
+	#
+	# customers
+	#
+	cust_ids = 1000000 + rng.permutation(5*n_customers)[:n_customers].astype("int64")
+	mosaic = np.array(MOSAIC_TYPES + [None], dtype=object)[np.where(rng.rand(n_customers) < 0.1, 49, rng.randint(0, 49, n_customers))]
+	age = rng.choice(np.array(["18-24", "25-34", "35-44", "45-54", "55-64", "65+", "UNK", None], dtype=object), n_customers,
+																	p=[0.08, 0.18, 0.2, 0.18, 0.14, 0.1, 0.08, 0.04])
+	gender = rng.choice(["M", "F", "U"], n_customers, p=[0.46, 0.48, 0.06])
+	state = rng.choice(list(STATES), n_customers, p=np.array(list(STATES.values()))/sum(STATES.values()))
+	pop = rng.choice(POPULATIONS, n_customers, p=[0.4, 0.3, 0.2, 0.1])
+
+	# skewed number of transactions per customer
+	weights = np.minimum(1 + rng.pareto(1.5, n_customers), 500)
+	who = rng.choice(n_customers, n_rows, p=weights/weights.sum())
+
+	#
+	# transactions
+	#
+	secondary = ["{}_{}".format(MTYPES_PRIMARY[i % 7], i) for i in range(57)] + ["---", "N/A", "UNKNOWN"]
+	days = rng.randint(0, 3*365, n_rows)
+
+	df = pd.DataFrame({"CustomerID": cust_ids[who], "Gender": gender[who], "ageGroup": age[who], "MosaicType": mosaic[who],
+						"CustomerState": state[who], "CustPop": pop[who], "SalePop": pop[who], "transID": np.arange(n_rows, dtype="int64") + 1,
+						"DaysAhead": rng.randint(0, 365, n_rows), "ValueAdmitQty": rng.randint(0, 5, n_rows),
+						"AdmitQty": 1 + rng.poisson(1.2, n_rows), "Sales": np.round(rng.gamma(2.0, 60.0, n_rows), 2),
+						"VenueState": rng.choice(list(STATES), n_rows), "pk_event_dim": rng.randint(1, 5000, n_rows),
+						"CancelledFlag": (rng.rand(n_rows) < 0.02).astype(int), "BChannel": rng.choice(["Internet", "Phone", "Box Office", "Agent"], n_rows),
+						"MTypePrimary": rng.choice(MTYPES_PRIMARY, n_rows, p=_zipf_probs(len(MTYPES_PRIMARY))),
+						"MTypeSecondary": rng.choice(secondary, n_rows, p=_zipf_probs(len(secondary))),
+						"CardType": rng.choice(["VISA", "MASTERCARD", "AMEX", "DINERS"], n_rows),
+						"EventNameStandard": np.char.add("event_", rng.randint(0, 2000, n_rows).astype(str)),
+						"PrimaryShow": np.char.add("show_", rng.randint(0, 500, n_rows).astype(str)), "PrimaryShowDesc": "",
+						"pk_attribute_dim": rng.randint(1, 200, n_rows),
+						"transactionDate": pd.Timestamp(end_date) - pd.to_timedelta(days, unit="D") + pd.to_timedelta(rng.randint(0, 86400, n_rows), unit="s")})
+
+	df["PrimaryShowDesc"] = df["PrimaryShow"]
+
+	# some transactions come up again under another population
+	again = df.sample(frac=0.01, random_state=seed)
+	again["SalePop"] = rng.choice(POPULATIONS, len(again.index))
+	df = pd.concat([df, again], ignore_index=True).sort_values("transactionDate", kind="stable").reset_index(drop=True)
+
+	return df.astype({col: dtype for col, dtype in TRANSACTION_SCHEMA.items() if col in df})
+
+#
+# write the transactions as a customer table and a sales table (like the ones join_tabs_query joins) into a SQLite
+# database, to be read through DataHandler with DSN = sqlite:<path>
+#
+
+def to_sqlite(df, path, cust_tbl="AO_CustData", tran_tbl="AO_SalesFacts", chunksize=100000):
+
+	conn = sqlite3.connect(path)
+
+	cust = df.drop_duplicates(subset=["CustomerID"])[["CustomerID", "Gender", "ageGroup", "MosaicType", "CustomerState", "CustPop"]]
+	cust = cust.rename(columns={"CustomerState": "state", "CustPop": "Population"})
+	cust.astype(object).where(cust.notnull(), None).to_sql(cust_tbl, conn, index=False, if_exists="replace", chunksize=chunksize)
+
+	for i in range(0, len(df.index), chunksize):
+		sales = df.iloc[i:i + chunksize].drop(columns=["Gender", "ageGroup", "MosaicType", "CustomerState", "CustPop"])
+		sales = sales.rename(columns={"SalePop": "Population", "transID": "mj_tnum"})
+		sales["transactionDate"] = sales["transactionDate"].dt.strftime("%Y-%m-%d %H:%M:%S")
+		sales.astype(object).where(sales.notnull(), None).to_sql(tran_tbl, conn, index=False, if_exists="replace" if i == 0 else "append")
+
+	conn.commit()
+	conn.close()
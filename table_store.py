@@ -0,0 +1,214 @@
+"""
+On-disk cache for the data frames we work with (the downloaded transaction table, customer profiles):
+a small format layer with Parquet, Feather and (legacy) pickle backends; the columnar backends support
+reading only some of the columns, filtering row groups and memory-mapped reads, and they can be
+written chunk by chunk so that we never have to hold a whole downloaded table in memory
+
+"""
+
+import hashlib
+import os.path
+import pickle
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.feather as feather
+
+#
+# the key for a cached table: a hash of the query and the configuration parameters that affect the result
+#
+
+def cache_key(query, pars, keys=("DSN", "GET_NROWS", "HANDLE_CUSTOMERS_WITH_NO_MOSAIC_GROUP")):
+
+	h = hashlib.sha1(query.encode("utf-8"))
+
+	for k in keys:
+		h.update("|{}={}".format(k, pars[k]).encode("utf-8"))
+
+	return h.hexdigest()[:16]
+
+#
+# the first chunk decides the schema; strings are stored dictionary-encoded where the format allows
+# a different dictionary in every chunk
+#
+
+def _arrow_schema(chunk, dictionary_strings):
+
+	fields = []
+	str_type = pa.dictionary(pa.int32(), pa.string()) if dictionary_strings else pa.string()
+
+	for f in pa.Schema.from_pandas(chunk, preserve_index=False):
+		if pa.types.is_dictionary(f.type) or pa.types.is_string(f.type) or pa.types.is_large_string(f.type) or pa.types.is_null(f.type):
+			f = pa.field(f.name, str_type)
+		fields.append(f)
+
+	return pa.schema(fields)
+
+#
+# names of the columns used in filters given in the DNF form, i.e. a list of (column, op, value) or a list of such lists
+#
+
+def _filter_columns(filters):
+
+	conjunctions = filters if isinstance(filters[0], list) else [filters]
+
+	return sorted(set(col for conj in conjunctions for col, op, val in conj))
+
+class ParquetFormat(object):
+
+	name = "parquet"
+	extension = ".parquet"
+	dictionary_strings = True
+
+	def write(self, df, path):
+
+		df.to_parquet(path)
+
+	def read(self, path, columns=None, filters=None, memory_map=False):
+
+		# filters are in the DNF form pyarrow understands, e.g. [("transactionDate", ">", some_date)];
+		# row groups whose statistics don't match are skipped
+		return pq.read_table(path, columns=columns, filters=filters, memory_map=memory_map).to_pandas()
+
+	def open_writer(self, path, schema):
+
+		return pq.ParquetWriter(path, schema)
+
+	def iter_batches(self, path, columns=None, batch_size=100000, memory_map=False):
+
+		for batch in pq.ParquetFile(path, memory_map=memory_map).iter_batches(batch_size=batch_size, columns=columns):
+			yield pa.Table.from_batches([batch])
+
+class FeatherFormat(object):
+
+	name = "feather"
+	extension = ".feather"
+	dictionary_strings = False  # an Arrow IPC file can only have one dictionary per column
+
+	def write(self, df, path):
+
+		# uncompressed so that memory-mapped reads don't need to copy anything
+		feather.write_feather(pa.Table.from_pandas(df), path, compression="uncompressed")
+
+	def read(self, path, columns=None, filters=None, memory_map=False):
+
+		if not filters:
+			return feather.read_table(path, columns=columns, memory_map=memory_map).to_pandas()
+
+		# Feather has no row groups to skip, so read the columns we need to filter on too and filter in Arrow
+		expr = pq.filters_to_expression(filters)
+		tbl = feather.read_table(path, columns=None if columns is None else list(columns) + 
+														[c for c in _filter_columns(filters) if c not in columns], memory_map=memory_map)
+		tbl = tbl.filter(expr)
+
+		return (tbl if columns is None else tbl.select(list(columns))).to_pandas()
+
+	def open_writer(self, path, schema):
+
+		return pa.ipc.new_file(path, schema)
+
+	def iter_batches(self, path, columns=None, batch_size=100000, memory_map=False):
+
+		with (pa.memory_map(path) if memory_map else pa.OSFile(path)) as src:
+			reader = pa.ipc.open_file(src)
+			for i in range(reader.num_record_batches):
+				tbl = pa.Table.from_batches([reader.get_batch(i)])
+				tbl = tbl if columns is None else tbl.select(list(columns))
+				for start in range(0, tbl.num_rows, batch_size):
+					yield tbl.slice(start, batch_size)
+
+class PickleFormat(object):
+
+	name = "pickle"
+	extension = ".pkl"
+	dictionary_strings = False
+
+	def write(self, df, path):
+
+		df.to_pickle(path)
+
+	def read(self, path, columns=None, filters=None, memory_map=False):
+
+		assert not filters, "error! the pickle cache format doesn't support filters..."
+
+		with open(path, "rb") as f:
+			df = pickle.load(f)
+
+		return df if columns is None else df[columns]
+
+	def open_writer(self, path, schema):
+
+		raise ValueError("error! the pickle cache format can't be written in chunks...")
+
+	def iter_batches(self, path, columns=None, batch_size=100000, memory_map=False):
+
+		df = self.read(path, columns=columns)  # no way around reading all of it
+
+		for start in range(0, len(df.index), batch_size):
+			yield pa.Table.from_pandas(df.iloc[start:start + batch_size], preserve_index=False)
+
+CACHE_FORMATS = {"parquet": ParquetFormat, "feather": FeatherFormat, "pickle": PickleFormat}
+
+def cache_format(name):
+
+	name = name.strip().lower() or "parquet"
+
+	if name not in CACHE_FORMATS:
+		raise ValueError("error! unknown cache format {}; choose from {}...".format(name, sorted(CACHE_FORMATS)))
+
+	return CACHE_FORMATS[name]()
+
+#
+# a cached data frame written in one go or chunk by chunk
+#
+
+class ChunkStore(object):
+
+	def __init__(self, path, fmt):
+
+		self.path = path
+		self.fmt = fmt
+		self.schema = None  # Arrow schema, fixed by the first chunk
+		self._writer = None
+		self.nrows = 0
+
+	def exists(self):
+
+		return os.path.exists(self.path)
+
+	def remove(self):
+
+		if self.exists():
+			os.remove(self.path)
+
+	def append(self, chunk):
+
+		if self._writer is None:
+			self.schema = _arrow_schema(chunk, self.fmt.dictionary_strings)
+			self._writer = self.fmt.open_writer(self.path, self.schema)
+
+		self._writer.write_table(pa.Table.from_pandas(chunk, schema=self.schema, preserve_index=False))
+		self.nrows += len(chunk.index)
+
+	def close(self):
+
+		if self._writer is not None:
+			self._writer.close()
+			self._writer = None
+
+	def write(self, df):
+
+		self.fmt.write(df, self.path)
+		self.nrows = len(df.index)
+
+	def read(self, columns=None, filters=None, memory_map=False):
+
+		return self.fmt.read(self.path, columns=columns, filters=filters, memory_map=memory_map)
+
+	#
+	# read the stored data frame back chunk by chunk (of at most batch_size rows)
+	#
+
+	def iter_chunks(self, columns=None, batch_size=100000, memory_map=False):
+
+		for tbl in self.fmt.iter_batches(self.path, columns=columns, batch_size=batch_size, memory_map=memory_map):
+			yield tbl.to_pandas()
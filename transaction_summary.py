@@ -0,0 +1,132 @@
+"""
+Summaries of a transaction table in a single pass: every column is counted once (value_counts on the column rather
+than Python Counters and per-row lookups) and all the distributions are made of these counts:
+
+	info	: rows, unique customers, transactions and populations, gender shares, customers with a known Mosaic type,
+			  missing and unique values by column
+	mosaic	: shares by Mosaic letter (the lookup table is applied once per Mosaic type)
+	state	: shares by customer state, also as a % of the state population
+	age		: shares by age group
+
+whoever makes a summary keeps it (see CustProfileCreator.summary and DataHandler.summary), so it is computed once and
+then printed (show) or exported (to_frame, save) as many times as needed
+
+"""
+
+import json
+import pandas as pd
+
+class TransactionSummary(object):
+
+	SECTIONS = ["info", "mosaic", "state", "age"]
+
+	# the columns whose distributions we show; every other column only gets its missing and unique values counted
+	COUNTED_COLUMNS = ["Gender", "ageGroup", "MosaicType", "CustomerState", "CustPop", "SalePop"]
+
+	def __init__(self, df, mosaic=None, state_pops_ks=None):
+
+		self.rows = len(df.index)
+		self.columns = list(df)
+
+		counts = {col: df[col].value_counts(dropna=False, sort=False) for col in self.COUNTED_COLUMNS if col in df}
+		counts = {col: vc[vc > 0] for col, vc in counts.items()}  # categoricals count the unused categories too
+		others = [col for col in self.columns if col not in counts]
+
+		self.missing = pd.concat([pd.Series({col: int(vc[vc.index.isna()].sum()) for col, vc in counts.items()}, dtype="int64"),
+																	df[others].isna().sum()]).reindex(self.columns)
+		self.unique = pd.concat([pd.Series({col: int(vc.index.notna().sum()) for col, vc in counts.items()}, dtype="int64"),
+																	df[others].nunique()]).reindex(self.columns)
+
+		self.customers = int(self.unique.get("CustomerID", 0))
+		self.transactions = int(self.unique.get("transID", 0))
+		self.populations = len(set(k for col in ["CustPop", "SalePop"] if col in counts for k in counts[col].index if pd.notnull(k)))
+
+		gender = counts.get("Gender", pd.Series(dtype="int64"))
+		self.gender_pct = pd.Series({"males": gender.get("M", 0), "females": gender.get("F", 0),
+										"no gender": gender.sum() - gender.get("M", 0) - gender.get("F", 0)})*100/max(gender.sum(), 1)
+
+		self.mosaic_known_pct = 100*(1 - self.missing.get("MosaicType", self.rows)/max(self.rows, 1))
+
+		self.mosaic_letter_pct = pd.Series(dtype=float)
+		if (mosaic is not None) and ("MosaicType" in counts):
+			mos_counts = counts["MosaicType"][counts["MosaicType"].index.notna()]
+			by_letter = mos_counts.groupby(mosaic.table(mos_counts.index)["letter"].values).sum()
+			self.mosaic_letter_pct = self._pct(by_letter)
+
+		states = counts.get("CustomerState", pd.Series(dtype="int64"))
+		states = states[states.index.notna()]
+		self.state_pct = self._pct(states)
+		self.state_per_capita_pct = pd.Series(dtype=float)
+		if state_pops_ks is not None:
+			known = states[states.index.isin(list(state_pops_ks))]
+			self.state_per_capita_pct = (known*100/(pd.Series(state_pops_ks).reindex(known.index).values*1000)).sort_values(ascending=False)
+
+		ages = counts.get("ageGroup", pd.Series(dtype="int64"))
+		self.age_pct = self._pct(ages[ages.index.notna() & (ages.index != "UNK")])
+
+	def _pct(self, counts):
+
+		return (counts*100/max(counts.sum(), 1)).sort_values(ascending=False)
+
+	def _show_ranking(self, title, pct, decimals=1, header=True):
+
+		print(title)
+		if header:
+			print("{}\t{}".format("  ","%"))
+		for k, v in pct.items():
+			print("{}:\t{}".format(k, round(v, decimals)))
+
+	def show(self, sections=None):
+
+		for section in sections or self.SECTIONS:
+
+			if section == "info":
+				print("---> some data info")
+				print("number or rows: {}".format(self.rows))
+				print("unique customers: {}".format(self.customers))
+				print("unique transactions: {}".format(self.transactions))
+				print("populations: {}".format(self.populations))
+				print("males: {}% females: {}% no gender: {}%".format(*[round(v, 1) for v in self.gender_pct.values]))
+				print("customers with known Mosaic type: {}%".format(round(self.mosaic_known_pct, 2)))
+				print("missing values:\n", self.missing[self.missing > 0])
+			elif section == "mosaic":
+				self._show_ranking("---> customers by mosaic letters", self.mosaic_letter_pct)
+			elif section == "state":
+				self._show_ranking("---> customers by state", self.state_pct)
+				self._show_ranking("---> customers by state as % of state population (2016)", self.state_per_capita_pct, 2, header=False)
+			elif section == "age":
+				self._show_ranking("---> customers by age", self.age_pct)
+			else:
+				raise ValueError("error! unknown summary section {}; choose from {}...".format(section, self.SECTIONS))
+
+	#
+	# everything in one long table: (section, measure, key, value)
+	#
+
+	def to_frame(self):
+
+		parts = [pd.DataFrame({"section": "info", "measure": ["rows", "customers", "transactions", "populations", "mosaic_known_pct"],
+								"key": "", "value": [self.rows, self.customers, self.transactions, self.populations, self.mosaic_known_pct]})]
+
+		for section, measure, values in [("info", "gender_pct", self.gender_pct), ("info", "missing", self.missing),
+											("info", "unique", self.unique), ("mosaic", "letter_pct", self.mosaic_letter_pct),
+											("state", "state_pct", self.state_pct), ("state", "per_capita_pct", self.state_per_capita_pct),
+											("age", "age_group_pct", self.age_pct)]:
+			parts.append(pd.DataFrame({"section": section, "measure": measure, "key": [str(k) for k in values.index],
+																							"value": values.astype(float).values}))
+
+		return pd.concat(parts, ignore_index=True)
+
+	def save(self, path):
+
+		tbl = self.to_frame()
+
+		if path.endswith(".json"):
+			with open(path, "w") as f:
+				json.dump({s: {m: g["value"].iloc[0] if (g["key"] == "").all() else dict(zip(g["key"], g["value"])) 
+																	for m, g in by_section.groupby("measure", sort=False)}
+															for s, by_section in tbl.groupby("section", sort=False)}, f, indent=1)
+		else:
+			tbl.to_csv(path, sep="\t", index=False)
+
+		print("saved data summary to {}...".format(path))